@@ -0,0 +1,102 @@
+"""Depositor compression workers benchmark
+
+Deposit the same synthetic flow with different ``compress_workers`` settings and write the measures as JSON:
+
+* ``add_document`` throughput (documents, rows and raw megabytes per second) of each worker number
+* ``compress_share``: part of ``add_document`` time spent in compression when it runs on the calling thread,
+  which is the part that could run in parallel. It is measured by a separate run because metrics add overhead
+* ``same_documents``: the documents are the same as the ones of the calling thread compression
+
+The compression runs in threads, zlib releases the GIL, so the scaling needs as many free CPU cores as workers.
+
+Usage:
+    python benchmarks/bench_compress_workers.py --rows 200000 --workers 0 1 2 4 --output result.json
+"""
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import platform
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import xialib
+from xialib import FileDepositor
+from bench_depositor import get_synthetic_batches
+
+
+def get_documents(batches: list) -> list:
+    return [(header.copy(), [line.copy() for line in data]) for header, data in batches]
+
+
+def get_compress_share(batches: list, args) -> float:
+    with tempfile.TemporaryDirectory() as deposit_path:
+        depositor = FileDepositor(deposit_path=deposit_path, metrics=True)
+        depositor.size_limit = args.size_limit
+        for header, data in get_documents(batches):
+            depositor.add_document(header, data)
+        metrics = depositor.get_metrics()
+    return metrics.get('compress_time', 0.0) / metrics['add_document_time']
+
+
+def run_workers(batches: list, args, compress_workers: int) -> dict:
+    with tempfile.TemporaryDirectory() as deposit_path:
+        depositor = FileDepositor(deposit_path=deposit_path, compress_workers=compress_workers)
+        depositor.size_limit = args.size_limit
+        documents = get_documents(batches)
+        doc_list, duration = list(), 0.0
+        for header, data in documents:
+            start = time.perf_counter()
+            doc_list.extend(depositor.add_document(header, data))
+            duration += time.perf_counter() - start
+    raw_size = sum(len(json.dumps(data)) for header, data in batches)
+    result = {'workers': compress_workers, 'docs': len(doc_list), 'seconds': duration,
+              'docs_per_sec': len(doc_list) / duration, 'rows_per_sec': args.rows / duration,
+              'mb_per_sec': raw_size / duration / 2 ** 20}
+    # Gzip header holds the compression time at bytes 4 - 7
+    result['data'] = [(lambda data: data[:4] + data[8:])(base64.b64decode(doc['data'])) for doc in doc_list]
+    return result
+
+
+def run(args) -> dict:
+    result = {'xialib_version': xialib.__version__, 'python_version': platform.python_version(),
+              'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+              'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'parameters': vars(args), 'compress_share': None,
+              'runs': list()}
+    batches = list(get_synthetic_batches(args.flow, args.rows, args.width, args.batch_size, args.seed))
+    result['compress_share'] = get_compress_share(batches, args)
+    serial_data = None
+    for compress_workers in args.workers:
+        run_result = run_workers(batches, args, compress_workers)
+        run_data = run_result.pop('data')
+        serial_data = run_data if serial_data is None else serial_data
+        run_result['same_documents'] = (run_data == serial_data)
+        result['runs'].append(run_result)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--width', type=int, default=20, help='Number of fields of each line')
+    parser.add_argument('--batch-size', type=int, default=50000, help='Lines of each add_document call')
+    parser.add_argument('--size-limit', type=int, default=2 ** 20)
+    parser.add_argument('--flow', default='normal', choices=['aged', 'normal'])
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4],
+                        help='compress_workers settings, the first one is the reference of same_documents')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='JSON output file, default print to stdout')
+    args = parser.parse_args()
+    result = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(result)
+    else:
+        print(result)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""Depositor benchmark suite
+
+Deposit synthetic aged and normal flows, merge them level by level and write the measures as JSON:
+
+* ``add_document`` throughput (documents, rows and raw megabytes per second)
+* ``merge_documents`` latency of each merge level 1 - 7. Only the calls which really merge documents are timed,
+  the calls with nothing to merge are counted and timed apart as ``skipped``
+* With ``--memory``, peak memory allocated by Python (tracemalloc) during deposit and during merge. Tracing slows
+  down every allocation, so the memory is measured by separate runs and never by the timed ones
+
+Usage:
+    python benchmarks/bench_depositor.py --rows 100000 --width 20 --memory --output result.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import string
+import argparse
+import platform
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import xialib
+from xialib import FileDepositor
+
+
+START_SEQ = '20201113222500000000'
+
+
+def get_batch_merge_level(batch_nb: int, batch_total: int) -> int:
+    """Merge level of the document of each batch: 0 for one batch of two, 1 for one of four... and 7 for the last"""
+    if batch_nb == batch_total - 1:
+        return 7
+    return min(7, (((batch_nb + 1) & -(batch_nb + 1)).bit_length() - 1))
+
+
+def get_leader_key(min_key: int, merge_level: int) -> int:
+    """Smallest merge key from ``min_key`` whose merge level is ``merge_level``"""
+    while FileDepositor.calc_merge_level(str(min_key)) != merge_level:
+        min_key += 1
+    return min_key
+
+
+def get_synthetic_batches(flow: str, row_nb: int, width: int, batch_size: int, seed: int = 0):
+    """Yield (header, data) of each deposit, ``width`` is the number of business fields
+
+    The merge keys are chosen so that every merge level has leader documents (see :func:`get_batch_merge_level`),
+    so an aged batch might cover more ages than its lines and a normal batch might skip some sequences
+    """
+    rand = random.Random(seed)
+    batch_total, next_key = (row_nb + batch_size - 1) // batch_size, int(START_SEQ) + 2
+    words = [''.join(rand.choice(string.ascii_uppercase) for _ in range(8)) for _ in range(64)]
+    for batch_nb, batch_start in enumerate(range(0, row_nb, batch_size)):
+        data = list()
+        for row_id in range(batch_start, min(batch_start + batch_size, row_nb)):
+            line = {'_NO': row_id, 'ID': row_id}
+            for field_nb in range(width - 1):
+                if field_nb % 3 == 0:
+                    line['F{}'.format(field_nb)] = rand.randint(0, 10 ** 6)
+                elif field_nb % 3 == 1:
+                    line['F{}'.format(field_nb)] = round(rand.random() * 10000, 2)
+                else:
+                    line['F{}'.format(field_nb)] = rand.choice(words)
+            data.append(line)
+        header = {'topic_id': 'bench', 'table_id': flow, 'start_seq': START_SEQ}
+        merge_level = get_batch_merge_level(batch_nb, batch_total)
+        if flow == 'aged':
+            header['age'] = next_key - int(START_SEQ)
+            next_key = get_leader_key(next_key + batch_size - 1, merge_level) + 1
+            header['end_age'] = next_key - 1 - int(START_SEQ)
+            for line in data:
+                line['_AGE'] = header['age']
+        else:
+            header['start_seq'] = str(get_leader_key(next_key, merge_level))
+            next_key = int(header['start_seq']) + 1
+            for line in data:
+                line['_SEQ'] = header['start_seq']
+        yield header, data
+
+
+def get_depositor(deposit_path: str, args) -> FileDepositor:
+    depositor = FileDepositor(deposit_path=deposit_path, **json.loads(args.depositor_kwargs))
+    depositor.size_limit = args.size_limit
+    return depositor
+
+
+def run_deposit(depositor: FileDepositor, flow: str, args, memory: bool = False) -> dict:
+    field_data = [{'field_name': 'ID', 'key_flag': True}] + \
+                 [{'field_name': 'F{}'.format(i), 'key_flag': False} for i in range(args.width - 1)]
+    depositor.add_document({'topic_id': 'bench', 'table_id': flow, 'aged': str(flow == 'aged'), 'age': '1',
+                            'start_seq': START_SEQ}, field_data)
+    batches = list(get_synthetic_batches(flow, args.rows, args.width, args.batch_size, args.seed))
+    if memory:
+        tracemalloc.start()
+        for header, data in batches:
+            depositor.add_document(header, data)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return {'peak_memory_bytes': peak_memory}
+    raw_size = sum(len(json.dumps(data)) for header, data in batches)
+    doc_nb, duration = 0, 0.0
+    for header, data in batches:
+        start = time.perf_counter()
+        doc_nb += len(depositor.add_document(header, data))
+        duration += time.perf_counter() - start
+    return {'docs': doc_nb, 'rows': args.rows, 'raw_bytes': raw_size, 'seconds': duration,
+            'docs_per_sec': doc_nb / duration, 'rows_per_sec': args.rows / duration,
+            'mb_per_sec': raw_size / duration / 2 ** 20}
+
+
+def run_merge(depositor: FileDepositor, memory: bool = False) -> dict:
+    if memory:
+        tracemalloc.start()
+        for merge_level in range(1, 8):
+            for doc in depositor.get_stream_by_sort_key(status_list=['initial', 'merged'],
+                                                        min_merge_level=merge_level):
+                depositor.merge_documents(depositor.get_header_from_ref(doc)['merge_key'], merge_level)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return {'peak_memory_bytes': peak_memory}
+    levels = dict()
+    for merge_level in range(1, 8):
+        latencies, skipped_latencies = list(), list()
+        for doc in depositor.get_stream_by_sort_key(status_list=['initial', 'merged'], min_merge_level=merge_level):
+            doc_header = depositor.get_header_from_ref(doc)
+            merge_key, merged_level = doc_header['merge_key'], doc_header.get('merged_level', 0)
+            start = time.perf_counter()
+            depositor.merge_documents(merge_key, merge_level)
+            latency = time.perf_counter() - start
+            # Leader is marked as merged only when the documents are really merged
+            doc_header = depositor.get_header_from_ref(depositor.get_ref_by_merge_key(merge_key))
+            if merged_level < merge_level == doc_header.get('merged_level', 0):
+                latencies.append(latency)
+            else:
+                skipped_latencies.append(latency)
+        levels[str(merge_level)] = {'merges': len(latencies), 'seconds': sum(latencies),
+                                    'mean_seconds': sum(latencies) / len(latencies) if latencies else 0.0,
+                                    'max_seconds': max(latencies) if latencies else 0.0,
+                                    'skipped': len(skipped_latencies), 'skipped_seconds': sum(skipped_latencies)}
+    doc_nb = len(list(depositor.get_stream_by_sort_key(status_list=['initial', 'merged'])))
+    return {'levels': levels, 'docs_after_merge': doc_nb}
+
+
+def run(args) -> dict:
+    result = {'xialib_version': xialib.__version__, 'python_version': platform.python_version(),
+              'platform': platform.platform(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'parameters': vars(args), 'flows': dict()}
+    for flow in args.flows:
+        with tempfile.TemporaryDirectory() as deposit_path:
+            depositor = get_depositor(deposit_path, args)
+            deposit_result = run_deposit(depositor, flow, args)
+            merge_result = run_merge(depositor)
+        if args.memory:
+            with tempfile.TemporaryDirectory() as deposit_path:
+                depositor = get_depositor(deposit_path, args)
+                deposit_result.update(run_deposit(depositor, flow, args, True))
+                merge_result.update(run_merge(depositor, True))
+        result['flows'][flow] = {'add_document': deposit_result, 'merge_documents': merge_result}
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--width', type=int, default=20, help='Number of fields of each line')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Lines of each add_document call')
+    parser.add_argument('--size-limit', type=int, default=2 ** 20)
+    parser.add_argument('--flows', nargs='+', default=['aged', 'normal'], choices=['aged', 'normal'])
+    parser.add_argument('--depositor-kwargs', default='{}', help='FileDepositor parameters as json')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--memory', action='store_true', help='Measure peak memory by separate untimed runs')
+    parser.add_argument('--output', default=None, help='JSON output file, default print to stdout')
+    args = parser.parse_args()
+    result = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(result)
+    else:
+        print(result)
+
+
+if __name__ == '__main__':
+    main()
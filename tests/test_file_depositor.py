@@ -1,4 +1,5 @@
 import os
+import asyncio
 import base64
 import gzip
 import time
@@ -6,9 +7,13 @@ import datetime
 import json
 import pytest
 import random
-from shutil import copy2
+import threading
+from shutil import copy2, rmtree
 from xialib import FileDepositor
 from xialib import BasicTranslator
+from xialib import Depositor
+from xialib import MergeScheduler
+from xialib import AsyncDepositor
 
 
 @pytest.fixture(scope='module')
@@ -23,6 +28,43 @@ def depositor():
     for file in os.listdir(os.path.join(depositor.deposit_path, 'test', 'normal_data')):
         os.remove(os.path.join(depositor.deposit_path, 'test', 'normal_data', file))
 
+def get_person_body():
+    with open(os.path.join('.', 'input', 'person_complex', '000002.json'), 'rb') as f:
+        return json.loads(f.read().decode())
+
+def get_depositor_factory(deposit_path, **kwargs):
+    def depositor_factory():
+        factory_depositor = FileDepositor(deposit_path=deposit_path, **kwargs)
+        factory_depositor.size_limit = 4096
+        return factory_depositor
+    return depositor_factory
+
+def add_table_documents(table_depositor, topic_id, table_id, data_body, aged=True, field_data=None):
+    """Add the table header then one document per 50 lines (age range or start sequence)"""
+    table_depositor.add_document({'topic_id': topic_id, 'table_id': table_id, 'aged': str(aged), 'age': '1',
+                                  'start_seq': '20201113222500000000'}, field_data if field_data else [])
+    for i in range(0, len(data_body), 50):
+        if aged:
+            doc_header = {'topic_id': topic_id, 'table_id': table_id, 'start_seq': '20201113222500000000',
+                          'age': i + 2, 'end_age': i + 51}
+            doc_data = [dict(line, _AGE=i + 2, _NO=line['id']) for line in data_body[i: i + 50]]
+        else:
+            doc_header = {'topic_id': topic_id, 'table_id': table_id, 'start_seq': str(20201113222500000000 + i)}
+            doc_data = [dict(line, _SEQ=doc_header['start_seq'], _NO=line['id']) for line in data_body[i: i + 50]]
+        table_depositor.add_document(doc_header, doc_data)
+
+def merge_table_documents(table_depositor, max_merge_level=7):
+    for mlvl in range(1, max_merge_level + 1):
+        for doc in table_depositor.get_stream_by_sort_key(status_list=['initial', 'merged'], min_merge_level=mlvl):
+            table_depositor.merge_documents(table_depositor.get_header_from_ref(doc)['merge_key'], mlvl)
+
+def get_table_ids(table_depositor):
+    id_list = list()
+    for doc in table_depositor.get_stream_by_sort_key(status_list=['initial', 'merged']):
+        doc_dict = table_depositor.get_header_from_ref(doc)
+        id_list.extend([line['id'] for line in table_depositor.get_data_from_header(doc_dict)])
+    return sorted(id_list)
+
 def test_delete_documents(depositor):
     copy2(os.path.join(depositor.deposit_path, 'case_delete', '20201113222500000000.header'),
           os.path.join(depositor.deposit_path, 'test-001', 'person_complex', '20201113222500000000.header'))
@@ -72,7 +114,7 @@ def test_add_aged_document(depositor):
         data_body = json.loads(f.read().decode())
         age_header = {'topic_id': 'test', 'age': 2, 'table_id': 'aged_data', 'start_seq': '20201113222500000000'}
 
-    start_age, current_age, test_data = 2, 2, list()
+    current_age, test_data = 2, list()
     translator.compile(age_header, test_data)
     for line in data_body:
         current_age = int(line['id']) + 1
@@ -146,6 +188,83 @@ def test_add_normal_document(depositor):
         counter += len(doc_data)
     assert counter == 864
 
+def test_compress_ratio(depositor):
+    depositor.set_current_topic_table('test', 'normal_data')
+    header_dict = depositor.get_header_from_ref(depositor.get_table_header())
+    assert header_dict['compress_ratio'] > 1
+    new_depositor = FileDepositor(deposit_path=depositor.deposit_path)
+    new_depositor.set_current_topic_table('test', 'normal_data')
+    assert new_depositor._get_compress_ratio() == header_dict['compress_ratio']
+
+def test_compress_ratio_drift(depositor):
+    ratio_depositor = FileDepositor(deposit_path=depositor.deposit_path)
+    ratio_depositor.size_limit = 2 ** 16
+    rand = random.Random(0)
+    normal_header = {'topic_id': 'test-002', 'table_id': 'ratio_drift', 'start_seq': '20201113222500000100'}
+    repetitive_data = [{'_SEQ': '20201113222500000100', '_NO': i, 'id': i, 'text': 'A' * 500} for i in range(2000)]
+    ratio_depositor.add_document(normal_header, repetitive_data)
+    assert ratio_depositor._get_compress_ratio() > 20
+    normal_header['start_seq'] = '20201113222500010000'
+    random_data = [{'_SEQ': '20201113222500010000', '_NO': i, 'id': i,
+                    'text': base64.b64encode(rand.getrandbits(2400).to_bytes(300, 'little')).decode()}
+                   for i in range(2000)]
+    ratio_depositor.add_document(normal_header, random_data)
+    line_nb = 0
+    for doc in ratio_depositor.get_stream_by_sort_key(status_list=['initial']):
+        doc_dict = ratio_depositor.get_header_from_ref(doc)
+        assert doc_dict['data_size'] < ratio_depositor.size_limit
+        line_nb += doc_dict['line_nb']
+    assert line_nb == 4000
+    assert ratio_depositor._get_compress_ratio() < 2
+    rmtree(os.path.join(depositor.deposit_path, 'test-002'))
+
+def test_compress_workers(depositor):
+    data_body = get_person_body()
+    doc_lists = list()
+    for compress_workers in [0, 2]:
+        worker_depositor = FileDepositor(deposit_path=depositor.deposit_path, compress_workers=compress_workers)
+        worker_depositor.size_limit = 4096
+        table_id = 'compress_workers_' + str(compress_workers)
+        aged_header = {'topic_id': 'test-002', 'table_id': table_id, 'start_seq': '20201113222500000000',
+                       'age': 2, 'end_age': 100000}
+        normal_header = {'topic_id': 'test-002', 'table_id': table_id, 'start_seq': '20201113222500000100'}
+        doc_list = worker_depositor.add_document(aged_header, [dict(line, _AGE=2, _NO=0) for line in data_body])
+        doc_list += worker_depositor.add_document(normal_header, [dict(line, _SEQ='20201113222500000100', _NO=0)
+                                                                  for line in data_body])
+        doc_lists.append(doc_list)
+    assert len(doc_lists[0]) == len(doc_lists[1]) > 10
+    for serial_doc, pooled_doc in zip(*doc_lists):
+        assert serial_doc['line_nb'] == pooled_doc['line_nb']
+        assert serial_doc['merge_key'] == pooled_doc['merge_key']
+        serial_data, pooled_data = base64.b64decode(serial_doc['data']), base64.b64decode(pooled_doc['data'])
+        # Gzip header holds the compression time at bytes 4 - 7
+        assert serial_data[:4] + serial_data[8:] == pooled_data[:4] + pooled_data[8:]
+        assert len(serial_data) < worker_depositor.size_limit
+    line_list = [line for doc in doc_lists[1] for line in worker_depositor.get_data_from_header(doc)]
+    assert [line['id'] for line in line_list] == [line['id'] for line in data_body] * 2
+    rmtree(os.path.join(depositor.deposit_path, 'test-002'))
+
+def test_add_stream_document(depositor):
+    depositor.size_limit = 4096
+    depositor.sort_buffer_size = 2048
+    data_body = get_person_body()
+    random.seed(2)
+    random.shuffle(data_body)
+    stream_header = {'topic_id': 'test-002', 'table_id': 'stream_data'}
+
+    def data_stream():
+        for line in data_body:
+            yield {'_SEQ': '20201113222500000100', '_NO': line['id'], 'id': line['id']}
+
+    depositor.add_document(stream_header, data_stream())
+    id_list = list()
+    for doc in depositor.get_stream_by_sort_key(status_list=['initial']):
+        doc_dict = depositor.get_header_from_ref(doc)
+        id_list.extend([line['id'] for line in depositor.get_data_from_header(doc_dict)])
+    assert id_list == sorted(line['id'] for line in data_body)
+    depositor.sort_buffer_size = Depositor.sort_buffer_size
+    rmtree(os.path.join(depositor.deposit_path, 'test-002'))
+
 def test_merge_aged_simple(depositor):
     depositor.set_current_topic_table('test', 'aged_data')
     depositor.size_limit = 5000
@@ -194,6 +313,469 @@ def test_merge_normal_simple(depositor):
     header_dict = depositor.get_header_from_ref(header_ref)
     assert total_size == header_dict['merged_size']
 
+def test_split_body(depositor):
+    split_depositor = FileDepositor(deposit_path=depositor.deposit_path, split_body=True)
+    split_depositor.size_limit = 4096
+    with open(os.path.join('.', 'input', 'person_complex', 'schema.json'), 'rb') as f:
+        field_data = json.loads(f.read().decode()).pop('columns')
+    data_body = get_person_body()
+    add_table_documents(split_depositor, 'test-003', 'split_data', data_body, field_data=field_data)
+    read_list, read_nb, get_data_from_header = list(), 0, split_depositor.get_data_from_header
+
+    def counted_get_data_from_header(header):
+        read_list.append(header['merge_key'])
+        return get_data_from_header(header)
+
+    split_depositor.get_data_from_header = counted_get_data_from_header
+    for mlvl in range(1, 8):
+        for doc in split_depositor.get_stream_by_sort_key(status_list=['initial', 'merged'], min_merge_level=mlvl):
+            read_list.clear()
+            split_depositor.merge_documents(split_depositor.get_header_from_ref(doc)['merge_key'], mlvl)
+            # Each document body is read once by a merge operation
+            assert len(read_list) == len(set(read_list))
+            read_nb += len(read_list)
+    del split_depositor.get_data_from_header
+    assert read_nb > 0
+    assert list(split_depositor.get_stream_by_sort_key(status_list=['merged']))
+    assert split_depositor.cache_stats['header_hits'] > 0
+    assert split_depositor._header_counters is None
+    assert split_depositor._header_cache is None
+    for doc in split_depositor.get_stream_by_sort_key(status_list=['initial', 'merged']):
+        doc_dict = split_depositor.get_header_from_ref(doc)
+        assert 'data' not in doc_dict
+        assert os.path.getsize(os.path.join(split_depositor.table_path, doc.split('.')[0] + '.body')) == \
+            doc_dict['data_size']
+    assert get_table_ids(split_depositor) == sorted(line['id'] for line in data_body)
+    header_dict = split_depositor.get_header_from_ref(split_depositor.get_table_header())
+    assert len(split_depositor.get_data_from_header(header_dict)) == len(field_data)
+    rmtree(os.path.join(depositor.deposit_path, 'test-003'))
+
+def test_table_header_counters(depositor):
+    counter_depositor = FileDepositor(deposit_path=depositor.deposit_path)
+    counter_depositor.set_current_topic_table('test', 'aged_data')
+    counter_depositor._header_counters = dict()
+    for i in range(3):
+        counter_depositor._inc_counters(merged_size=10, merged_lines=1)
+    assert counter_depositor._header_counters == {'merged_size': 30, 'merged_lines': 3}
+    before = counter_depositor.get_header_from_ref(counter_depositor.get_table_header())
+    header_dict = counter_depositor.flush_table_header()
+    assert header_dict['merged_size'] == before.get('merged_size', 0) + 30
+    assert counter_depositor.flush_table_header() is None
+    counter_depositor.header_flush_interval = 2
+    counter_depositor._inc_counters(merged_size=10, merged_lines=1)
+    assert counter_depositor._header_counters
+    counter_depositor._inc_counters(merged_size=10, merged_lines=1)
+    assert not counter_depositor._header_counters
+    header_dict = counter_depositor.get_header_from_ref(counter_depositor.get_table_header())
+    assert header_dict['merged_lines'] == before.get('merged_lines', 0) + 5
+    counter_depositor.inc_table_header(merged_size=-50, merged_lines=-5)
+
+def test_calc_merge_levels():
+    merge_keys = [str(20201113222500000000 + i) for i in range(2000)]
+    assert Depositor.calc_merge_levels(merge_keys + merge_keys[:10]) == \
+        [Depositor.calc_merge_level(key) for key in merge_keys + merge_keys[:10]]
+    assert max(Depositor.calc_merge_levels(merge_keys)) > 0
+
+def test_merge_scheduler(depositor):
+    data_body, task_list = get_person_body(), list()
+    depositor_factory = get_depositor_factory(depositor.deposit_path)
+    for table_id in ['table_a', 'table_b']:
+        table_depositor = depositor_factory()
+        add_table_documents(table_depositor, 'test-004', table_id, data_body)
+        for mlvl in range(7, 0, -1):
+            for doc in table_depositor.get_stream_by_sort_key(status_list=['initial'], min_merge_level=mlvl):
+                task_list.append(('test-004', table_id, table_depositor.get_header_from_ref(doc)['merge_key'], mlvl))
+    scheduler = MergeScheduler(depositor_factory, max_workers=2)
+    assert all(scheduler.run(task_list))
+    for table_id in ['table_a', 'table_b']:
+        table_depositor = depositor_factory()
+        table_depositor.set_current_topic_table('test-004', table_id)
+        assert list(table_depositor.get_stream_by_sort_key(status_list=['merged']))
+        assert get_table_ids(table_depositor) == sorted(line['id'] for line in data_body)
+    rmtree(os.path.join(depositor.deposit_path, 'test-004'))
+
+def test_async_depositor(depositor):
+    data_body = get_person_body()
+    depositor_factory = get_depositor_factory(depositor.deposit_path)
+
+    async def load_table(async_depositor, table_id):
+        await async_depositor.add_document({'topic_id': 'test-011', 'table_id': table_id, 'aged': 'True',
+                                            'age': '1', 'start_seq': '20201113222500000000'}, [])
+        add_tasks = list()
+        for i in range(0, len(data_body), 50):
+            age_header = {'topic_id': 'test-011', 'table_id': table_id, 'start_seq': '20201113222500000000',
+                          'age': i + 2, 'end_age': i + 51}
+            add_tasks.append(async_depositor.add_document(age_header, [dict(line, _AGE=i + 2, _NO=line['id'])
+                                                                       for line in data_body[i: i + 50]]))
+        await asyncio.gather(*add_tasks)
+        table_depositor = depositor_factory()
+        table_depositor.set_current_topic_table('test-011', table_id)
+        for mlvl in range(1, 8):
+            for doc in table_depositor.get_stream_by_sort_key(status_list=['initial', 'merged'], min_merge_level=mlvl):
+                merge_key = table_depositor.get_header_from_ref(doc)['merge_key']
+                assert await async_depositor.merge_documents('test-011', table_id, merge_key, mlvl)
+
+    async def load_tables():
+        async with AsyncDepositor(depositor_factory, max_workers=2) as async_depositor:
+            await asyncio.gather(load_table(async_depositor, 'table_a'), load_table(async_depositor, 'table_b'))
+        return async_depositor
+
+    loop = asyncio.new_event_loop()
+    async_depositor = loop.run_until_complete(load_tables())
+    # The worker threads are released when leaving the context
+    with pytest.raises(RuntimeError):
+        loop.run_until_complete(async_depositor.merge_documents('test-011', 'table_a', '20201113222500000051', 1))
+    loop.close()
+    for table_id in ['table_a', 'table_b']:
+        table_depositor = depositor_factory()
+        table_depositor.set_current_topic_table('test-011', table_id)
+        assert list(table_depositor.get_stream_by_sort_key(status_list=['merged']))
+        assert get_table_ids(table_depositor) == sorted(line['id'] for line in data_body)
+    rmtree(os.path.join(depositor.deposit_path, 'test-011'))
+
+def test_async_depositor_overlap(depositor):
+    # Each call waits for the other one, the barrier is broken if the calls are not running at the same time
+    barrier = threading.Barrier(2, timeout=10)
+    depositor_factory = get_depositor_factory(depositor.deposit_path)
+
+    def barrier_depositor_factory():
+        barrier_depositor = depositor_factory()
+        add_document = barrier_depositor.add_document
+
+        def add_document_together(header, data):
+            barrier.wait()
+            return add_document(header, data)
+        barrier_depositor.add_document = add_document_together
+        return barrier_depositor
+
+    async def add_headers():
+        async with AsyncDepositor(barrier_depositor_factory, max_workers=2) as async_depositor:
+            return await asyncio.gather(*[async_depositor.add_document(
+                {'topic_id': 'test-011', 'table_id': table_id, 'aged': 'True', 'age': '1',
+                 'start_seq': '20201113222500000000'}, []) for table_id in ['table_a', 'table_b']])
+
+    loop = asyncio.new_event_loop()
+    results = loop.run_until_complete(add_headers())
+    loop.close()
+    assert [result[0]['table_id'] for result in results] == ['table_a', 'table_b']
+    assert not barrier.broken
+    rmtree(os.path.join(depositor.deposit_path, 'test-011'))
+
+@pytest.mark.parametrize("aged", [True, False])
+def test_plan_merge(depositor, aged):
+    plan_depositor = get_depositor_factory(depositor.deposit_path)()
+    add_table_documents(plan_depositor, 'test-012', 'plan_data', get_person_body(), aged)
+    assert plan_depositor.plan_merge('20991113222500000000', 1)['status'] == 'blocked'
+    # Interrupted merge and cache of a running merge
+    plan_depositor._save_journal({'merge_key': '20201113222500000051', 'merge_level': 1, 'aged': aged,
+                                  'key_list': [], 'done': 1, 'attempts': 2, 'operations': [{}, {}]})
+    header_cache = plan_depositor._header_cache = object()
+    assert plan_depositor.plan_merge('20991113222500000000', 1)['pending_journal'] == \
+        {'merge_key': '20201113222500000051', 'merge_level': 1, 'done': 1, 'operations': 2, 'attempts': 2}
+    assert plan_depositor._header_cache is header_cache
+    plan_depositor._header_cache = None
+    plan_depositor._clear_journal()
+    for mlvl in range(1, 8):
+        for doc in plan_depositor.get_stream_by_sort_key(status_list=['initial', 'merged'], min_merge_level=mlvl):
+            merge_key = plan_depositor.get_header_from_ref(doc)['merge_key']
+            file_list = sorted(os.listdir(plan_depositor.table_path))
+            doc_nb = len(list(plan_depositor.get_stream_by_sort_key(status_list=['initial', 'merged'])))
+            plan = plan_depositor.plan_merge(merge_key, mlvl)
+            assert sorted(os.listdir(plan_depositor.table_path)) == file_list
+            if plan['status'] == 'merged':
+                continue
+            assert plan['status'] == 'ready'
+            assert plan['pending_journal'] is None
+            assert plan['read_bytes'] == sum(task['size'] for task in plan['tasks']) or not plan['simple']
+            assert plan['doc_count'] == len(plan['tasks']) - plan['docs_deleted']
+            assert plan_depositor.merge_documents(merge_key, mlvl)
+            assert plan_depositor.plan_merge(merge_key, mlvl)['status'] == 'merged'
+            assert len(list(plan_depositor.get_stream_by_sort_key(status_list=['initial', 'merged']))) == \
+                doc_nb - plan['docs_deleted']
+    rmtree(os.path.join(depositor.deposit_path, 'test-012'))
+
+@pytest.mark.parametrize("aged", [True, False])
+def test_resume_merge(depositor, aged):
+    resume_depositor, data_body = get_depositor_factory(depositor.deposit_path)(), get_person_body()
+    add_table_documents(resume_depositor, 'test-005', 'resume_data', data_body, aged)
+    journal_file = os.path.join(resume_depositor.table_path, 'merge.journal')
+    save_progress, interruptions = resume_depositor._save_journal_progress, list()
+
+    def interrupted_save_progress(done):
+        # Interrupted just before or just after saving the progress of the first operation
+        if done == 1 and len(interruptions) % 2 == 0:
+            interruptions.append(done)
+            raise RuntimeError
+        save_progress(done)
+        if done == 1 and len(interruptions) % 2 == 1:
+            interruptions.append(done)
+            raise RuntimeError
+
+    assert not resume_depositor.resume_merge()
+    for mlvl in range(1, 8):
+        for doc in resume_depositor.get_stream_by_sort_key(status_list=['initial', 'merged'], min_merge_level=mlvl):
+            merge_key = resume_depositor.get_header_from_ref(doc)['merge_key']
+            resume_depositor._save_journal_progress = interrupted_save_progress
+            with pytest.raises(RuntimeError):
+                resume_depositor.merge_documents(merge_key, mlvl)
+            assert os.path.exists(journal_file)
+            resume_depositor._save_journal_progress = save_progress
+            assert resume_depositor.resume_merge()
+            assert not os.path.exists(journal_file)
+            assert resume_depositor.merge_documents(merge_key, mlvl)
+    assert len(interruptions) > 2
+    assert get_table_ids(resume_depositor) == sorted(line['id'] for line in data_body)
+    rmtree(os.path.join(depositor.deposit_path, 'test-005'))
+
+def test_merge_attempt_limit(depositor):
+    limit_depositor, data_body = get_depositor_factory(depositor.deposit_path)(), get_person_body()
+    add_table_documents(limit_depositor, 'test-013', 'limit_data', data_body)
+    journal_file = os.path.join(limit_depositor.table_path, 'merge.journal')
+    merge_key = limit_depositor.get_header_from_ref(
+        next(limit_depositor.get_stream_by_sort_key(status_list=['initial'], min_merge_level=1)))['merge_key']
+
+    def failed_save_progress(done):
+        raise RuntimeError
+
+    limit_depositor._save_journal_progress = failed_save_progress
+    with pytest.raises(RuntimeError):
+        limit_depositor.merge_documents(merge_key, 1)
+    for attempt in range(limit_depositor.merge_attempt_limit):
+        with pytest.raises(RuntimeError):
+            limit_depositor.resume_merge()
+        with open(journal_file) as f:
+            assert json.loads(f.read())['attempts'] == attempt + 1
+    # The failing journal is discarded so it doesn't block the next merges
+    assert not limit_depositor.resume_merge()
+    assert not os.path.exists(journal_file)
+    del limit_depositor._save_journal_progress
+    assert limit_depositor.merge_documents(merge_key, 1)
+    assert get_table_ids(limit_depositor) == sorted(line['id'] for line in data_body)
+    rmtree(os.path.join(depositor.deposit_path, 'test-013'))
+
+def test_iter_data(depositor):
+    read_depositor, data_body = get_depositor_factory(depositor.deposit_path)(), get_person_body()
+    add_table_documents(read_depositor, 'test-006', 'read_data', data_body)
+    age_header = {'topic_id': 'test-006', 'table_id': 'read_data', 'start_seq': '20201113222500000000',
+                  'age': 140, 'end_age': 160}
+    read_depositor.add_document(age_header, [dict(line, _AGE=140, _NO=line['id'], city='Paris')
+                                             for line in data_body[200: 220]])
+    full_data = [(line['_AGE'], line['id'], line.get('city')) for line in read_depositor.iter_data()]
+    assert [line[0] for line in full_data] == sorted(line[0] for line in full_data)
+    assert [line for line in full_data if 140 <= line[0] <= 151] == \
+        [(140, line['id'], 'Paris') for line in data_body[200: 220]]
+    merge_table_documents(read_depositor, 3)
+    assert [(line['_AGE'], line['id'], line.get('city')) for line in read_depositor.iter_data()] == full_data
+    assert [(line['_AGE'], line['id'], line.get('city')) for line in read_depositor.iter_data(100, 250)] == \
+        [line for line in full_data if 100 <= line[0] <= 250]
+    assert [(line['_AGE'], line['id'], line.get('city')) for line in read_depositor.iter_data(end_age=60)] == \
+        [line for line in full_data if line[0] <= 60]
+    read_depositor.set_current_topic_table('test', 'normal_data')
+    with pytest.raises(ValueError):
+        list(read_depositor.iter_data(100, 250))
+    rmtree(os.path.join(depositor.deposit_path, 'test-006'))
+
+def test_key_compaction(depositor):
+    data = [{'_AGE': 2, '_NO': 1, 'id': 1, 'city': 'Lyon'}, {'_AGE': 2, '_NO': 2, 'id': 2, 'city': 'Lyon'},
+            {'_AGE': 3, '_NO': 1, 'id': 1, 'city': 'Paris', '_OP': 'U'}, {'_AGE': 3, '_NO': 2, 'id': 2, '_OP': 'D'},
+            {'_AGE': 4, '_NO': 1, 'id': 2, 'city': 'Nice'}, {'_AGE': 4, '_NO': 2, 'id': 3, 'city': 'Nice'}]
+    assert list(Depositor._get_compacted_stream(data, ['id'])) == [
+        {'_AGE': 3, '_NO': 1, 'id': 1, 'city': 'Paris', '_OP': 'U'},
+        {'_AGE': 4, '_NO': 1, 'id': 2, 'city': 'Nice', '_OP': 'U'},
+        {'_AGE': 4, '_NO': 2, 'id': 3, 'city': 'Nice'}]
+    compact_depositor = FileDepositor(deposit_path=depositor.deposit_path, key_compaction=True)
+    field_data = [{'field_name': 'id', 'key_flag': True}, {'field_name': 'city', 'key_flag': False}]
+    compact_depositor.add_document({'topic_id': 'test-007', 'table_id': 'compact_data', 'aged': 'True', 'age': '1',
+                                    'start_seq': '20201113222500000000'}, field_data)
+    age_header = {'topic_id': 'test-007', 'table_id': 'compact_data', 'start_seq': '20201113222500000000'}
+    for age in range(2, 40):
+        age_header['age'] = age
+        compact_depositor.add_document(age_header, [{'_AGE': age, '_NO': i, 'id': i, 'city': str(age),
+                                                     '_OP': 'U' if age > 2 else ''} for i in range(10)])
+    merge_table_documents(compact_depositor)
+    doc_list = list(compact_depositor.get_stream_by_sort_key(status_list=['initial', 'merged']))
+    assert len(doc_list) < 38
+    for doc in doc_list:
+        doc_data = compact_depositor.get_data_from_header(compact_depositor.get_header_from_ref(doc))
+        assert sorted(line['id'] for line in doc_data) == list(range(10))
+    rmtree(os.path.join(depositor.deposit_path, 'test-007'))
+
+def test_add_encoded_document(depositor):
+    encoded_depositor = FileDepositor(deposit_path=depositor.deposit_path)
+    data_body = get_person_body()
+    encoded_depositor.add_document({'topic_id': 'test-008', 'table_id': 'encoded_data', 'aged': 'True', 'age': '1',
+                                    'start_seq': '20201113222500000000'}, [])
+    age_header = {'topic_id': 'test-008', 'table_id': 'encoded_data', 'start_seq': '20201113222500000000',
+                  'age': 2, 'end_age': 3}
+    age_data = [dict(line, _AGE=2, _NO=i) for i, line in enumerate(data_body[:100])]
+    encoded_data = gzip.compress(json.dumps(age_data).encode())
+    doc_header = encoded_depositor.add_encoded_document(age_header, encoded_data)[0]
+    assert doc_header['data_size'] == len(base64.b64encode(encoded_data))
+    assert encoded_depositor.get_data_from_header(doc_header) == age_data
+    expected_header = encoded_depositor.add_document(age_header, age_data)[0]
+    for key in ['merge_status', 'line_nb', 'merge_level']:
+        assert doc_header[key] == expected_header[key]
+    assert doc_header['merge_key'] == '20201113222500000003'
+    # Lines not aligned with the header
+    mixed_data = gzip.compress(json.dumps([dict(line, _AGE=6 + i % 2) for i, line in enumerate(age_data)]).encode())
+    doc_header = encoded_depositor.add_encoded_document(dict(age_header, age=6, end_age=7), mixed_data)[0]
+    assert all(line['_AGE'] == 6 for line in encoded_depositor.get_data_from_header(doc_header))
+    # Values looking like the line keys
+    nested_data = [dict(line, _AGE=8, detail={'_AGE': 8, '_SEQ': '20201113222500000001'}) for line in age_data]
+    doc_header = encoded_depositor.add_encoded_document(dict(age_header, age=8, end_age=8),
+                                                        gzip.compress(json.dumps(nested_data).encode()))[0]
+    assert doc_header['line_nb'] == 100
+    normal_header = {'topic_id': 'test-008', 'table_id': 'normal_data', 'start_seq': '20201113222500000000'}
+    normal_data = [dict(line, _SEQ=str(20201113222500000000 + i), _NO=0) for i, line in enumerate(data_body[:100])]
+    encoded_depositor.add_document(dict(normal_header, age=1), [])
+    doc_header = encoded_depositor.add_encoded_document(normal_header,
+                                                        gzip.compress(json.dumps(normal_data).encode()))[0]
+    assert doc_header['merge_key'] == '20201113222500000099'
+    assert doc_header['line_nb'] == 100
+    # Flat lines are scanned, other lines are decoded
+    flat_data = [{'id': i, 'name': 'name ' + str(i), '_SEQ': str(20201113222500000000 + i)} for i in range(10)]
+    assert FileDepositor._scan_line_keys(json.dumps(flat_data).encode(), '_SEQ') == [l['_SEQ'] for l in flat_data]
+    assert FileDepositor._scan_line_keys(json.dumps(flat_data).encode(), '_AGE') is None
+    assert FileDepositor._scan_line_keys(json.dumps(normal_data).encode(), '_SEQ') is None
+    for name in ['a", "_SEQ": "1', 'a}, {b']:
+        string_data = [dict(line, name=name) for line in flat_data]
+        assert FileDepositor._scan_line_keys(json.dumps(string_data).encode(), '_SEQ') is None
+    # Documents bigger than half of the size limit are chunked again
+    encoded_depositor.size_limit = 4096
+    large_data = [dict(line, _AGE=10) for line in data_body[:1000]]
+    doc_list = encoded_depositor.add_encoded_document(dict(age_header, age=10, end_age=99),
+                                                      gzip.compress(json.dumps(large_data).encode()))
+    assert len(doc_list) > 1
+    assert all(doc['data_size'] < encoded_depositor.size_limit for doc in doc_list)
+    assert sum(doc['line_nb'] for doc in doc_list) == 1000
+    rmtree(os.path.join(depositor.deposit_path, 'test-008'))
+
+def test_bucket_layout(depositor):
+    data_body = get_person_body()
+    depositors = {'flat_data': get_depositor_factory(depositor.deposit_path)(),
+                  'bucket_data': get_depositor_factory(depositor.deposit_path, bucket_prefix=18, split_body=True)()}
+    for table_id, table_depositor in depositors.items():
+        add_table_documents(table_depositor, 'test-009', table_id, data_body)
+        merge_table_documents(table_depositor, 3)
+    flat_depositor, bucket_depositor = depositors['flat_data'], depositors['bucket_data']
+    assert sorted(os.listdir(bucket_depositor.table_path)) == sorted(
+        ['20201113222500000000.body', '20201113222500000000.header', '202011132225000000', '202011132225000001',
+         '202011132225000002', '202011132225000003', '202011132225000004', '202011132225000005',
+         '202011132225000006', '202011132225000007', '202011132225000008', '202011132225000009',
+         '202011132225000010'])
+    sort_key = '20201113222500000502'
+    for kwargs in [{}, {'reverse': True}, {'le_ge_key': sort_key}, {'le_ge_key': sort_key, 'equal': False},
+                   {'le_ge_key': sort_key, 'reverse': True}, {'le_ge_key': sort_key, 'min_merge_level': 2},
+                   {'status_list': ['header']}]:
+        assert list(bucket_depositor.get_stream_by_sort_key(**kwargs)) == \
+            list(flat_depositor.get_stream_by_sort_key(**kwargs))
+    assert [line['id'] for line in bucket_depositor.iter_data(200, 600)] == \
+        [line['id'] for line in flat_depositor.iter_data(200, 600)]
+    merge_key = bucket_depositor.get_header_from_ref(list(bucket_depositor.get_stream_by_sort_key())[-1])['merge_key']
+    assert bucket_depositor.get_ref_by_merge_key(merge_key) == flat_depositor.get_ref_by_merge_key(merge_key)
+    # Only the reached buckets are loaded
+    new_depositor = FileDepositor(deposit_path=depositor.deposit_path, bucket_prefix=18)
+    new_depositor.set_current_topic_table('test-009', 'bucket_data')
+    next(new_depositor.get_stream_by_sort_key(le_ge_key=sort_key, status_list=['initial', 'merged']))
+    assert len(new_depositor._table_indexes) == 2
+    new_depositor = FileDepositor(deposit_path=depositor.deposit_path, bucket_prefix=18)
+    new_depositor.set_current_topic_table('test-009', 'bucket_data')
+    assert new_depositor.get_ref_by_merge_key(merge_key) == flat_depositor.get_ref_by_merge_key(merge_key)
+    assert not new_depositor.get_ref_by_merge_key('20201113222500099999')
+    assert len(new_depositor._table_indexes) == 2
+    rmtree(os.path.join(depositor.deposit_path, 'test-009'))
+
+def test_metrics(depositor):
+    callback_values = dict()
+
+    def metrics_callback(name, value):
+        callback_values[name] = callback_values.get(name, 0) + value
+
+    metric_depositor = FileDepositor(deposit_path=depositor.deposit_path, metrics_callback=metrics_callback)
+    metric_depositor.size_limit = 4096
+    data_body = get_person_body()
+    metric_depositor.add_document({'topic_id': 'test-010', 'table_id': 'metric_data', 'aged': 'True', 'age': '1',
+                                   'start_seq': '20201113222500000000'}, [])
+    metric_depositor.add_document({'topic_id': 'test-010', 'table_id': 'metric_data', 'age': 2, 'end_age': 1000,
+                                   'start_seq': '20201113222500000000'},
+                                  [dict(line, _AGE=2, _NO=line['id']) for line in data_body])
+    metrics = metric_depositor.get_metrics()
+    assert metrics['add_document_count'] == 2
+    assert metrics['serialize_bytes'] > metrics['compress_bytes'] > 0
+    assert metrics['compress_time'] > 0 and metrics['serialize_time'] > 0
+    assert metrics['store_count'] == len(os.listdir(metric_depositor.table_path))
+    for doc in metric_depositor.get_stream_by_sort_key(status_list=['initial'], min_merge_level=1):
+        metric_depositor.merge_documents(metric_depositor.get_header_from_ref(doc)['merge_key'], 1)
+    metrics = metric_depositor.get_metrics()
+    assert metrics['merge_count_level_1'] > 0 and metrics['merge_time_level_1'] > 0
+    assert metrics['merge_tasks'] > 0 and metrics['merge_task_bytes'] > 0
+    assert metrics['documents_scanned'] > 0 and metrics['headers_read'] > 0
+    assert callback_values == metrics
+    metric_depositor.reset_metrics()
+    assert metric_depositor.get_metrics() == {}
+    assert FileDepositor(deposit_path=depositor.deposit_path).get_metrics() == {}
+    rmtree(os.path.join(depositor.deposit_path, 'test-010'))
+
+def test_table_index(depositor):
+    depositor.set_current_topic_table('test', 'normal_data')
+    file_list = sorted(f for f in os.listdir(depositor.table_path) if not f.endswith('.header'))
+    assert [f for f in depositor._get_table_index()['names'] if not f.endswith('.header')] == file_list
+    copy2(os.path.join(depositor.table_path, file_list[0]),
+          os.path.join(depositor.table_path, '20201113222400000000-20201113222400000000.initial'))
+    assert '20201113222400000000-20201113222400000000.initial' in depositor._get_table_index()['names']
+    assert depositor.get_ref_by_merge_key('20201113222400000000') == '20201113222400000000-20201113222400000000.initial'
+    depositor.delete_documents(['20201113222400000000-20201113222400000000'])
+    assert not depositor.get_ref_by_merge_key('20201113222400000000')
+    assert [f for f in depositor._get_table_index()['names'] if not f.endswith('.header')] == file_list
+
+def test_table_index_concurrent_writers(depositor):
+    writers = [FileDepositor(deposit_path=depositor.deposit_path) for _ in range(2)]
+
+    def add_documents(writer_nb):
+        for i in range(300):
+            start_seq = str(20201113222500000000 + i * 2 + writer_nb)
+            normal_header = {'topic_id': 'test-002', 'table_id': 'concurrent', 'start_seq': start_seq}
+            writers[writer_nb].add_document(normal_header, [{'_SEQ': start_seq, '_NO': 0, 'id': i}])
+
+    for writer in writers:
+        writer.mtime_resolution = 10 ** 8
+    threads = [threading.Thread(target=add_documents, args=(writer_nb, )) for writer_nb in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    file_list = sorted(os.listdir(os.path.join(depositor.deposit_path, 'test-002', 'concurrent')))
+    assert len(file_list) == 600
+    # A change made at the same time as an own write is found by the check after the modification time resolution
+    time.sleep(0.2)
+    for writer in writers:
+        assert writer._get_table_index()['names'] == file_list
+    rmtree(os.path.join(depositor.deposit_path, 'test-002'))
+
+def test_table_index_own_writes(depositor):
+    listdir_calls = list()
+    listdir = os.listdir
+
+    def counted_listdir(path):
+        listdir_calls.append(path)
+        return listdir(path)
+
+    data_body = get_person_body()
+    for bucket_prefix in [0, 18]:
+        table_depositor = FileDepositor(deposit_path=depositor.deposit_path, bucket_prefix=bucket_prefix)
+        table_depositor.mtime_resolution = 60 * 10 ** 9
+        os.listdir = counted_listdir
+        try:
+            add_table_documents(table_depositor, 'test-002', 'own_writes_' + str(bucket_prefix), data_body)
+            merge_table_documents(table_depositor)
+            assert get_table_ids(table_depositor) == sorted(line['id'] for line in data_body)
+        finally:
+            os.listdir = listdir
+        # Each directory is only listed once, writes of the depositor itself never lead to a new listing
+        assert len(listdir_calls) == len(set(listdir_calls))
+        listdir_calls.clear()
+    rmtree(os.path.join(depositor.deposit_path, 'test-002'))
+
 def test_document_search(depositor):
     depositor.set_current_topic_table('test', 'aged_data')
     for doc in depositor.get_stream_by_sort_key():
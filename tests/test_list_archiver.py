@@ -2,9 +2,12 @@ import os
 import time
 import datetime
 import json
+import random
 import pytest
 from xialib import IoListArchiver
+from xialib.archiver import _LazyColumn
 from xialib import BasicStorer
+from xialib import BasicFlower
 
 def get_current_timestamp():
     return datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')
@@ -82,6 +85,165 @@ def test_scenraio(archiver: IoListArchiver):
 
     archiver.remove_archives([merge_key_1, merge_key_2, merge_key_3])
 
+def test_typed_workspace(archiver: IoListArchiver):
+    typed_archiver = IoListArchiver(archive_path=archiver.archive_path, fs=BasicStorer(), typed_workspace=True)
+    typed_archiver.set_current_topic_table('test-001', 'person_complex')
+    archiver.set_merge_key(merge_key_1)
+    typed_archiver.set_merge_key(merge_key_1)
+    for x in range(2, 5):
+        src_file = str(x).zfill(6) + '.json'
+        with open(os.path.join('.', 'input', 'person_complex', src_file), 'rb') as f:
+            data = json.loads(f.read().decode())
+            archiver.add_data(data)
+            typed_archiver.add_data(data)
+    assert typed_archiver.get_data() == archiver.get_data()
+    assert typed_archiver.workspace[0]['id'].value_type == int
+    assert typed_archiver.workspace[0]['first_name'].value_type == str
+    assert isinstance(typed_archiver.workspace[0]['children'], list)
+    for field_name in archiver.get_field_list():
+        typed_desc = typed_archiver.describe_single_field(field_name)
+        desc = archiver.describe_single_field(field_name)
+        typed_desc.pop('samples', None), desc.pop('samples', None)
+        assert typed_desc == desc
+    typed_archiver.archive_data()
+    typed_archiver.remove_data()
+    archiver.remove_data()
+    typed_archiver.load_archive(merge_key_1, fields=field_list_01)
+    typed_archiver.append_archive(merge_key_1, fields=field_list_01)
+    records = typed_archiver.get_data()
+    assert len(records) == 6000 and records[:3000] == records[3000:]
+    assert typed_archiver.workspace[0]['height'][-1] == records[-1].get('height', None)
+    typed_archiver.remove_data()
+    typed_archiver.remove_archives([merge_key_1])
+
+def test_typed_column():
+    archiver = IoListArchiver(archive_path=os.path.join('.', 'input', 'module_specific', 'archiver'),
+                              fs=BasicStorer(), typed_workspace=True)
+    column = archiver._get_column(['a', None, 'b', 'a', None, None, 'c', 'a', 'b', None])
+    assert list(column) == ['a', None, 'b', 'a', None, None, 'c', 'a', 'b', None]
+    assert column[-1] is None and column[1:4] == [None, 'b', 'a']
+    assert column.get_value_counter() == {'a': 3, 'b': 2, 'c': 1, None: 4}
+    column.extend(archiver._get_column([None, 'd', 'a']))
+    assert list(column)[9:] == [None, None, 'd', 'a'] and len(column.dictionary) == 4
+    assert archiver._get_column([1, 2.0]) == [1, 2.0]
+    assert archiver._get_column([True, False]) == [True, False]
+    assert archiver._get_column([2 ** 64, 1]) == [2 ** 64, 1]
+    with pytest.raises(IndexError):
+        column[20]
+
+def test_lazy_load(archiver: IoListArchiver):
+    archiver.set_merge_key(merge_key_1)
+    with open(os.path.join('.', 'input', 'person_complex', '000002.json'), 'rb') as f:
+        data = json.loads(f.read().decode())
+        archiver.add_data(data)
+    archiver.archive_data()
+    archiver.remove_data()
+    archiver.load_archive(merge_key_1)
+    assert len(archiver.get_field_list()) == 12
+    assert all(isinstance(column, _LazyColumn) for column in archiver.workspace[1].values())
+    archiver.append_archive(merge_key_1)
+    assert len(archiver.describe_single_field('id')['value']) > 0
+    assert not isinstance(archiver.workspace[0]['id'], _LazyColumn)
+    assert isinstance(archiver.workspace[0]['email'], _LazyColumn)
+    records = archiver.get_data()
+    assert len(records) == 2000 and [line['id'] for line in records[:1000]] == [line['id'] for line in data]
+    assert records[0]['email'] == data[0]['email'] == records[1000]['email']
+    archiver.remove_data()
+    archiver.remove_archives([merge_key_1])
+
+def test_load_with_filters(archiver: IoListArchiver):
+    archiver.set_merge_key(merge_key_1)
+    with open(os.path.join('.', 'input', 'person_complex', '000002.json'), 'rb') as f:
+        data = json.loads(f.read().decode())
+        archiver.add_data(data)
+    archiver.archive_data()
+    archiver.remove_data()
+    archive_stats = archiver._get_archive_stats(merge_key_1)
+    assert archive_stats['id']['min_value'] == min(line['id'] for line in data)
+    assert archive_stats['id']['max_value'] == max(line['id'] for line in data)
+    assert 'min_value' not in archive_stats['children']
+    filters = [[['gender', '=', 'Female'], ['height', '>=', 180]], [['city', '=', 'Paris']]]
+    assert archiver.load_archive(merge_key_1, fields=['id', 'first_name'], filters=filters)
+    expected = [{key: value for key, value in line.items() if key in ['id', 'first_name']}
+                for line in BasicFlower.filter_table_dnf(data, filters)]
+    assert expected and archiver.get_data() == expected
+    assert sorted(archiver.get_field_list()) == ['first_name', 'id']
+    assert archiver.load_archive(merge_key_1, filters=[[['height', '<', 1000]]])
+    assert len(archiver.get_data()) == len([line for line in data if line.get('height', None) is not None])
+    assert not archiver.load_archive(merge_key_1, filters=[[['id', '>', archive_stats['id']['max_value']]]])
+    assert archiver.get_data() == []
+    assert not archiver.load_archive(merge_key_1, filters=[[['dummy', '=', 1]], [['gender', '=', 'Dummy']]])
+    assert not archiver.load_archive(merge_key_1, filters=[[['gender', '<', 'A']]])
+    with pytest.raises(ValueError):
+        archiver.load_archive(merge_key_1, filters=[[['gender', 'like', 'F']]])
+    archiver.remove_data()
+    archiver.remove_archives([merge_key_1])
+    assert archiver._get_archive_stats(merge_key_1) is None
+
+def test_load_with_filters_no_stats(archiver: IoListArchiver):
+    archiver.set_merge_key(merge_key_1)
+    with open(os.path.join('.', 'input', 'person_complex', '000002.json'), 'rb') as f:
+        data = json.loads(f.read().decode())
+        archiver.add_data(data)
+    archiver.archive_data()
+    archiver.remove_data()
+    os.remove(os.path.join(archiver.table_path, archiver._get_stats_filename(merge_key_1)))
+    assert archiver._get_archive_stats(merge_key_1) is None
+    # Without statistics, a condition on a missing field matches nothing, same as the statistics check
+    assert archiver.load_archive(merge_key_1, filters=[[['dummy', '=', 1]]])
+    assert archiver.get_data() == []
+    assert archiver.load_archive(merge_key_1, fields=['id'], filters=[[['dummy', '!=', 1]]])
+    assert archiver.get_data() == []
+    filters = [[['dummy', '!=', 1], ['city', '=', 'Paris']], [['gender', '=', 'Female']]]
+    assert archiver.load_archive(merge_key_1, filters=filters)
+    assert archiver.get_data() == [line for line in data if line.get('gender', None) == 'Female']
+    # Without filter field in the archive, no column is decoded to filter the lines
+    read_column, read_items = archiver._read_column, list()
+    archiver._read_column = lambda archive_file, item: read_items.append(item) or read_column(archive_file, item)
+    assert archiver.load_archive(merge_key_1, fields=['id'], filters=[[['dummy', '!=', 1]]])
+    assert archiver.workspace[0] == {'id': []} and not read_items
+    assert archiver.load_archive(merge_key_1, fields=['id'], filters=[[]])
+    assert isinstance(archiver.workspace[0]['id'], _LazyColumn) and not read_items
+    assert archiver.get_data() == [{'id': line['id']} for line in data]
+    del archiver._read_column
+    archiver.remove_data()
+    archiver.remove_archives([merge_key_1])
+
+def test_describe_large_field(archiver: IoListArchiver):
+    random.seed(0)
+    archiver.set_merge_key(merge_key_1)
+    archiver.add_data([{'number': random.randint(0, 10 ** 6), 'text': chr(0x4E00 + random.randint(0, 99)) + str(i),
+                        'code': 'C' + str(i % 50).zfill(4) + str(i)} for i in range(100000)])
+    number_desc = archiver.describe_single_field('number')
+    assert number_desc['type'] == 'number' and number_desc['total_nb'] == 100000
+    assert 0.9 * 95000 < number_desc['distinct_nb'] < 1.1 * 95000
+    text_desc = archiver.describe_single_field('text')
+    assert text_desc['type'] == 'c_1' and len(text_desc['value']) == 100
+    code_desc = archiver.describe_single_field('code')
+    assert code_desc['type'] == 'c_5' and len(code_desc['value']) == 50
+    assert code_desc['min_value'] == 'C00000' and code_desc['max_value'] == 'C004999999'
+    archiver.remove_data()
+
+def test_describe_relations(archiver: IoListArchiver):
+    archiver.set_merge_key(merge_key_1)
+    with open(os.path.join('.', 'input', 'person_complex', '000002.json'), 'rb') as f:
+        data = json.loads(f.read().decode())
+        archiver.add_data(data)
+    field_descs = {field_name: archiver.describe_single_field(field_name)
+                   for field_name in sorted(archiver.get_field_list())}
+    relation = archiver.describe_relation('gender', field_descs['gender'], 'height', field_descs['height'], 3)
+    assert len(relation) == 2 * 3
+    for (rank1, rank2), ratio in relation.items():
+        gender, height = field_descs['gender']['value'][rank1], field_descs['height']['value'][rank2]
+        assert ratio == len([line for line in data
+                             if line.get('gender', None) == gender and line.get('height', None) == height]) / len(data)
+    relations = archiver.describe_relations(field_descs, 3)
+    assert not [key for key in relations if 'children' in key]
+    assert relations[('gender', 'height')] == relation
+    assert relations[('email', 'first_name')] == archiver.describe_relation('email', field_descs['email'], 'first_name',
+                                                                           field_descs['first_name'], 3)
+    archiver.remove_data()
+
 def test_archive_zero_data(archiver: IoListArchiver):
     archiver.set_merge_key(merge_key_4)
     archiver.add_data([])
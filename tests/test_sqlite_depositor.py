@@ -0,0 +1,101 @@
+import os
+import json
+import sqlite3
+import pytest
+from xialib import SQLiteDepositor
+from xialib import Depositor
+
+
+@pytest.fixture(scope='module')
+def depositor():
+    conn = sqlite3.connect(':memory:')
+    depositor = SQLiteDepositor(db=conn)
+    depositor.size_limit = 4096
+    yield depositor
+    conn.close()
+
+def get_person_data():
+    with open(os.path.join('.', 'input', 'person_complex', 'schema.json'), 'rb') as f:
+        data_header = json.loads(f.read().decode())
+        field_data = data_header.pop('columns')
+    with open(os.path.join('.', 'input', 'person_complex', '000002.json'), 'rb') as f:
+        data_body = json.loads(f.read().decode())
+    return data_header, field_data, data_body
+
+def test_aged_document(depositor):
+    data_header, field_data, data_body = get_person_data()
+    depositor.add_document({'topic_id': 'test', 'table_id': 'aged_data', 'aged': 'True', 'age': '1',
+                            'start_seq': '20201113222500000000', 'meta-data': data_header}, field_data)
+    age_header = {'topic_id': 'test', 'table_id': 'aged_data', 'start_seq': '20201113222500000000'}
+    for i in range(0, len(data_body), 50):
+        age_header['age'], age_header['end_age'] = i + 2, i + 51
+        depositor.add_document(age_header, [dict(line, _AGE=i + 2, _NO=line['id']) for line in data_body[i: i + 50]])
+    assert depositor.get_table_header() == '20201113222500000000'
+    header_dict = depositor.get_header_from_ref(depositor.get_table_header())
+    assert len(depositor.get_data_from_header(header_dict)) == len(field_data)
+    for mlvl in range(1, 8):
+        for doc in depositor.get_stream_by_sort_key(status_list=['initial', 'merged'], min_merge_level=mlvl):
+            depositor.merge_documents(depositor.get_header_from_ref(doc)['merge_key'], mlvl)
+    doc_list = list(depositor.get_stream_by_sort_key(status_list=['initial', 'merged']))
+    assert list(depositor.get_stream_by_sort_key(status_list=['merged']))
+    id_list = list()
+    for doc in doc_list:
+        id_list.extend([line['id'] for line in depositor.get_data_from_header(depositor.get_header_from_ref(doc))])
+    assert sorted(id_list) == sorted(line['id'] for line in data_body)
+    header_dict = depositor.get_header_from_ref(depositor.get_table_header())
+    assert header_dict['merged_lines'] > 0
+
+def test_normal_document(depositor):
+    data_header, field_data, data_body = get_person_data()
+    normal_header = {'topic_id': 'test', 'table_id': 'normal_data', 'start_seq': '20201113222500000000'}
+    depositor.add_document(dict(normal_header, age='1', **{'meta-data': data_header}), field_data)
+    for i in range(0, len(data_body), 50):
+        normal_header['start_seq'] = str(20201113222500000000 + i)
+        depositor.add_document(normal_header, [dict(line, _SEQ=normal_header['start_seq'], _NO=line['id'])
+                                               for line in data_body[i: i + 50]])
+    for mlvl in range(1, 8):
+        for doc in depositor.get_stream_by_sort_key(status_list=['initial', 'merged'], min_merge_level=mlvl):
+            depositor.merge_documents(depositor.get_header_from_ref(doc)['merge_key'], mlvl)
+    id_list = list()
+    for doc in depositor.get_stream_by_sort_key(status_list=['initial', 'merged']):
+        id_list.extend([line['id'] for line in depositor.get_data_from_header(depositor.get_header_from_ref(doc))])
+    assert sorted(id_list) == sorted(line['id'] for line in data_body)
+
+def test_stream_by_sort_key(depositor):
+    depositor.set_current_topic_table('test', 'aged_data')
+    doc_list = list(depositor.get_stream_by_sort_key())
+    assert doc_list[0] == depositor.get_table_header()
+    assert list(depositor.get_stream_by_sort_key(reverse=True)) == doc_list[::-1]
+    sort_key = depositor.get_header_from_ref(doc_list[2])['sort_key']
+    assert list(depositor.get_stream_by_sort_key(le_ge_key=sort_key)) == doc_list[2:]
+    assert list(depositor.get_stream_by_sort_key(le_ge_key=sort_key, equal=False)) == doc_list[3:]
+    assert list(depositor.get_stream_by_sort_key(le_ge_key=sort_key, reverse=True)) == doc_list[2::-1]
+    for doc in depositor.get_stream_by_sort_key(min_merge_level=3):
+        header_dict = depositor.get_header_from_ref(doc)
+        assert header_dict['merge_status'] == 'header' or header_dict['merge_level'] >= 3
+    merge_key = depositor.get_header_from_ref(doc_list[-1])['merge_key']
+    assert depositor.get_ref_by_merge_key(merge_key) == doc_list[-1]
+
+def test_update_and_delete(depositor):
+    depositor.set_current_topic_table('test', 'aged_data')
+    doc_ref = list(depositor.get_stream_by_sort_key(status_list=['initial', 'merged']))[-1]
+    depositor.update_document(doc_ref, {'merge_status': 'packaged', 'merged_level': Depositor.DELETE})
+    header_dict = depositor.get_header_from_ref(doc_ref)
+    assert header_dict['merge_status'] == 'packaged' and 'merged_level' not in header_dict
+    assert doc_ref in depositor.get_stream_by_sort_key(status_list=['packaged'])
+    depositor.delete_documents([doc_ref])
+    assert doc_ref not in depositor.get_stream_by_sort_key()
+    assert depositor.get_header_from_ref(doc_ref) == {}
+
+def test_transaction(depositor):
+    depositor.set_current_topic_table('test', 'aged_data')
+    doc_list = list(depositor.get_stream_by_sort_key())
+    with pytest.raises(ValueError):
+        with depositor._transaction():
+            depositor.delete_documents(doc_list)
+            raise ValueError
+    assert list(depositor.get_stream_by_sort_key()) == doc_list
+
+def test_exceptions():
+    with pytest.raises(TypeError):
+        SQLiteDepositor(db=object())
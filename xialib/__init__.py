@@ -12,7 +12,7 @@ from xialib import translators
 from xialib.adaptors import SQLiteAdaptor, JsonAdaptor
 from xialib.archivers import IoListArchiver
 from xialib.decoders import BasicDecoder, ZipDecoder
-from xialib.depositors import FileDepositor
+from xialib.depositors import FileDepositor, SQLiteDepositor
 from xialib.formatters import BasicFormatter, CSVFormatter, ZstFormatter
 from xialib.flowers import BasicFlower, SegmentFlower
 from xialib.publishers import BasicPublisher
@@ -23,7 +23,7 @@ from xialib.translators import BasicTranslator, SapTranslator
 from xialib.adaptor import Adaptor, DbapiAdaptor, DbapiQmarkAdaptor
 from xialib.archiver import Archiver, ListArchiver
 from xialib.decoder import Decoder
-from xialib.depositor import Depositor
+from xialib.depositor import Depositor, MergeScheduler, AsyncDepositor
 from xialib.flower import Flower
 from xialib.formatter import Formatter
 from xialib.publisher import Publisher
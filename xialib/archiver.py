@@ -1,16 +1,298 @@
 import abc
 import json
+import heapq
+import operator
+import array
 import logging
 import itertools
 import random
 import struct
-from typing import List, Dict, Union
+from typing import List, Dict, Union, Iterable, Callable
 from functools import reduce, partial
 from collections import Counter
 
 __all__ = ['Archiver']
 
 
+def xia_eq(a, b):
+    return a is not None and a == b
+
+def xia_ge(a, b):
+    return a is not None and a >= b
+
+def xia_gt(a, b):
+    return a is not None and a > b
+
+def xia_le(a, b):
+    return a is not None and a <= b
+
+def xia_lt(a, b):
+    return a is not None and a < b
+
+def xia_ne(a, b):
+    return a is not None and a != b
+
+
+class _TypedColumn(object):
+    """Typed column of list workspace
+
+    int and float values are saved in a contiguous ``array.array``, str values are dictionary encoded
+    (the array saves the position of value in ``dictionary``). None values are saved in the null bitmap.
+    The column behaves as a read-only list.
+    """
+    typecodes = {int: 'q', float: 'd', str: 'I'}
+
+    def __init__(self, value_type: type):
+        self.value_type = value_type
+        self.values = array.array(self.typecodes[value_type])
+        self.nulls = bytearray()
+        self.null_nb = 0
+        self.length = 0
+        self.dictionary = list()
+        self._codes = dict()
+
+    @classmethod
+    def from_list(cls, values: list) -> Union['_TypedColumn', list]:
+        """Get a typed column, the list itself is returned if the values are not of a single supported type"""
+        value_types = set(type(value) for value in values)
+        value_types.discard(type(None))
+        if len(value_types) != 1 or next(iter(value_types)) not in cls.typecodes:
+            return values
+        column = cls(value_types.pop())
+        try:
+            column.extend(values)
+        except OverflowError:
+            return values
+        return column
+
+    def _get_code(self, value: str) -> int:
+        code = self._codes.get(value, None)
+        if code is None:
+            code = self._codes[value] = len(self.dictionary)
+            self.dictionary.append(value)
+        return code
+
+    def _set_nulls(self, positions: Iterable[int]):
+        for pos in positions:
+            self.nulls[pos >> 3] |= 1 << (pos & 7)
+            self.null_nb += 1
+
+    def extend(self, values: Union['_TypedColumn', list]):
+        start, new_length = self.length, self.length + len(values)
+        if isinstance(values, _TypedColumn):
+            if values.value_type is str:
+                code_map = [self._get_code(value) for value in values.dictionary]
+                self.values.extend(code_map[code] for code in values.values)
+            else:
+                self.values.extend(values.values)
+            null_positions = [pos for pos in range(values.length) if values.is_null(pos)] if values.null_nb else []
+        else:
+            null_positions = [pos for pos, value in enumerate(values) if value is None]
+            if self.value_type is str:
+                self.values.extend(0 if value is None else self._get_code(value) for value in values)
+            else:
+                self.values.extend(0 if value is None else value for value in values)
+        self.nulls.extend(bytes((new_length + 7) // 8 - len(self.nulls)))
+        self._set_nulls(start + pos for pos in null_positions)
+        # Null slots always hold 0 so the null values could be removed from the value count
+        for pos in null_positions:
+            self.values[start + pos] = 0
+        self.length = new_length
+
+    def is_null(self, pos: int) -> bool:
+        return bool(self.nulls[pos >> 3] >> (pos & 7) & 1)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.length)
+            if step != 1:
+                return [self[pos] for pos in range(start, stop, step)]
+            if self.null_nb:
+                return list(itertools.islice(iter(self), start, stop))
+            if self.value_type is str:
+                return list(map(self.dictionary.__getitem__, self.values[start:stop]))
+            return self.values[start:stop].tolist()
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("column index out of range")
+        if self.null_nb and self.is_null(index):
+            return None
+        return self.dictionary[self.values[index]] if self.value_type is str else self.values[index]
+
+    def __iter__(self):
+        values = map(self.dictionary.__getitem__, self.values) if self.value_type is str else iter(self.values)
+        if not self.null_nb:
+            return values
+        return (None if self.nulls[pos >> 3] >> (pos & 7) & 1 else value for pos, value in enumerate(values))
+
+    def tolist(self) -> list:
+        return list(self)
+
+    def get_value_counter(self) -> Counter:
+        """Values are counted on the contiguous buffer, null slots are removed from the count"""
+        counter = Counter(self.values)
+        if self.null_nb:
+            counter[0] -= self.null_nb
+            if counter[0] == 0:
+                counter.pop(0)
+            counter[None] = self.null_nb
+        if self.value_type is str:
+            return Counter({self.dictionary[k] if k is not None else None: v for k, v in counter.items()})
+        return counter
+
+
+class _DistinctSketch(object):
+    """Distinct count estimation by K minimum values, values are counted exactly while the cardinality is small"""
+    k = 1024
+
+    def __init__(self):
+        self.exact_set = set()
+        self.min_hashes = None
+
+    def update(self, values: Iterable):
+        if self.min_hashes is None:
+            self.exact_set.update(values)
+            if len(self.exact_set) <= self.k:
+                return
+            values, self.exact_set, self.min_hashes = self.exact_set, None, list()
+        # Hash of tuple mixes the hash of value, so the hash of small integers is also well distributed
+        self.min_hashes = heapq.nsmallest(self.k, set(self.min_hashes).union(map(hash, zip(values))))
+
+    def count(self) -> int:
+        if self.min_hashes is None:
+            return len(self.exact_set)
+        # Hash values are uniformly distributed in [-2 ** 63, 2 ** 63)
+        kth_ratio = (self.min_hashes[-1] + 2 ** 63) / 2 ** 64
+        return int(round((self.k - 1) / kth_ratio))
+
+
+class _FieldProfiler(object):
+    """Single pass field profiler with bounded memory
+
+    * Values are added by block and counted by ``Counter``, so most of the work is done in C
+    * Value / number / prefix counters are exact and dropped once they have more than ``max_value_nb`` entries
+      (the descriptor only gives value lists of at most ``max_value_nb`` entries)
+    * Prefix counters of length n + 1 have at least as many entries as length n, so only the lengths before the
+      first dropped one are still counted
+    * Distinct number is estimated by a K minimum values sketch
+    """
+    max_value_nb = 88
+    max_prefix = 21
+    block_size = 2 ** 16
+    value_types = {type(None), str, int, float}
+
+    def __init__(self, map_number):
+        self.map_number = map_number
+        self.total_nb, self.none_nb = 0, 0
+        self.field_types = set()
+        self.min_value, self.max_value = None, None
+        self.distinct = _DistinctSketch()
+        self.value_counter = Counter()
+        self.number_counter = Counter()
+        self.prefix_counters = [Counter() for i in range(self.max_prefix)]
+        self.prefix_limit = self.max_prefix
+        self.prefix_overflow = None
+
+    def _add_counter(self, counter: Counter) -> bool:
+        field_types = set(map(type, counter))
+        if not field_types <= self.value_types:
+            return False
+        self.total_nb += sum(counter.values())
+        self.none_nb += counter.pop(None, 0)
+        field_types.discard(type(None))
+        self.field_types |= field_types
+        if not counter:
+            return True
+        block_min, block_max = min(counter), max(counter)
+        if self.min_value is None or block_min < self.min_value:
+            self.min_value = block_min
+        if self.max_value is None or block_max > self.max_value:
+            self.max_value = block_max
+        self.distinct.update(counter)
+        if self.value_counter is not None:
+            self.value_counter.update(counter)
+            if len(self.value_counter) > self.max_value_nb:
+                self.value_counter = None
+        return True
+
+    def _check_prefix(self, level: int) -> bool:
+        """Check if the prefix counter of level is oversized, the higher levels are removed if it is the case"""
+        if len(self.prefix_counters[level - 1]) <= self.max_value_nb or self.prefix_overflow == level:
+            return False
+        self.prefix_overflow = level
+        # The first level is kept because it is the result when it is already oversized
+        self.prefix_limit = max(level - 1, 1)
+        for i in range(self.prefix_limit, self.max_prefix):
+            self.prefix_counters[i] = None
+        return True
+
+    def _check_number(self):
+        if self.number_counter is not None and len(self.number_counter) > self.max_value_nb:
+            self.number_counter = None
+
+    def add_values(self, values: list) -> bool:
+        """Add a block of values, returns False if a value type is not supported"""
+        if not set(map(type, values)) <= self.value_types:
+            return False
+        self._add_counter(Counter(values))
+        not_null_values = [value for value in values if value is not None] if self.none_nb else values
+        if self.field_types == {str}:
+            for level in range(1, self.prefix_limit + 1):
+                self.prefix_counters[level - 1].update(map(operator.itemgetter(slice(level)), not_null_values))
+                if self._check_prefix(level):
+                    break
+        elif self.field_types in ({int}, {float}) and self.number_counter is not None:
+            self.number_counter.update(map(self.map_number, not_null_values))
+            self._check_number()
+        return True
+
+    def add_counter(self, counter: Counter) -> bool:
+        """Add values with their occurrence numbers, returns False if a value type is not supported"""
+        counter = Counter(counter)
+        if not self._add_counter(counter):
+            return False
+        if self.field_types == {str}:
+            for level in range(1, self.prefix_limit + 1):
+                prefix_counter = self.prefix_counters[level - 1]
+                for value, weight in counter.items():
+                    prefix_counter[value[:level]] += weight
+                if self._check_prefix(level):
+                    break
+        elif self.field_types in ({int}, {float}) and self.number_counter is not None:
+            for value, weight in counter.items():
+                self.number_counter[self.map_number(value)] += weight
+            self._check_number()
+        return True
+
+    def _set_values(self, descriptor: dict, field_type: str, counter: Counter):
+        value_list = sorted(counter.items(), key=lambda x: x[1], reverse=True)
+        descriptor['type'] = field_type
+        descriptor['value'] = [k for k, v in value_list]
+        descriptor['ratio'] = [v / self.total_nb for k, v in value_list]
+
+    def get_descriptor(self) -> dict:
+        descriptor = dict()
+        descriptor['none_ratio'] = self.none_nb / self.total_nb
+        descriptor['distinct_nb'] = len(self.value_counter) if self.value_counter is not None \
+            else self.distinct.count()
+        descriptor['total_nb'] = self.total_nb
+        descriptor['min_value'] = self.min_value
+        descriptor['max_value'] = self.max_value
+        if self.value_counter is not None:
+            self._set_values(descriptor, 'full', self.value_counter)
+        elif self.field_types in ({int}, {float}):
+            if self.number_counter is not None:
+                self._set_values(descriptor, 'number', self.number_counter)
+        elif self.field_types == {str} and self.prefix_overflow is not None:
+            prefix_nb = max(self.prefix_overflow - 1, 1)
+            self._set_values(descriptor, 'c_' + str(prefix_nb), self.prefix_counters[prefix_nb - 1])
+        return descriptor
+
+
 class Archiver(metaclass=abc.ABCMeta):
     """
     Attributes:
@@ -22,6 +304,14 @@ class Archiver(metaclass=abc.ABCMeta):
     data_encode = None
     data_format = None
     zero_data = None
+    # Same filter operations as BasicFlower
+    filter_oper = {'=': xia_eq,
+                   '>=': xia_ge,
+                   '>': xia_gt,
+                   '<=': xia_le,
+                   '<': xia_lt,
+                   '!=': xia_ne,
+                   '<>': xia_ne}
 
     def __init__(self, **kwargs):
         """
@@ -51,9 +341,8 @@ class Archiver(metaclass=abc.ABCMeta):
 
         def map_number(ori_value: Union[int, float]) -> int:
             [bits] = struct.unpack(">Q", struct.pack(">d", float(ori_value)))
-            bit_string = "{:064b}".format(bits)
-            exp = int(bit_string[1:12], 2)
-            return exp if bit_string[0] == '0' else exp * -1
+            exp = (bits >> 52) & 0x7FF
+            return exp if bits >> 63 == 0 else exp * -1
 
         def map_string(ori_value: str, nb: int) -> str:
             return ori_value[:nb]
@@ -106,7 +395,7 @@ class Archiver(metaclass=abc.ABCMeta):
         """
         self.merge_key = merge_key
 
-    def load_archive(self, merge_key: str, fields: List[str] = None):
+    def load_archive(self, merge_key: str, fields: List[str] = None, filters: List[List[list]] = None) -> bool:
         """ Public function
 
         This function loads the needed fields of an archive to workspace
@@ -115,10 +404,135 @@ class Archiver(metaclass=abc.ABCMeta):
         Args:
             merge_key (:obj:`str`): Merge key of archive
             fields (:obj:`list` of :obj:`str`): Field list
+            filters (:obj:`list` of :obj:`list`): Disjunctive normal form filters, same as BasicFlower
+
+        Returns:
+            :obj:`bool`: False if the archive is skipped because its statistics show no line could match the filters
+
+        Notes:
+            Filter fields are loaded for filtering but only the fields of field list are kept in workspace
+        """
+        self.remove_data()
+        self.set_merge_key(merge_key)
+        if not filters:
+            self.append_archive(merge_key, fields)
+            return True
+        self.check_filters(filters)
+        archive_stats = self._get_archive_stats(merge_key)
+        if archive_stats is not None and not self.match_stats(archive_stats, filters):
+            return False
+        load_fields = None if fields is None else list(set(fields) | self.get_fields_from_filter(filters))
+        self.append_archive(merge_key, load_fields)
+        self._filter_workspace(filters, fields)
+        return True
+
+    def check_filters(self, filters: List[List[list]]):
+        """Public function
+
+        Check the disjunctive normal form filters: [[[field, operation, value], ...] and-list, ...] or-list
+
+        Args:
+            filters (:obj:`list` of :obj:`list`): Disjunctive normal form filters
+        """
+        if not isinstance(filters, list) or \
+                any([not isinstance(or_filter, list) for or_filter in filters]) or \
+                any([not isinstance(and_filter, list) or len(and_filter) != 3 or
+                     and_filter[1] not in self.filter_oper for or_filter in filters for and_filter in or_filter]):
+            self.logger.error("Wrong Filters of Archiver", extra=self.log_context)
+            raise ValueError("XIA-000036")
+
+    @classmethod
+    def get_fields_from_filter(cls, ndf_filters: List[List[list]]) -> set:
+        return set([x[0] for l1 in ndf_filters for x in l1 if len(x) > 0])
+
+    @classmethod
+    def filter_dnf(cls, line: dict, ndf_filters: List[List[list]]) -> bool:
+        # Operators are False on None, so a condition on a missing field never matches, same as in match_stats
+        return any([all([cls.filter_oper.get(l2[1])(line.get(l2[0], None), l2[2]) for l2 in l1 if len(l2) > 0])
+                    for l1 in ndf_filters])
+
+    @classmethod
+    def get_column_stats(cls, values: list) -> dict:
+        """Public function
+
+        Get the zone map statistics of a column
+
+        Args:
+            values (:obj:`list`): Column values
+
+        Returns:
+            :obj:`dict`: total_nb, null_nb, distinct_nb and min_value / max_value if the values are comparable
+        """
+        not_null_values = [value for value in values if value is not None]
+        stats = {'total_nb': len(values), 'null_nb': len(values) - len(not_null_values)}
+        value_types = set(type(value) for value in not_null_values)
+        if not value_types or (not value_types <= {int, float} and value_types != {str}):
+            return stats
+        stats['distinct_nb'] = len(set(not_null_values))
+        stats['min_value'] = min(not_null_values)
+        stats['max_value'] = max(not_null_values)
+        return stats
+
+    @classmethod
+    def _match_condition(cls, field_stats: dict, operation: str, value) -> bool:
+        if field_stats is None or field_stats['null_nb'] == field_stats['total_nb']:
+            return False
+        if 'min_value' not in field_stats or value is None:
+            return True
+        min_value, max_value = field_stats['min_value'], field_stats['max_value']
+        try:
+            if operation == '=':
+                return min_value <= value <= max_value
+            elif operation in ['>=', '>']:
+                return cls.filter_oper[operation](max_value, value)
+            elif operation in ['<=', '<']:
+                return cls.filter_oper[operation](min_value, value)
+            else:
+                return not min_value == max_value == value
+        except TypeError:
+            return True
+
+    @classmethod
+    def match_stats(cls, archive_stats: dict, ndf_filters: List[List[list]]) -> bool:
+        """Public function
+
+        Check if some lines of an archive could match the filters by using the archive statistics
+
+        Args:
+            archive_stats (:obj:`dict`): Statistics of each field, see :meth:`get_column_stats`
+            ndf_filters (:obj:`list` of :obj:`list`): Disjunctive normal form filters
+
+        Returns:
+            :obj:`bool`: False if no line could match the filters
+        """
+        return any([all([cls._match_condition(archive_stats.get(l2[0], None), l2[1], l2[2]) for l2 in l1
+                         if len(l2) > 0]) for l1 in ndf_filters])
+
+    def _get_archive_stats(self, merge_key: str) -> Union[dict, None]:
+        """To be implemented function
+
+        Get the statistics of each field of an archive. Default implementation has no statistics
+
+        Args:
+            merge_key (:obj:`str`): Merge key of archive
+
+        Returns:
+            :obj:`dict`: Field name - statistics dictionary, None if there is no statistics
         """
+        return None
+
+    def _filter_workspace(self, filters: List[List[list]], fields: List[str] = None):
+        """Only keep the lines of workspace matching the filters and the fields of field list
+
+        Default implementation rebuilds the workspace from the filtered data
+        """
+        merge_key = self.merge_key
+        data = [line for line in self.get_data() if self.filter_dnf(line, filters)]
+        if fields is not None:
+            data = [{key: value for key, value in line.items() if key in fields} for line in data]
         self.remove_data()
         self.set_merge_key(merge_key)
-        self.append_archive(merge_key, fields)
+        self.add_data(data)
 
     def remove_data(self):
         """ Public Function
@@ -248,108 +662,220 @@ class Archiver(metaclass=abc.ABCMeta):
                 type: full, number or c_<n> (The first n characters)
                 value: Not None value ordered by frequency
                 ratio: present ratio
+
+        Notes:
+            The field data is profiled in a single pass. distinct_nb is an estimation when the field has
+            more than 1024 distinct values
         """
-        descriptor = {}
         field_data = self._get_list_by_field_name(field_name)
-        total_nb = len(field_data)
         if not field_data:
-            return descriptor
-        field_types = dict(Counter([type(field_item) for field_item in field_data]))
-        for key, value in field_types.items():
-            if key not in [type(None), str, int, float]:
-                return {}
-        descriptor['none_ratio'] = field_types.get(type(None), 0) / total_nb
-        field_types.pop(type(None), None)
-        field_dist = dict(Counter(field_data))
-        field_dist.pop(None, None)
-        descriptor['distinct_nb'] = len(field_dist)
-        descriptor['total_nb'] = len(field_data)
-        descriptor['min_value'] = min(list(field_dist))
-        descriptor['max_value'] = max(list(field_dist))
-        samples = set()
-        for i in range(8):
-           samples.add(random.choice(field_data))
-        descriptor['samples'] = list(samples)
-        if len(field_dist) <= 88:
-            descriptor['type'] = 'full'
-            descriptor['value'] = [k for k, v in sorted(field_dist.items(), key=lambda x: x[1], reverse=True)]
-            descriptor['ratio'] = [v / total_nb for k, v in sorted(field_dist.items(), key=lambda x: x[1],
-                                                                   reverse=True)]
-        elif len(field_types) == 1:
-            if int in field_types or float in field_types:
-                field_dist = dict(Counter([self.func_map['number'](item) for item in field_data if item is not None]))
-                if len(field_dist) <= 88:
-                    descriptor['type'] = 'number'
-                    descriptor['value'] = [k for k, v in sorted(field_dist.items(), key=lambda x: x[1], reverse=True)]
-                    descriptor['ratio'] = [v / total_nb for k, v in sorted(field_dist.items(), key=lambda x: x[1],
-                                                                           reverse=True)]
-            elif str in field_types:
-                field_dist, old_field_dist = {}, {}
-                for i in range(1, 22):
-                    old_field_dist = field_dist
-                    mapped_field = [self.func_map['c_' + str(i)](item) for item in field_data if item is not None]
-                    field_dist = dict(Counter(mapped_field ))
-                    if len(field_dist) > 88 and len(old_field_dist) > 0:
-                        descriptor['type'] = 'c_' + str(i-1)
-                        descriptor['value'] = [k for k, v in sorted(old_field_dist.items(), key=lambda x: x[1],
-                                                                    reverse=True)]
-                        descriptor['ratio'] = [v / total_nb for k, v in
-                                               sorted(old_field_dist.items(), key=lambda x: x[1], reverse=True)]
-                        break
+            return {}
+        profiler = _FieldProfiler(self.func_map['number'])
+        if isinstance(field_data, _TypedColumn) and field_data.value_type is str and \
+                len(field_data.dictionary) * 8 <= len(field_data):
+            # Each distinct value of a dictionary encoded column is only profiled once with its occurrence number
+            if not profiler.add_counter(field_data.get_value_counter()):
+                return {}  # pragma: no cover
+        else:
+            for start in range(0, len(field_data), profiler.block_size):
+                if not profiler.add_values(field_data[start: start + profiler.block_size]):
+                    return {}
+        descriptor = profiler.get_descriptor()
+        descriptor['samples'] = list(set([random.choice(field_data) for i in range(8)]))
         return descriptor
 
+    def _get_mapped_list(self, field_name: str, field_desc: dict) -> list:
+        field_list = self._get_list_by_field_name(field_name)
+        if field_desc['type'] == 'full':
+            return list(field_list)
+        map_func = self.func_map[field_desc['type']]
+        return [None if item is None else map_func(item) for item in field_list]
+
+    @classmethod
+    def _get_relation(cls, field1_mapped_list: list, field1_desc: dict, field2_mapped_list: list, field2_desc: dict,
+                      rank: int) -> dict:
+        """Read the top rank cells of the contingency table of the two mapped fields"""
+        total_nb = len(field1_mapped_list)
+        contingency = Counter(zip(field1_mapped_list, field2_mapped_list))
+        field1_values = field1_desc['value'][:rank]
+        field2_values = field2_desc['value'][:rank]
+        return {(i1, i2): contingency.get((v1, v2), 0) / total_nb
+                for (i1, v1), (i2, v2) in itertools.product(enumerate(field1_values), enumerate(field2_values))}
+
     def describe_relation(self, field1_name, field1_desc: dict, field2_name, field2_desc: dict, rank: int = 1) -> dict:
-        result = {}
-        field1_rank = min(rank, len(field1_desc['value']))
-        field2_rank = min(rank, len(field2_desc['value']))
-        field1_type = field1_desc['type']
-        field2_type = field2_desc['type']
-        field1_list = self._get_list_by_field_name(field1_name)
-        field2_list = self._get_list_by_field_name(field2_name)
-        field1_mapped_list = [self.func_map[field1_type](item) for item in field1_list if item is not None]
-        field2_mapped_list = [self.func_map[field2_type](item) for item in field2_list if item is not None]
-        total_nb = len(field1_list)
-        for cur_comb in itertools.product(range(field1_rank), range(field2_rank)):
-            f1_v = field1_desc['value'][cur_comb[0]]
-            f2_v = field2_desc['value'][cur_comb[1]]
-            ok_items = [(v1, v2) for v1, v2 in zip(field1_mapped_list, field2_mapped_list) if f1_v == v1 and f2_v == v2]
-            result[cur_comb] = len(ok_items) / total_nb
-        return result
+        """Public function
+
+        This function will describe the relation of two fields of the current workspace
+
+        Args:
+            field1_name (:obj:`str`): Name of the first field
+            field1_desc (:obj:`dict`): Description of the first field given by :meth:`describe_single_field`
+            field2_name (:obj:`str`): Name of the second field
+            field2_desc (:obj:`dict`): Description of the second field given by :meth:`describe_single_field`
+            rank (:obj:`int`): Number of top values of each field to be checked
+
+        Return:
+            (rank of field 1 value, rank of field 2 value) - ratio of lines having both values dictionary
+        """
+        field1_mapped_list = self._get_mapped_list(field1_name, field1_desc)
+        field2_mapped_list = self._get_mapped_list(field2_name, field2_desc)
+        return self._get_relation(field1_mapped_list, field1_desc, field2_mapped_list, field2_desc, rank)
+
+    def describe_relations(self, field_descs: Dict[str, dict], rank: int = 1) -> Dict[tuple, dict]:
+        """Public function
+
+        This function will describe the relation of all field pairs of the current workspace
+
+        Args:
+            field_descs (:obj:`dict`): Field name - description given by :meth:`describe_single_field` dictionary.
+                Fields without description type are ignored
+            rank (:obj:`int`): Number of top values of each field to be checked
+
+        Return:
+            (field 1 name, field 2 name) - relation given by :meth:`describe_relation` dictionary
+        """
+        field_descs = {key: value for key, value in field_descs.items() if 'type' in value}
+        # Each field is only mapped once for all of its pairs
+        mapped_lists = {key: self._get_mapped_list(key, value) for key, value in field_descs.items()}
+        return {(field1_name, field2_name): self._get_relation(mapped_lists[field1_name], field_descs[field1_name],
+                                                               mapped_lists[field2_name], field_descs[field2_name],
+                                                               rank)
+                for field1_name, field2_name in itertools.combinations(field_descs, 2)}
+
+
+class _LazyColumn(object):
+    """Column whose values are only decoded by ``loader`` at the first access"""
+    def __init__(self, loader: Callable[[], Union[_TypedColumn, list]]):
+        self.loader = loader
+
+    def load(self) -> Union[_TypedColumn, list]:
+        return self.loader()
+
 
 class ListArchiver(Archiver):
+    """Workspace data object is a field name - value list dictionary
+
+    Attributes:
+        typed_workspace (:obj:`bool`): int, float and str value lists are saved as typed columns
+            (contiguous array, dictionary encoded str and null bitmap) to reduce the workspace memory
+    """
     data_encode = 'blob'
     data_format = 'zst'
     zero_data = dict()
 
-    def record_to_list(self, record_data: List[dict]) -> Dict[str, list]:
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.typed_workspace = kwargs.get('typed_workspace', False)
+
+    def _get_column(self, values: list) -> Union[_TypedColumn, list]:
+        return _TypedColumn.from_list(values) if self.typed_workspace else values
+
+    @classmethod
+    def _get_plain_columns(cls, record_data: List[dict]) -> Dict[str, list]:
         if not record_data:
             return dict()
         field_list = reduce(lambda a, b: set(a) | set(b), record_data)
         return {k: [x.get(k, None) for x in record_data] for k in field_list}
 
+    def record_to_list(self, record_data: List[dict]) -> Dict[str, list]:
+        return {key: self._get_column(value) for key, value in self._get_plain_columns(record_data).items()}
+
     def list_to_record(self, list_data: Dict[str, list]) -> List[dict]:
         if not list_data:
             return list()
+        list_data = {key: self._get_plain_list(value) for key, value in list_data.items()}
         vector_size_set = [len(value) for key, value in list_data.items()]
         l_size = vector_size_set[0]
         return [{key: value[i] for key, value in list_data.items() if value[i] is not None} for i in range(l_size)]
 
     def _merge_workspace(self):
         field_list = reduce(lambda a, b: set(a) | set(b), self.workspace)
-        self.workspace[:] = [{key: [u for i in self.workspace for u in i.get(key, [])] for key in field_list}]
+        self.workspace[:] = [{key: self._get_merged_column([i[key] for i in self.workspace if key in i])
+                              for key in field_list}]
+
+    @classmethod
+    def _load_column(cls, column: Union[_LazyColumn, _TypedColumn, list]) -> Union[_TypedColumn, list]:
+        return column.load() if isinstance(column, _LazyColumn) else column
+
+    def _get_plain_list(self, column: Union[_LazyColumn, _TypedColumn, list]) -> list:
+        column = self._load_column(column)
+        return column if isinstance(column, list) else column.tolist()
+
+    def _load_workspace(self):
+        """Decode all lazy columns of the first workspace data object"""
+        for key, column in self.workspace[0].items():
+            if isinstance(column, _LazyColumn):
+                self.workspace[0][key] = column.load()
+
+    def _get_merged_column(self, column_list: list) -> Union[_LazyColumn, _TypedColumn, list]:
+        """Merge of lazy columns is also lazy, so the fields never accessed are never decoded"""
+        if any(isinstance(column, _LazyColumn) for column in column_list):
+            return _LazyColumn(partial(self._merge_columns, column_list))
+        return self._merge_columns(column_list)
+
+    def _merge_columns(self, column_list: list) -> Union[_TypedColumn, list]:
+        column_list = [self._load_column(column) for column in column_list]
+        value_types = set(column.value_type if isinstance(column, _TypedColumn) else None for column in column_list)
+        if len(value_types) == 1 and None not in value_types:
+            merged_column = _TypedColumn(value_types.pop())
+            for column in column_list:
+                merged_column.extend(column)
+            return merged_column
+        return self._get_column([u for column in column_list for u in column])
 
     def add_data(self, data: List[dict]):
-        list_data = self.record_to_list(data)
-        self.workspace_size += len(json.dumps(list_data))
-        self.workspace.append(list_data)
+        # The size is measured before the typed conversion, so typed columns are never converted back to lists
+        plain_data = self._get_plain_columns(data)
+        self.workspace_size += len(json.dumps(plain_data))
+        self.workspace.append({key: self._get_column(value) for key, value in plain_data.items()})
 
     def _get_data(self):
+        self._load_workspace()
         return self.list_to_record(self.workspace[0])
 
+    def _select_rows(self, column: Union[_LazyColumn, _TypedColumn, list], positions: List[int]):
+        values = self._get_plain_list(column)
+        return self._get_column([values[pos] for pos in positions])
+
+    def _filter_workspace(self, filters: List[List[list]], fields: List[str] = None):
+        """Filter columns of workspace: the matched positions are computed from the filter columns only and
+        the selection of the other lazy columns is also lazy
+        """
+        if len(self.workspace) > 1:
+            self._merge_workspace()
+        columns = {key: self._get_plain_list(self._get_list_by_field_name(key))
+                   for key in self.get_fields_from_filter(filters) if key in self.workspace[0]}
+        if columns:
+            row_nb = max([len(column) for column in columns.values()])
+            positions = [pos for pos in range(row_nb)
+                         if self.filter_dnf({key: column[pos] for key, column in columns.items()}, filters)]
+            positions = None if len(positions) == row_nb else positions
+        else:
+            # Without filter field in workspace, every line has the result of an empty line: no column is decoded
+            row_nb, positions = 0, None if self.filter_dnf(dict(), filters) else list()
+        list_data = dict()
+        for key, column in self.workspace[0].items():
+            if fields is not None and key not in fields:
+                continue
+            if positions is None:
+                list_data[key] = column
+            elif not positions:
+                list_data[key] = self._get_column(list())
+            elif isinstance(column, _LazyColumn):
+                list_data[key] = _LazyColumn(partial(self._select_rows, column, positions))
+            else:
+                list_data[key] = self._select_rows(column, positions)
+        if positions is not None:
+            self.workspace_size = self.workspace_size * len(positions) // row_nb if positions else 0
+        self.workspace[:] = [list_data]
+
     def _get_list_by_field_name(self, field_name: str):
         if len(self.workspace) > 1:
             self._merge_workspace()
-        return self.workspace[0].get(field_name, [])
+        column = self.workspace[0].get(field_name, [])
+        if isinstance(column, _LazyColumn):
+            column = self.workspace[0][field_name] = column.load()
+        return column
 
     def get_field_list(self):
         result_set = set()
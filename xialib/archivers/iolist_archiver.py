@@ -5,8 +5,8 @@ import base64
 import zipfile
 import hashlib
 from typing import List, Dict
-from functools import reduce
-from xialib.archiver import ListArchiver
+from functools import reduce, partial
+from xialib.archiver import ListArchiver, _LazyColumn
 from xialib.storer import RWStorer
 
 class IoListArchiver(ListArchiver):
@@ -36,6 +36,9 @@ class IoListArchiver(ListArchiver):
     def _get_filename(self, merge_key):
         return hashlib.md5(merge_key.encode()).hexdigest()[:4] + '-' + merge_key + '.zst'
 
+    def _get_stats_filename(self, merge_key):
+        return hashlib.md5(merge_key.encode()).hexdigest()[:4] + '-' + merge_key + '.stats'
+
     def _set_current_topic_table(self, topic_id: str, table_id: str):
         self.topic_path = self.storer.join(self.archive_path, self.topic_id)
         self.table_path = self.storer.join(self.topic_path, self.table_id)
@@ -46,27 +49,49 @@ class IoListArchiver(ListArchiver):
 
     def _archive_data(self):
         archive_file_name = self.storer.join(self.table_path, self._get_filename(self.merge_key))
-        write_io = io.BytesIO()
+        write_io, archive_stats = io.BytesIO(), dict()
         with zipfile.ZipFile(write_io, 'w', compression=zipfile.ZIP_DEFLATED) as f:
             for key, value in self.workspace[0].items():
                 item_name = base64.b32encode(key.encode()).decode()
-                f.writestr(item_name, json.dumps(value, ensure_ascii=False))
+                values = self._get_plain_list(value)
+                archive_stats[key] = self.get_column_stats(values)
+                f.writestr(item_name, json.dumps(values, ensure_ascii=False))
         write_io.flush()
         self.storer.write(write_io, archive_file_name)
+        # Statistics file is used to skip the archive when it could not match the filters of load_archive
+        stats_file_name = self.storer.join(self.table_path, self._get_stats_filename(self.merge_key))
+        self.storer.write(json.dumps(archive_stats, ensure_ascii=False).encode(), stats_file_name)
         # for write_io in self.storer.get_io_wb_stream(archive_file_name):
         return archive_file_name
 
+    def _read_column(self, archive_file: zipfile.ZipFile, item: zipfile.ZipInfo) -> list:
+        return self._get_column(json.loads(archive_file.read(item).decode()))
+
     def append_archive(self, append_merge_key: str, fields: List[str] = None):
-        field_list = fields
+        """Public function
+
+        The archive file is kept in memory, each field is only decoded when it is firstly accessed
+        """
         archive_file_name = self.storer.join(self.table_path, self._get_filename(append_merge_key))
         for read_io in self.storer.get_io_stream(archive_file_name):
-            with zipfile.ZipFile(read_io) as f:
-                fd_list = [item for item in f.infolist() if base64.b32decode(item.filename).decode() in field_list]
-                list_data = {base64.b32decode(im.filename).decode(): json.loads(f.read(im).decode()) for im in fd_list}
-                list_size = sum([item.file_size for item in fd_list])
-                self.workspace.append(list_data)
-                self.workspace_size += list_size
+            archive_file = zipfile.ZipFile(io.BytesIO(read_io.read()))
+            fd_list = [item for item in archive_file.infolist()
+                       if fields is None or base64.b32decode(item.filename).decode() in fields]
+            list_data = {base64.b32decode(im.filename).decode():
+                         _LazyColumn(partial(self._read_column, archive_file, im)) for im in fd_list}
+            list_size = sum([item.file_size for item in fd_list])
+            self.workspace.append(list_data)
+            self.workspace_size += list_size
+
+    def _get_archive_stats(self, merge_key: str):
+        stats_file_name = self.storer.join(self.table_path, self._get_stats_filename(merge_key))
+        if not self.storer.exists(stats_file_name):
+            return None
+        return json.loads(self.storer.read(stats_file_name).decode())
 
     def remove_archives(self, merge_key_list: List[str]):
         for merge_key in merge_key_list:
             self.storer.remove(self.storer.join(self.table_path, self._get_filename(merge_key)))
+            stats_file_name = self.storer.join(self.table_path, self._get_stats_filename(merge_key))
+            if self.storer.exists(stats_file_name):
+                self.storer.remove(stats_file_name)
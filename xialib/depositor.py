@@ -1,14 +1,147 @@
 import abc
 import io
+import re
+import asyncio
 import gzip
 import json
+import heapq
 import hashlib
 import datetime
+import time
+import zlib
+import struct
 import logging
-from functools import reduce
-from typing import List, Dict, Any, Union, Generator
+import itertools
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce, lru_cache
+from typing import List, Dict, Any, Union, Generator, Iterable, Callable, Tuple
+
+__all__ = ['Depositor', 'MergeScheduler', 'AsyncDepositor']
+
+
+@lru_cache(maxsize=2 ** 16)
+def _calc_merge_level(merge_key: str) -> int:
+    hex_dict = {'2': 1, '4': 2, '6': 1, '8': 3, 'a': 1, 'c': 2, 'e': 1}
+    prove = hashlib.md5(merge_key.encode()).hexdigest()
+    zero_count = (len(prove) - len(prove.rstrip('0'))) * 4 + hex_dict.get(prove[0], 0)
+    mlvl_dict = {0: 0, 1: 0, 2: 0, 3: 1, 4: 1, 5: 2, 6: 2, 7: 3, 8: 3, 9: 4, 10: 5, 11: 6}
+    return mlvl_dict.get(zero_count, 7)
+
+
+class _LRUCache(object):
+    """Size bounded LRU cache, each item has its own weight"""
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.size = 0
+        self._items = OrderedDict()
+
+    def get(self, key):
+        if key not in self._items:
+            return None
+        self._items.move_to_end(key)
+        return self._items[key][0]
+
+    def put(self, key, value, size: int = 1):
+        self.pop(key)
+        if size > self.max_size:
+            return
+        self._items[key] = (value, size)
+        self.size += size
+        while self.size > self.max_size:
+            old_value, old_size = self._items.popitem(last=False)[1]
+            self.size -= old_size
+
+    def pop(self, key):
+        if key in self._items:
+            self.size -= self._items.pop(key)[1]
+
+
+def _add_step_timing(timings: dict, step: str, elapsed: float, size: int = 0):
+    """Running totals [seconds, bytes] of each step, so the memory used doesn't grow with the line number"""
+    totals = timings.setdefault(step, [0.0, 0])
+    totals[0] += elapsed
+    totals[1] += size
+
+
+class _SegmentedGzipWriter(object):
+    """Gzip writer compressing the written data by segments
+
+    Each segment is compressed alone with the previous 32 KiB of data as dictionary and ends by a sync flush, so the
+    segments could be compressed at the same time by an executor. The output only depends on the written data and on
+    the calls of :meth:`flush`, it is the same with or without executor.
+    """
+    window_size = 2 ** 15
+
+    def __init__(self, segment_size: int, executor: ThreadPoolExecutor = None, timings: dict = None):
+        self.segment_size = segment_size
+        self.executor = executor
+        self.timings = timings
+        self._header = b'\x1f\x8b\x08\x00' + struct.pack('<L', int(time.time())) + b'\x02\xff'
+        self._buffer, self._buffer_size, self._dictionary = list(), 0, b''
+        self._segments, self._pending, self._zipped_size, self._crc, self._size = list(), list(), 0, 0, 0
+
+    def write(self, data: bytes):
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        if self._buffer_size >= self.segment_size:
+            self._add_segment(False)
+
+    def _add_segment(self, last: bool):
+        raw_data = b''.join(self._buffer)
+        self._buffer, self._buffer_size = list(), 0
+        self._crc, self._size = zlib.crc32(raw_data, self._crc), self._size + len(raw_data)
+        if self.executor is None:
+            self._add_result(self._compress_segment(raw_data, self._dictionary, last))
+        else:
+            self._pending.append(self.executor.submit(self._compress_segment, raw_data, self._dictionary, last))
+        self._dictionary = (self._dictionary + raw_data)[-self.window_size:]
+
+    @classmethod
+    def _compress_segment(cls, raw_data: bytes, dictionary: bytes, last: bool) -> Tuple[bytes, float]:
+        start = time.perf_counter()
+        if dictionary:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                                          zlib.Z_DEFAULT_STRATEGY, dictionary)
+        else:
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -zlib.MAX_WBITS)
+        zipped_data = compressor.compress(raw_data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+        return zipped_data, time.perf_counter() - start
+
+    def _add_result(self, result: Tuple[bytes, float]):
+        zipped_data, elapsed = result
+        self._segments.append(zipped_data)
+        self._zipped_size += len(zipped_data)
+        if self.timings is not None:
+            _add_step_timing(self.timings, 'compress', elapsed)
+
+    def _wait_segments(self):
+        for future in self._pending:
+            self._add_result(future.result())
+        self._pending = list()
+
+    def flush(self) -> int:
+        """Compress all written data
 
-__all__ = ['Depositor']
+        Returns:
+            :obj:`int`: Compressed size of written data
+        """
+        if self._buffer:
+            self._add_segment(False)
+        self._wait_segments()
+        return len(self._header) + self._zipped_size
+
+    def close(self) -> bytes:
+        """Compress the rest of written data
+
+        Returns:
+            :obj:`bytes`: Gzip compressed data
+        """
+        self._add_segment(True)
+        self._wait_segments()
+        return b''.join([self._header] + self._segments + [struct.pack('<LL', self._crc, self._size & 0xffffffff)])
 
 
 class Depositor(metaclass=abc.ABCMeta):
@@ -17,6 +150,10 @@ class Depositor(metaclass=abc.ABCMeta):
         DELETE (:obj:`object`): Delete symbol for document field delete
         data_encode (:obj:`str`): Each depositor subclass should has its pre-defined data encode
         size_limit (:obj:`int`): Each depositor will have its limit of document size.
+        sort_buffer_size (:obj:`int`): Serialized bytes kept in memory when sorting a data stream,
+            bigger streams will be spilled to temporary sorted runs
+        header_cache_size (:obj:`int`): Number of document headers cached during a merge operation
+        merge_attempt_limit (:obj:`int`): Times an interrupted merge is resumed before its journal is discarded
 
     Note:
         It is forbidden to create dependency among XIA work units, each depositor must implement its encoder
@@ -24,15 +161,40 @@ class Depositor(metaclass=abc.ABCMeta):
     DELETE = object()
     data_encode = None
     size_limit = 2 ** 20
+    sort_buffer_size = 2 ** 26
+    header_cache_size = 1024
+    merge_attempt_limit = 3
 
     def __init__(self, **kwargs):
         """
         Attributes:
             topic_id (:obj:`str`): Topic ID
             table_id (:obj:`str`): Table ID
+            cache_stats (:obj:`dict`): Hit / miss counters of merge operation header cache
+            header_flush_interval (:obj:`int`): Table header counters are accumulated during a merge operation
+                and written once at its end. A positive value forces a write after this number of increments
+            key_compaction (:obj:`bool`): Only keep the last line of each key (defined by table header) in
+                the merged documents. Default False keeps all lines
+            metrics (:obj:`bool`): Collect the operation metrics, see :meth:`get_metrics`. Default False
+            metrics_callback (:obj:`callable`): Function called with (name, value) for each collected metric.
+                Setting a callback also enables the metrics collection
+            compress_workers (:obj:`int`): Number of threads compressing the added data. The thread pool is created
+                at the first added document. Default 0 means the data is compressed by the calling thread.
+                The documents are the same, only the compression runs in parallel
         """
         self.topic_id = None
         self.table_id = None
+        self._compress_ratios = dict()
+        self._header_cache = None
+        self.cache_stats = {'header_hits': 0, 'header_misses': 0}
+        self.header_flush_interval = kwargs.get('header_flush_interval', 0)
+        self._header_counters, self._header_counter_nb = None, 0
+        self.key_compaction = kwargs.get('key_compaction', False)
+        self.metrics_callback = kwargs.get('metrics_callback', None)
+        self.metrics = dict() if kwargs.get('metrics', False) or self.metrics_callback is not None else None
+        self._step_timings = dict()
+        self.compress_workers = kwargs.get('compress_workers', 0)
+        self._compress_executor = None
         self.logger = logging.getLogger("XIA.Depositor")
         self.log_context = {'context': ''}
         if len(self.logger.handlers) == 0:
@@ -42,13 +204,105 @@ class Depositor(metaclass=abc.ABCMeta):
             console_handler.setFormatter(formatter)
             self.logger.addHandler(console_handler)
 
+    def get_metrics(self) -> dict:
+        """Public function
+
+        Snapshot of collected metrics. Times are in seconds, sizes in bytes:
+
+        * ``serialize_time``, ``serialize_bytes``: json serialization of added data
+        * ``compress_time``, ``compress_bytes``: compression of added data
+        * ``store_time``, ``store_bytes``, ``store_count``: documents saved by ``_add_document``
+        * ``add_document_time``, ``add_document_count``: calls of :meth:`add_document`
+        * ``documents_scanned``: documents checked by ``get_stream_by_sort_key``
+        * ``headers_read``: document headers read from the storage
+        * ``merge_tasks``, ``merge_task_bytes``: number and data size of merged documents
+        * ``merge_time_level_<n>``, ``merge_count_level_<n>``: merge operations of each level
+
+        Returns:
+            :obj:`dict`: Metrics name and value, empty if metrics are not enabled
+        """
+        return dict() if self.metrics is None else self.metrics.copy()
+
+    def reset_metrics(self):
+        """Public function
+
+        Reset all collected metrics
+        """
+        if self.metrics is not None:
+            self.metrics = dict()
+
+    def _add_metric(self, name: str, value: Union[int, float] = 1):
+        self.metrics[name] = self.metrics.get(name, 0) + value
+        if self.metrics_callback is not None:
+            self.metrics_callback(name, value)
+
+    def _flush_step_timings(self):
+        timings, self._step_timings = self._step_timings, dict()
+        for step, (elapsed, size) in timings.items():
+            self._add_metric(step + '_time', elapsed)
+            self._add_metric(step + '_bytes', size)
+
+    def _get_line_dumps(self) -> Callable[[dict], str]:
+        if self.metrics is None:
+            return self._dumps_line
+
+        def timed_dumps(line: dict) -> str:
+            start = time.perf_counter()
+            json_line = json.dumps(line, ensure_ascii=False)
+            _add_step_timing(self._step_timings, 'serialize', time.perf_counter() - start, len(json_line))
+            return json_line
+        return timed_dumps
+
     @classmethod
-    def calc_merge_level(cls, merge_key):
-        hex_dict = {'2': 1, '4': 2, '6': 1, '8': 3, 'a': 1, 'c': 2, 'e': 1}
-        prove = hashlib.md5(merge_key.encode()).hexdigest()
-        zero_count = (len(prove) - len(prove.rstrip('0'))) * 4 + hex_dict.get(prove[0], 0)
-        mlvl_dict = {0: 0, 1: 0, 2: 0, 3: 1, 4: 1, 5: 2, 6: 2, 7: 3, 8: 3, 9: 4, 10: 5, 11: 6}
-        return mlvl_dict.get(zero_count, 7)
+    def _dumps_line(cls, line: dict) -> str:
+        return json.dumps(line, ensure_ascii=False)
+
+    def _get_gzip_writer(self, segment_size: int) -> '_SegmentedGzipWriter':
+        if self.compress_workers > 0 and self._compress_executor is None:
+            self._compress_executor = ThreadPoolExecutor(max_workers=self.compress_workers)
+        timings = None if self.metrics is None else self._step_timings
+        return _SegmentedGzipWriter(segment_size, self._compress_executor, timings)
+
+    def _save_chunk(self, header: dict, data: bytes) -> dict:
+        if self.metrics is None:
+            return self._add_document(header, data)
+        self._add_metric('compress_bytes', len(data))
+        start = time.perf_counter()
+        doc_content = self._add_document(header, data)
+        self._add_metric('store_time', time.perf_counter() - start)
+        self._add_metric('store_bytes', len(data))
+        self._add_metric('store_count')
+        return doc_content
+
+    @classmethod
+    def calc_merge_level(cls, merge_key: str) -> int:
+        """Public function
+
+        Merge level (0 - 7) of a merge key. Results of recently used merge keys are memorized
+
+        Args:
+            merge_key (:obj:`str`): Merge key
+
+        Returns:
+            :obj:`int`: Merge level
+        """
+        return _calc_merge_level(merge_key)
+
+    @classmethod
+    def calc_merge_levels(cls, merge_keys: Iterable[str]) -> List[int]:
+        """Public function
+
+        Merge levels of a list of merge keys, each distinct merge key is only calculated once
+
+        Args:
+            merge_keys (:obj:`list` of :obj:`str`): Merge keys
+
+        Returns:
+            :obj:`list` of :obj:`int`: Merge levels in the same order of the merge keys
+        """
+        merge_keys = list(merge_keys)
+        level_dict = {merge_key: _calc_merge_level(merge_key) for merge_key in set(merge_keys)}
+        return [level_dict[merge_key] for merge_key in merge_keys]
 
     @classmethod
     def get_current_timestamp(cls):
@@ -80,23 +334,113 @@ class Depositor(metaclass=abc.ABCMeta):
         """
         raise NotImplementedError  # pragma: no cover
 
-    def _get_aged_data_chunk(self, header: dict, input_data: List[dict]) -> Generator[dict, None, None]:
-        if len(input_data) == 0:
+    def _get_sorted_stream(self, input_data: Iterable[dict], sort_key) -> Generator[dict, None, None]:
+        """External merge sort of a data stream
+
+        Lines are kept serialized in memory up to ``sort_buffer_size`` bytes, each full buffer is sorted and
+        spilled to a temporary run. The runs are then merged back lazily.
+        """
+        runs, buffer, buffer_size = list(), list(), 0
+        try:
+            for line in input_data:
+                json_line = json.dumps(line, ensure_ascii=False)
+                buffer.append((sort_key(line), json_line))
+                buffer_size += len(json_line)
+                if buffer_size >= self.sort_buffer_size:
+                    runs.append(self._spill_sorted_run(buffer))
+                    buffer, buffer_size = list(), 0
+            buffer.sort(key=lambda x: x[0])
+            streams = [self._read_sorted_run(run) for run in runs] + [(json.loads(item[1]) for item in buffer)]
+            if len(streams) == 1:
+                yield from streams[0]
+            else:
+                yield from heapq.merge(*streams, key=sort_key)
+        finally:
+            for run in runs:
+                run.close()
+
+    def _spill_sorted_run(self, buffer: List[tuple]):
+        buffer.sort(key=lambda x: x[0])
+        run = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+        for item in buffer:
+            run.write(item[1] + '\n')
+        run.seek(0)
+        return run
+
+    def _read_sorted_run(self, run) -> Generator[dict, None, None]:
+        for json_line in run:
+            yield json.loads(json_line)
+
+    def _get_compress_ratio(self) -> float:
+        """Get the learned raw / gzipped size ratio of the current table (1.0 if unknown)
+
+        The ratio is persisted as ``compress_ratio`` field of table header
+        """
+        table_key = (self.topic_id, self.table_id)
+        if table_key not in self._compress_ratios:
+            ratio, header_ref = None, self.get_table_header()
+            if header_ref:
+                ratio = self.get_header_from_ref(header_ref).get('compress_ratio', None)
+            self._compress_ratios[table_key] = {'ratio': ratio, 'saved': ratio}
+        ratio = self._compress_ratios[table_key]['ratio']
+        return 1.0 if ratio is None else ratio
+
+    def _learn_compress_ratio(self, raw_size: int, zipped_size: int):
+        ratio_info = self._compress_ratios.setdefault((self.topic_id, self.table_id), {'ratio': None, 'saved': None})
+        observed_ratio = raw_size / max(zipped_size, 1)
+        # Worse compression is learned at once: an overestimated ratio delays the first probe of the next document
+        if ratio_info['ratio'] is None or observed_ratio < ratio_info['ratio']:
+            ratio_info['ratio'] = observed_ratio
+        else:
+            ratio_info['ratio'] = (ratio_info['ratio'] + observed_ratio) / 2
+
+    def _save_compress_ratio(self):
+        ratio_info = self._compress_ratios.get((self.topic_id, self.table_id), None)
+        if not ratio_info or ratio_info['ratio'] is None:
+            return
+        saved_ratio = ratio_info['saved']
+        if saved_ratio is not None and abs(ratio_info['ratio'] - saved_ratio) <= saved_ratio / 10:
+            return
+        header_ref = self.get_table_header()
+        if header_ref:
+            self.update_document(header_ref, {'compress_ratio': round(ratio_info['ratio'], 3)})
+        ratio_info['saved'] = ratio_info['ratio']
+
+    def _is_probe_needed(self, zipped_size: int, probed_raw_size: int, raw_size: int, ratio: float) -> bool:
+        """Only flush the compressor when the predicted compressed size is near the chunk target size
+
+        The learned ratio only predicts the first probe. Once a probe is done, the prediction is anchored to the
+        ratio observed by the probe, and a probe is always done after ``size_limit // 4`` raw bytes, so that
+        badly compressed data added after a high learned ratio could not make the document exceed ``size_limit``
+        """
+        unprobed_raw_size = raw_size - probed_raw_size
+        if unprobed_raw_size >= self.size_limit // 4:
+            return True
+        if zipped_size > 0:
+            ratio, margin = probed_raw_size / zipped_size, 16
+        else:
+            margin = 4
+        return (zipped_size + unprobed_raw_size / ratio) * margin >= (self.size_limit // 2) * (margin - 1)
+
+    def _get_aged_data_chunk(self, header: dict, input_data: Iterable[dict]) -> Generator[dict, None, None]:
+        input_data = iter(input_data)
+        first_line = next(input_data, None)
+        if first_line is None:
             zero_data = gzip.compress(json.dumps([]).encode())
             yield {'header': header, 'data': zero_data, 'line_nb': 0}
             return
-        chunk_size = self.size_limit // 8
-        chunk_number, raw_size, cur_age, line_no, nb, data_io, zipped_size, zipped_io = 0, 0, None, 0, 0, None, 0, None
-        for line in input_data:
+        chunk_size, ratio, probed_raw_size = self.size_limit // 8, self._get_compress_ratio(), 0
+        dumps = self._get_line_dumps()
+        chunk_number, raw_size, cur_age, line_no, nb, zipped_size, zipped_io = 0, 0, None, 0, 0, 0, None
+        for line in itertools.chain([first_line], input_data):
             cur_age = line['_AGE'] if cur_age is None else cur_age
             line['_AGE'] = cur_age
             if '_NO' in line:
                 line['_NO'] = line_no
                 line_no += 1
-            json_line = json.dumps(line, ensure_ascii=False)
-            if data_io is None:
-                data_io = io.BytesIO()
-                zipped_io = gzip.GzipFile(mode='wb', fileobj=data_io)
+            json_line = dumps(line)
+            if zipped_io is None:
+                zipped_io = self._get_gzip_writer(chunk_size // 4)
                 zipped_io.write(('[' + json_line).encode())
             else:
                 zipped_io.write((',' + json_line).encode())
@@ -106,26 +450,29 @@ class Depositor(metaclass=abc.ABCMeta):
             cur_chunk_number = raw_size // chunk_size
             if cur_chunk_number != chunk_number:
                 chunk_number = cur_chunk_number
-                zipped_io.flush()
-                zipped_size = data_io.getbuffer().nbytes
+                if not self._is_probe_needed(zipped_size, probed_raw_size, raw_size, ratio):
+                    continue
+                zipped_size, probed_raw_size = zipped_io.flush(), raw_size
                 if zipped_size >= self.size_limit // 2:
                     zipped_io.write(']'.encode())
-                    zipped_io.close()
+                    chunk_data = zipped_io.close()
                     chunk_header = header.copy()
                     if cur_age > header.get('end_age', header['age']):
                         self.logger.error("Not enough age ranged defined for an aged flow", extra=self.log_context)
                         raise ValueError('XIA-000016')
                     chunk_header['age'] = cur_age
                     chunk_header.pop('end_age', None)
-                    chunk_data = data_io.getvalue()
+                    self._learn_compress_ratio(raw_size, len(chunk_data))
                     yield {'header': chunk_header, 'data': chunk_data, 'line_nb': nb}
                     cur_age += 1
-                    chunk_number, raw_size, line_no, nb, data_io, zipped_size, zipped_io = 0, 0, 0, 0, None, 0, None
+                    chunk_number, raw_size, line_no, nb, zipped_size, zipped_io = 0, 0, 0, 0, 0, None
+                    ratio, probed_raw_size = self._get_compress_ratio(), 0
         if raw_size > 0 or cur_age != header.get('end_age', cur_age):
             if raw_size > 0:
                 zipped_io.write(']'.encode())
-                zipped_io.close()
-                chunk_data = data_io.getvalue()
+                chunk_data = zipped_io.close()
+                if raw_size >= chunk_size:
+                    self._learn_compress_ratio(raw_size, len(chunk_data))
             else:
                 chunk_data = gzip.compress(b'[]')
             chunk_header = header.copy()
@@ -136,23 +483,25 @@ class Depositor(metaclass=abc.ABCMeta):
             chunk_header['end_age'] = header.get('end_age', cur_age)
             yield {'header': chunk_header, 'data': chunk_data, 'line_nb': nb}
 
-    def _get_normal_data_chunk(self, header: dict, input_data: List[dict]) -> Generator[dict, None, None]:
-        if len(input_data) == 0:
+    def _get_normal_data_chunk(self, header: dict, input_data: Iterable[dict]) -> Generator[dict, None, None]:
+        input_data = iter(input_data)
+        first_line = next(input_data, None)
+        if first_line is None:
             zero_data = gzip.compress(json.dumps([]).encode())
             yield {'header': header, 'data': zero_data, 'line_nb': 0}
             return
-        chunk_size = self.size_limit // 8
-        chunk_number, raw_size, cur_seq, line_no, nb, data_io, zipped_size, zipped_io = 0, 0, None, 0, 0, None, 0, None
-        for line in input_data:
+        chunk_size, ratio, probed_raw_size = self.size_limit // 8, self._get_compress_ratio(), 0
+        dumps = self._get_line_dumps()
+        chunk_number, raw_size, cur_seq, line_no, nb, zipped_size, zipped_io = 0, 0, None, 0, 0, 0, None
+        for line in itertools.chain([first_line], input_data):
             cur_seq = line['_SEQ'] if cur_seq is None or line['_SEQ'] > cur_seq else cur_seq
             line['_SEQ'] = cur_seq
             if '_NO' in line:
                 line['_NO'] = line_no
                 line_no += 1
-            json_line = json.dumps(line, ensure_ascii=False)
-            if data_io is None:
-                data_io = io.BytesIO()
-                zipped_io = gzip.GzipFile(mode='wb', fileobj=data_io)
+            json_line = dumps(line)
+            if zipped_io is None:
+                zipped_io = self._get_gzip_writer(chunk_size // 4)
                 zipped_io.write(('[' + json_line).encode())
             else:
                 zipped_io.write((',' + json_line).encode())
@@ -162,24 +511,29 @@ class Depositor(metaclass=abc.ABCMeta):
             cur_chunk_number = raw_size // chunk_size
             if cur_chunk_number != chunk_number:
                 chunk_number = cur_chunk_number
-                zipped_io.flush()
-                zipped_size = data_io.getbuffer().nbytes
+                if not self._is_probe_needed(zipped_size, probed_raw_size, raw_size, ratio):
+                    continue
+                zipped_size, probed_raw_size = zipped_io.flush(), raw_size
                 if zipped_size >= self.size_limit // 2:
                     zipped_io.write(']'.encode())
-                    zipped_io.close()
+                    chunk_data = zipped_io.close()
                     chunk_header = header.copy()
                     chunk_header['start_seq'] = cur_seq
-                    yield {'header': chunk_header, 'data': data_io.getvalue(), 'line_nb': nb}
+                    self._learn_compress_ratio(raw_size, len(chunk_data))
+                    yield {'header': chunk_header, 'data': chunk_data, 'line_nb': nb}
                     cur_seq = str(int(cur_seq) + 1)
-                    chunk_number, raw_size, line_no, nb, data_io, zipped_size, zipped_io = 0, 0, 0, 0, None, 0, None
+                    chunk_number, raw_size, line_no, nb, zipped_size, zipped_io = 0, 0, 0, 0, 0, None
+                    ratio, probed_raw_size = self._get_compress_ratio(), 0
         if raw_size > 0:
             zipped_io.write(']'.encode())
-            zipped_io.close()
+            chunk_data = zipped_io.close()
             chunk_header = header.copy()
             chunk_header['start_seq'] = cur_seq
-            yield {'header': chunk_header, 'data': data_io.getvalue(), 'line_nb': nb}
+            if raw_size >= chunk_size:
+                self._learn_compress_ratio(raw_size, len(chunk_data))
+            yield {'header': chunk_header, 'data': chunk_data, 'line_nb': nb}
 
-    def add_document(self, header: dict, data: List[dict]) -> List[dict]:
+    def add_document(self, header: dict, data: Union[List[dict], Iterable[dict]]) -> List[dict]:
         """ Public function
 
         This function will add a document to depositor. The following properties:
@@ -188,11 +542,23 @@ class Depositor(metaclass=abc.ABCMeta):
 
         Args:
             header (:obj:`dict`): Document Header
-            data (:obj:`list` of :obj:`dict`): Data in Python dictioany list format
+            data (:obj:`list` of :obj:`dict`): Data in Python dictioany list format. Any other iterable
+                (generator for example) will be sorted by an external merge sort bounded by ``sort_buffer_size``
 
         Returns:
             :obj:`list` of :obj:`dict`: List of added document header
         """
+        if self.metrics is None:
+            return self._add_new_document(header, data)
+        start = time.perf_counter()
+        try:
+            return self._add_new_document(header, data)
+        finally:
+            self._flush_step_timings()
+            self._add_metric('add_document_time', time.perf_counter() - start)
+            self._add_metric('add_document_count')
+
+    def _add_new_document(self, header: dict, data: Union[List[dict], Iterable[dict]]) -> List[dict]:
         self.set_current_topic_table(header['topic_id'], header['table_id'])
         content = header.copy()
         content.pop('merged_level', None)
@@ -200,6 +566,7 @@ class Depositor(metaclass=abc.ABCMeta):
         content.pop('segment_start_age', None)
         # Case 1 : Header
         if int(content.get('age', 0)) == 1:
+            data = data if isinstance(data, list) else list(data)
             content['age'] = 1
             content['aged'] = (content.get('aged', '').lower() == 'true')
             content['merge_status'] = 'header'
@@ -209,38 +576,134 @@ class Depositor(metaclass=abc.ABCMeta):
             content['deposit_at'] = self.get_current_timestamp()
             for key in ['merged_size', 'merged_lines', 'packaged_size', 'packaged_lines']:
                 content.pop(key, None)
-            return [self._add_document(content, gzip.compress(json.dumps(data, ensure_ascii=False).encode()))]
+            self._compress_ratios.pop((self.topic_id, self.table_id), None)
+            return [self._save_chunk(content, gzip.compress(json.dumps(data, ensure_ascii=False).encode()))]
         # Case 2 : Aged Document
         elif 'age' in content:
             for key in [k for k in ['age', 'end_age'] if k in content]:
                 content[key] = int(content[key])
-            data = sorted(data, key=lambda a: (a.get('_AGE', 0), a.get('_NO', 0)))
+            data = self._get_sorted_data(data, lambda a: (a.get('_AGE', 0), a.get('_NO', 0)))
             result_headers = list()
             content['merge_status'] = 'initial'
             for result in self._get_aged_data_chunk(content, data):
-                chunk_h = result['header']
-                chunk_h['merge_key'] = str(int(chunk_h['start_seq']) + chunk_h.get('end_age', chunk_h['age']))
-                chunk_h['sort_key'] = chunk_h['merge_key']
-                chunk_h['merge_level'] = self.calc_merge_level(chunk_h['merge_key'])
-                chunk_h['line_nb'] = result['line_nb']
-                chunk_h['deposit_at'] = self.get_current_timestamp()
-                result_headers.append(self._add_document(chunk_h, result['data']))
+                chunk_h = self._set_aged_chunk_header(result['header'], result['line_nb'])
+                result_headers.append(self._save_chunk(chunk_h, result['data']))
+            self._save_compress_ratio()
             return result_headers
         # Case 3 : Normal Document
         else:
-            data = sorted(data, key=lambda a: (a.get('_SEQ', ''), a.get('_NO', 0)))
+            data = self._get_sorted_data(data, lambda a: (a.get('_SEQ', ''), a.get('_NO', 0)))
             result_headers = list()
             content['merge_status'] = 'initial'
             for result in self._get_normal_data_chunk(content, data):
-                chunk_h = result['header']
-                chunk_h['merge_key'] = chunk_h['start_seq']
-                chunk_h['merge_level'] = self.calc_merge_level(chunk_h['merge_key'])
-                chunk_h['deposit_at'] = self.get_current_timestamp()
-                chunk_h['sort_key'] = chunk_h['deposit_at']
-                chunk_h['line_nb'] = result['line_nb']
-                result_headers.append(self._add_document(chunk_h, result['data']))
+                chunk_h = self._set_normal_chunk_header(result['header'], result['line_nb'])
+                result_headers.append(self._save_chunk(chunk_h, result['data']))
+            self._save_compress_ratio()
             return result_headers
 
+    def _set_aged_chunk_header(self, chunk_h: dict, line_nb: int) -> dict:
+        chunk_h['merge_key'] = str(int(chunk_h['start_seq']) + chunk_h.get('end_age', chunk_h['age']))
+        chunk_h['sort_key'] = chunk_h['merge_key']
+        chunk_h['merge_level'] = self.calc_merge_level(chunk_h['merge_key'])
+        chunk_h['line_nb'] = line_nb
+        chunk_h['deposit_at'] = self.get_current_timestamp()
+        return chunk_h
+
+    def _set_normal_chunk_header(self, chunk_h: dict, line_nb: int) -> dict:
+        chunk_h['merge_key'] = chunk_h['start_seq']
+        chunk_h['merge_level'] = self.calc_merge_level(chunk_h['merge_key'])
+        chunk_h['deposit_at'] = self.get_current_timestamp()
+        chunk_h['sort_key'] = chunk_h['deposit_at']
+        chunk_h['line_nb'] = line_nb
+        return chunk_h
+
+    _line_sep_pattern = re.compile(rb'\}\s*,\s*\{')
+    _line_key_patterns = {'_AGE': re.compile(rb'"_AGE"\s*:\s*(-?\d+)\s*[,}]'),
+                          '_SEQ': re.compile(rb'"_SEQ"\s*:\s*"([^"\\]*)"\s*[,}]')}
+
+    @classmethod
+    def _scan_line_keys(cls, raw_data: bytes, key: str) -> Union[list, None]:
+        """Get the ``key`` value of each line without decoding the json data
+
+        The scan only counts the brackets, the braces, the line separators and the key values, so it only works when
+        the lines have no nested list or object. Brackets, braces or escaped quotes in the strings change the counts.
+        None is returned when the counts don't prove one key value per line, the data must then be decoded.
+        """
+        stripped_data = raw_data.strip()
+        if not stripped_data.startswith(b'[{') or not stripped_data.endswith(b'}]') or b'\\"' in stripped_data or \
+                stripped_data.count(b'[') != 1 or stripped_data.count(b']') != 1:
+            return None
+        values = cls._line_key_patterns[key].findall(stripped_data)
+        line_nb = len(cls._line_sep_pattern.findall(stripped_data)) + 1
+        if not line_nb == len(values) == stripped_data.count(b'{') == stripped_data.count(b'}'):
+            return None
+        return [int(value) for value in values] if key == '_AGE' else [value.decode() for value in values]
+
+    def _get_data_size(self, data: bytes) -> int:
+        """To be implemented function
+
+        Size of gzipped data once saved by :meth:`_add_document`, it is the ``data_size`` of the document header.
+        Default implementation saves the data as it is
+
+        Args:
+            data (:obj:`bytes`): gzipped bytes objects
+
+        Returns:
+            :obj:`int`: Saved data size
+        """
+        return len(data)
+
+    def add_encoded_document(self, header: dict, data: bytes) -> List[dict]:
+        """ Public function
+
+        This function will add a document whose data is already gzipped json (``gzip`` data encode of x-i-a spec).
+        When the saved data is smaller than ``size_limit // 2`` (the size of documents cut by :meth:`add_document`)
+        and all the lines are aligned with the header (same ``_AGE`` as header ``age`` for aged document, ``_SEQ``
+        present for normal document), the gzipped data is saved as it is so it is never compressed again.
+        Otherwise the decoded data is added by :meth:`add_document`
+
+        The alignment of lines without nested list or object is checked by a scan of the json text. The other data
+        is decoded once, the decoded lines are checked and passed to :meth:`add_document` when needed
+
+        Args:
+            header (:obj:`dict`): Document Header
+            data (:obj:`bytes`): Gzipped json list
+
+        Returns:
+            :obj:`list` of :obj:`dict`: List of added document header
+        """
+        content, raw_data = header.copy(), gzip.decompress(data)
+        if int(content.get('age', 0)) == 1 or self._get_data_size(data) >= self.size_limit // 2:
+            return self.add_document(header, json.loads(raw_data.decode()))
+        key = '_AGE' if 'age' in content else '_SEQ'
+        data_list, key_values = None, self._scan_line_keys(raw_data, key)
+        if key_values is None:
+            data_list = json.loads(raw_data.decode())
+            key_values = [line.get(key, None) if isinstance(line, dict) else None for line in data_list]
+        if 'age' in content:
+            content['age'] = int(content['age'])
+            content['end_age'] = int(content.get('end_age', content['age']))
+            aligned = all(value == content['age'] for value in key_values)
+        else:
+            aligned = all(isinstance(value, str) for value in key_values)
+        if not key_values or not aligned:
+            return self.add_document(header, json.loads(raw_data.decode()) if data_list is None else data_list)
+        self.set_current_topic_table(content['topic_id'], content['table_id'])
+        for key in ['merged_level', 'segment_start_time', 'segment_start_age']:
+            content.pop(key, None)
+        content['merge_status'] = 'initial'
+        if 'age' in content:
+            chunk_h = self._set_aged_chunk_header(content, len(key_values))
+        else:
+            content['start_seq'] = max(key_values)
+            chunk_h = self._set_normal_chunk_header(content, len(key_values))
+        return [self._save_chunk(chunk_h, data)]
+
+    def _get_sorted_data(self, data: Union[List[dict], Iterable[dict]], sort_key) -> Iterable[dict]:
+        if isinstance(data, list):
+            return sorted(data, key=sort_key)
+        return self._get_sorted_stream(data, sort_key)
+
     @abc.abstractmethod
     def _add_document(self, header: dict, data: bytes) -> dict:
         """ To be implemented function
@@ -301,6 +764,7 @@ class Depositor(metaclass=abc.ABCMeta):
         Returns:
             :obj:`dict`: Last chunked Modified document header
         """
+        self._invalidate_cache(ref)
         if data is not None:
             data = sorted(data, key=lambda a: (a.get('_AGE', 0), a.get('_SEQ', ''), a.get('_NO', 0)))
             header['line_nb'] = len(data)
@@ -419,6 +883,47 @@ class Depositor(metaclass=abc.ABCMeta):
         """
         raise NotImplementedError  # pragma: no cover
 
+    def iter_data(self, start_age: int = None, end_age: int = None) -> Generator[dict, None, None]:
+        """ Public function
+
+        Read the data of an aged table in the given age range. Only the documents whose age range overlaps the
+        requested one are decoded. When some document age ranges overlap, the document with the highest merge key
+        is taken, the same as the merge operation.
+
+        Args:
+            start_age (:obj:`int`): First age to read. Default None means from the first age
+            end_age (:obj:`int`): Last age to read. Default None means until the last age
+
+        Yields:
+            :obj:`dict`: Data line ordered by ``_AGE``
+        """
+        header_ref = self.get_table_header()
+        table_header = self.get_header_from_ref(header_ref) if header_ref else dict()
+        if not table_header.get('aged', False):
+            self.logger.error("Age range read is only possible for aged table", extra=self.log_context)
+            raise ValueError("XIA-000035")
+        windows, covered_start_age = list(), None
+        for doc_ref in self.get_stream_by_sort_key(status_list=['initial', 'merged', 'packaged'], reverse=True):
+            doc_header = self._get_header(doc_ref)
+            if doc_header['start_seq'] < table_header['start_seq']:
+                break
+            doc_start_age = doc_header['age']
+            doc_end_age = doc_header.get('end_age', doc_start_age)
+            if covered_start_age is not None:
+                doc_end_age = min(doc_end_age, covered_start_age - 1)
+                covered_start_age = min(covered_start_age, doc_start_age)
+            else:
+                covered_start_age = doc_start_age
+            window_start_age = doc_start_age if start_age is None else max(doc_start_age, start_age)
+            window_end_age = doc_end_age if end_age is None else min(doc_end_age, end_age)
+            if window_start_age <= window_end_age:
+                windows.append((doc_header, window_start_age, window_end_age))
+            if start_age is not None and covered_start_age <= start_age:
+                break
+        for doc_header, window_start_age, window_end_age in reversed(windows):
+            yield from sorted([line for line in self.get_data_from_header(doc_header)
+                               if window_start_age <= line['_AGE'] <= window_end_age], key=self._get_line_order)
+
     def merge_documents(self, merge_key: str, target_merge_level: int) -> bool:
         """ Public function
 
@@ -430,31 +935,199 @@ class Depositor(metaclass=abc.ABCMeta):
 
         Returns:
             True if successful, False otherwise.
+
+        Notes:
+            Document headers are cached during the merge operation, each document body is only read once.
+            Table header counters are written once at the end of the merge operation.
+            The planned operations are saved in a merge journal, an interrupted merge of the table is always
+            finished before starting a new one
+        """
+        self._header_cache = _LRUCache(self.header_cache_size)
+        self._header_counters, self._header_counter_nb = dict(), 0
+        start = time.perf_counter() if self.metrics is not None else 0
+        try:
+            return self._merge_documents(merge_key, target_merge_level)
+        finally:
+            self.flush_table_header()
+            self._header_counters = None
+            self._header_cache = None
+            if self.metrics is not None:
+                self._add_metric('merge_time_level_{}'.format(target_merge_level), time.perf_counter() - start)
+                self._add_metric('merge_count_level_{}'.format(target_merge_level))
+
+    def flush_table_header(self) -> Union[dict, None]:
+        """ Public function
+
+        Write the accumulated table header counters
+
+        Returns:
+            :obj:`dict`: Table header after update, None if there is nothing to write
+        """
+        if not self._header_counters:
+            return None
+        counters = self._header_counters
+        self._header_counters, self._header_counter_nb = dict(), 0
+        return self.inc_table_header(**counters)
+
+    def _inc_counters(self, **kwargs):
+        if self._header_counters is None:
+            self.inc_table_header(**kwargs)
+            return
+        for key, value in kwargs.items():
+            self._header_counters[key] = self._header_counters.get(key, 0) + value
+        self._header_counter_nb += 1
+        if 0 < self.header_flush_interval <= self._header_counter_nb:
+            self.flush_table_header()
+
+    def _add_task_metrics(self, merge_task: List[dict]):
+        if self.metrics is not None:
+            self._add_metric('merge_tasks', len(merge_task))
+            self._add_metric('merge_task_bytes', sum(task['size'] for task in merge_task))
+
+    def _get_header(self, ref: Any) -> dict:
+        if self._header_cache is None:
+            if self.metrics is not None:
+                self._add_metric('headers_read')
+            return self.get_header_from_ref(ref)
+        header = self._header_cache.get(ref)
+        if header is None:
+            self.cache_stats['header_misses'] += 1
+            if self.metrics is not None:
+                self._add_metric('headers_read')
+            header = self.get_header_from_ref(ref)
+            self._header_cache.put(ref, header)
+        else:
+            self.cache_stats['header_hits'] += 1
+        return header.copy()
+
+    def _invalidate_cache(self, ref: Any):
+        if self._header_cache is not None:
+            self._header_cache.pop(ref)
+
+    def _delete_documents(self, ref_list) -> bool:
+        for ref in ref_list:
+            self._invalidate_cache(ref)
+        return self.delete_documents(ref_list)
+
+    def plan_merge(self, merge_key: str, target_merge_level: int) -> dict:
+        """ Public function
+
+        Dry-run of :meth:`merge_documents`: the merge operations are planned but nothing is written
+
+        Args:
+            merge_key (:obj:`str`): Leader document merge_key
+            target_merge_level (:obj:`int`): Target merge level
+
+        Returns:
+            :obj:`dict`: Merge plan with the following keys:
+                * status: ``ready``, ``merged`` (nothing to do) or ``blocked`` (merge not possible now)
+                * simple: True if the documents are merged without rewriting data (Case 1)
+                * tasks: Task list (ref, size, merged)
+                * read_bytes: Estimated bytes to be read
+                * write_bytes: Estimated bytes to be written
+                * docs_written / docs_deleted: Number of documents to be rewritten / deleted
+                * doc_count: Number of documents in the merge scope after the merge
+                * operations: Planned operations (write, delete, update)
+                * pending_journal: Interrupted merge (merge_key, merge_level, done, operations, attempts) which will
+                  be resumed by :meth:`merge_documents` before this merge, None if there is no interrupted merge.
+                  The plan doesn't include its operations
+
+        Notes:
+            Sizes are in the unit of the ``data_size`` header field (the same as ``size_limit``): the size of data as
+            it is saved, not the gzipped size. For example, :class:`FileDepositor` saves the data in base64 unless the
+            body is split, so its sizes are about 4/3 of the gzipped sizes
         """
         self.log_context['context'] = self.topic_id + '-' + self.table_id + '-' \
                                       + merge_key + '(' + str(target_merge_level) + ')'
+        # plan_merge could be called during a merge operation, the cache of the operation must be kept
+        header_cache, self._header_cache = self._header_cache, _LRUCache(self.header_cache_size)
+        try:
+            pending_journal = self._load_journal()
+            result, merge_task, journal = self._get_merge_journal(merge_key, target_merge_level)
+        finally:
+            self._header_cache = header_cache
+        plan = {'merge_key': merge_key, 'merge_level': target_merge_level, 'simple': False, 'tasks': list(),
+                'read_bytes': 0, 'write_bytes': 0, 'docs_written': 0, 'docs_deleted': 0, 'doc_count': 0,
+                'operations': list(), 'pending_journal': None}
+        if pending_journal is not None:
+            plan['pending_journal'] = {'merge_key': pending_journal['merge_key'],
+                                       'merge_level': pending_journal['merge_level'],
+                                       'done': pending_journal['done'],
+                                       'operations': len(pending_journal['operations']),
+                                       'attempts': pending_journal.get('attempts', 0)}
+        if journal is None:
+            plan['status'] = 'merged' if result else 'blocked'
+            return plan
+        plan['status'] = 'ready'
+        plan['tasks'] = [{'ref': task['ref'], 'size': task['size'], 'merged': task['merged']} for task in merge_task]
+        plan['operations'] = journal['operations']
+        for operation in journal['operations']:
+            if operation['type'] == 'write':
+                plan['simple'] = plan['simple'] or not operation['count']
+                plan['docs_written'] += 1
+                plan['read_bytes'] += sum(task['size'] for task in operation['tasks'])
+                plan['write_bytes'] += sum(self._get_task_write_size(task) for task in operation['tasks'])
+            elif operation['type'] == 'delete':
+                plan['docs_deleted'] += len(operation['refs'])
+        plan['doc_count'] = len(merge_task) - plan['docs_deleted']
+        return plan
+
+    @classmethod
+    def _get_task_write_size(cls, task: dict) -> int:
+        """Aged task only keeps the lines of its age window, the written size is estimated by age range ratio"""
+        if 'task_start_age' not in task:
+            return task['size']
+        task_range = task['task_end_age'] - task['task_start_age'] + 1
+        doc_range = task['end_age'] - task['start_age'] + 1
+        if task_range <= 0:
+            return 0
+        return task['size'] if task_range >= doc_range else task['size'] * task_range // doc_range
+
+    def _get_merge_journal(self, merge_key: str, target_merge_level: int) -> Tuple[bool, List[dict], dict]:
+        """Get the merge journal, the journal is None when there is nothing to merge
+
+        Returns:
+            merge result if there is nothing to merge, merge task list and merge journal
+        """
         base_doc = self.get_ref_by_merge_key(merge_key)
         if not base_doc:
             self.logger.error("Can not get base doc by Merge Key", extra=self.log_context)
-            return False
-        base_doc_header = self.get_header_from_ref(base_doc)
+            return False, list(), None
+        base_doc_header = self._get_header(base_doc)
         if base_doc_header.get('merged_level', 0) < target_merge_level - 1:
             # Not really possible to happen because the higher level merge could only be triggered by lower level
             self.logger.warning("Lower level merge has not yet finished", extra=self.log_context)  # pragma: no cover
-            return False # pragma: no cover
+            return False, list(), None # pragma: no cover
         elif base_doc_header.get('merged_level', 0) >= target_merge_level:
             self.logger.warning("This level has already been merged", extra=self.log_context)
-            return True
+            return True, list(), None
         if 'age' in base_doc_header:
-            aged_merge_task = self._get_aged_merge_task(base_doc, base_doc_header, target_merge_level)
-            if not aged_merge_task:
-                return False
-            return self._aged_merge(aged_merge_task, target_merge_level)
+            merge_task = self._get_aged_merge_task(base_doc, base_doc_header, target_merge_level)
+            if not merge_task:
+                return False, list(), None
+            task_snapshot = [dict(task) for task in merge_task]
+            operations = self._get_aged_merge_plan(merge_task, target_merge_level)
         else:
-            normal_merge_task = self._get_normal_merge_task(base_doc, base_doc_header, target_merge_level)
-            if not normal_merge_task:
-                return False
-            return self._normal_merge(normal_merge_task, target_merge_level)
+            merge_task = self._get_normal_merge_task(base_doc, base_doc_header, target_merge_level)
+            if not merge_task:
+                return False, list(), None
+            task_snapshot = [dict(task) for task in merge_task]
+            operations = self._get_normal_merge_plan(merge_task, target_merge_level)
+        journal = {'merge_key': merge_key, 'merge_level': target_merge_level, 'aged': 'age' in base_doc_header,
+                   'key_list': self._get_compaction_keys() if self.key_compaction else list(),
+                   'done': 0, 'attempts': 0, 'operations': operations}
+        return True, task_snapshot, journal
+
+    def _merge_documents(self, merge_key: str, target_merge_level: int) -> bool:
+        self.log_context['context'] = self.topic_id + '-' + self.table_id + '-' \
+                                      + merge_key + '(' + str(target_merge_level) + ')'
+        self._resume_merge()
+        result, merge_task, journal = self._get_merge_journal(merge_key, target_merge_level)
+        if journal is None:
+            return result
+        self._add_task_metrics(merge_task)
+        self._save_journal(journal)
+        return self._run_merge_journal(journal)
 
     def _get_aged_merge_task(self, leader_doc_ref: Any, leader_doc_dict: dict, target_merge_level: int) -> List[dict]:
         doc_header = {}
@@ -467,7 +1140,7 @@ class Depositor(metaclass=abc.ABCMeta):
                                                    reverse=True,
                                                    min_merge_level=(target_merge_level - 1),
                                                    equal=False):
-            doc_header = self.get_header_from_ref(doc_ref)
+            doc_header = self._get_header(doc_ref)
 
             if doc_header['start_seq'] < leader_doc_dict['start_seq']:
                 self.logger.warning("Old data reached without meeting header", extra=self.log_context)
@@ -522,7 +1195,7 @@ class Depositor(metaclass=abc.ABCMeta):
                                                    reverse=True,
                                                    min_merge_level=(target_merge_level - 1),
                                                    equal=False):
-            doc_header = self.get_header_from_ref(doc_ref)
+            doc_header = self._get_header(doc_ref)
 
             if doc_header['merge_level'] >= target_merge_level:
                 self.logger.info("End of scope: Higher merge level reached", extra=self.log_context)
@@ -544,133 +1217,451 @@ class Depositor(metaclass=abc.ABCMeta):
             return list()
         return task_list
 
-    def _aged_merge(self, merge_task: List[dict], target_merge_level: int) -> bool:
+    @classmethod
+    def _get_line_order(cls, line: dict) -> tuple:
+        return line.get('_AGE', 0), line.get('_SEQ', ''), line.get('_NO', 0)
+
+    def _get_task_stream(self, task: dict, aged: bool) -> Generator[dict, None, None]:
+        """Decode the data of a merge task when it is firstly needed, sorted and filtered by task age window"""
+        task_header = self._get_header(task['ref'])
+        if aged:
+            task_data = [item for item in self.get_data_from_header(task_header)
+                         if task['task_start_age'] <= item['_AGE'] <= task['task_end_age']]
+        else:
+            task_data = list(self.get_data_from_header(task_header))
+        task_data.sort(key=self._get_line_order)
+        yield from task_data
+
+    def _get_merge_stream(self, task_list: List[dict], aged: bool) -> Iterable[dict]:
+        """K-way merge of task data
+
+        Age windows of aged tasks never overlap, so each task is only decoded when the previous one is exhausted.
+        """
+        if aged:
+            task_list = sorted(task_list, key=lambda x: x['task_start_age'])
+            return itertools.chain.from_iterable(self._get_task_stream(task, True) for task in task_list)
+        return heapq.merge(*[self._get_task_stream(task, False) for task in task_list], key=self._get_line_order)
+
+    def _get_compaction_keys(self) -> List[str]:
+        header_ref = self.get_table_header()
+        if not header_ref:
+            return list()
+        field_data = self.get_data_from_header(self.get_header_from_ref(header_ref))
+        return [field['field_name'] for field in field_data
+                if field.get('key_flag', False) and field['field_name'] not in ['_AGE', '_SEQ', '_NO', '_OP']]
+
+    @classmethod
+    def _get_compacted_stream(cls, data: Iterable[dict], key_list: List[str]) -> Generator[dict, None, None]:
+        """Only keep the last line of each key.
+
+        When an older line of the key is an update or a delete, the kept inserted line becomes an update
+        so the loaded target line is still replaced.
+        """
+        last_lines = OrderedDict()
+        for line in data:
+            key = tuple(line.get(field_name, None) for field_name in key_list)
+            previous = last_lines.pop(key, None)
+            replace_flag = previous is not None and (previous[1] or previous[0].get('_OP', '') in ['U', 'D'])
+            last_lines[key] = (line, replace_flag)
+        for line, replace_flag in last_lines.values():
+            if replace_flag and line.get('_OP', '') not in ['U', 'D']:
+                line = dict(line, _OP='U')
+            yield line
+
+    def _update_document_stream(self, ref: Any, header: dict, data: Iterable[dict]) -> dict:
+        """Update a document by using a sorted data stream, the data is compressed on the fly"""
+        self._invalidate_cache(ref)
+        line_nb, data_io = 0, io.BytesIO()
+        with gzip.GzipFile(mode='wb', fileobj=data_io) as zipped_io:
+            zipped_io.write(b'[')
+            for line in data:
+                zipped_io.write(((',' if line_nb > 0 else '') + json.dumps(line, ensure_ascii=False)).encode())
+                line_nb += 1
+            zipped_io.write(b']')
+        gzipped_data = data_io.getvalue()
+        if len(gzipped_data) >= self.size_limit:
+            self.logger.error("Updated data is oversized", extra=self.log_context)
+            raise ValueError("XIA-000017")
+        header['line_nb'] = line_nb
+        return self._update_document(ref, header, gzipped_data)
+
+    def _get_aged_merge_plan(self, merge_task: List[dict], target_merge_level: int) -> List[dict]:
         segment_start_age = min([task['start_age'] for task in merge_task])
         over_size_flag = True if sum([task['size'] for task in merge_task]) >= self.size_limit else False
         has_merged_flag = True if any([task['merged'] for task in merge_task]) else False
         merge_flag = True if over_size_flag or has_merged_flag or target_merge_level == 7 else False
         task_list = sorted(merge_task, key=lambda x: x['task_end_age'], reverse=True)
-        del_list = list()
+        operations, del_list = list(), list()
         # Case 1: Simple no merge at all
         if not merge_flag:
             lead_doc = task_list[0]['ref']
-            header = self.get_header_from_ref(lead_doc)
+            header = self._get_header(lead_doc)
+            header.pop('data', None)
             header['age'] = segment_start_age
             header['merged_level'] = target_merge_level
-            body_data = list()
-            for task in task_list:
-                if task['ref'] != lead_doc:
-                    del_list.append(task['ref'])
-                task_header = self.get_header_from_ref(task['ref'])
-                task_data = self.get_data_from_header(task_header)
-                body_data.extend([item for item in task_data
-                                  if task['task_start_age'] <= item['_AGE'] <= task['task_end_age']])
-            self.update_document(lead_doc, header, body_data)
-            self.delete_documents(del_list)
-            return True
+            del_list.extend([task['ref'] for task in task_list if task['ref'] != lead_doc])
+            operations.append({'type': 'write', 'ref': lead_doc, 'header': header, 'tasks': task_list, 'count': False})
+            operations.append({'type': 'delete', 'refs': del_list})
+            return operations
         # Case 2 - Step 1: Merge everything who is self-oversized
         for task in [task for task in task_list if task['size'] >= (self.size_limit // 2) and not task['merged']]:
-            header = self.get_header_from_ref(task['ref'])
-            body_data = [item for item in self.get_data_from_header(header)
-                              if task['task_start_age'] <= item['_AGE'] <= task['task_end_age']]
+            header = self._get_header(task['ref'])
+            header.pop('data', None)
             header['merge_status'] = 'merged'
             header['age'] = task['task_start_age']
             header['end_age'] = task['task_end_age']
+            operations.append({'type': 'write', 'ref': task['ref'], 'header': header, 'tasks': [task], 'count': True})
             task['merged'] = True
-            updated_header = self.update_document(task['ref'], header, body_data)
-            self.inc_table_header(merged_size=updated_header['data_size'], merged_lines=updated_header['line_nb'])
         # Case 2 - Step 2: Merge documents
-        base_doc, total_size, header, body_data = None, 0, dict(), list()
+        base_doc, total_size, header, group_tasks = None, 0, dict(), list()
         for task in task_list:
             if (total_size + task['size'] >= self.size_limit or task['merged']) and total_size > 0:
-                updated_header = self.update_document(base_doc, header, body_data)
-                self.inc_table_header(merged_size=updated_header['data_size'], merged_lines=updated_header['line_nb'])
-                base_doc, total_size, header, body_data = None, 0, dict(), list()
+                operations.append({'type': 'write', 'ref': base_doc, 'header': header, 'tasks': group_tasks,
+                                   'count': True})
+                base_doc, total_size, header, group_tasks = None, 0, dict(), list()
             if task['merged']:
                 continue
             if task['task_start_age'] > task['task_end_age']:
                 del_list.append(task['ref'])
                 continue
-            task_header = self.get_header_from_ref(task['ref'])
-            task_data = self.get_data_from_header(task_header)
-            body_data.extend([item for item in task_data
-                              if task['task_start_age'] <= item['_AGE'] <= task['task_end_age']])
+            group_tasks.append(task)
             total_size += task['size']
             if base_doc is None:
                 base_doc = task['ref']
-                header = task_header.copy()
+                header = self._get_header(task['ref'])
+                header.pop('data', None)
                 header['merge_status'] = 'merged'
                 header['end_age'] = task['task_end_age']
             else:
                 del_list.append(task['ref'])
             header['age'] = task['task_start_age']
         if total_size > 0:
-            updated_header = self.update_document(base_doc, header, body_data)
-            self.inc_table_header(merged_size=updated_header['data_size'], merged_lines=updated_header['line_nb'])
-        self.delete_documents(del_list)
+            operations.append({'type': 'write', 'ref': base_doc, 'header': header, 'tasks': group_tasks, 'count': True})
+        operations.append({'type': 'delete', 'refs': del_list})
         # Case 2 - Step 3: Update Lead Document
         lead_doc = task_list[0]['ref']
         header = {'segment_start_age': segment_start_age, 'merged_level': target_merge_level}
-        self.update_document(lead_doc, header)
-        return True
+        operations.append({'type': 'update', 'ref': lead_doc, 'header': header})
+        return operations
 
-    def _normal_merge(self, merge_task: List[dict], target_merge_level: int) -> bool:
+    def _get_normal_merge_plan(self, merge_task: List[dict], target_merge_level: int) -> List[dict]:
         segment_start_time = min([task['start_time'] for task in merge_task])
         over_size_flag = True if sum([task['size'] for task in merge_task]) >= self.size_limit else False
         has_merged_flag = True if any([task['merged'] for task in merge_task]) else False
         merge_flag = True if over_size_flag or has_merged_flag or target_merge_level == 7 else False
         task_list = sorted(merge_task, key=lambda x: x['end_time'], reverse=True)
-        del_list = list()
+        operations, del_list = list(), list()
         # Case 1: Simple no merge at all
         if not merge_flag:
             lead_doc = task_list[0]['ref']
-            header = self.get_header_from_ref(lead_doc)
+            header = self._get_header(lead_doc)
+            header.pop('data', None)
             header['start_time'] = segment_start_time
             header['merged_level'] = target_merge_level
-            body_data = list()
-            for task in task_list:
-                if task['ref'] != lead_doc:
-                    del_list.append(task['ref'])
-                task_header = self.get_header_from_ref(task['ref'])
-                task_data = self.get_data_from_header(task_header)
-                body_data.extend(task_data)
-            self.update_document(lead_doc, header, body_data)
-            self.delete_documents(del_list)
-            return True
+            del_list.extend([task['ref'] for task in task_list if task['ref'] != lead_doc])
+            operations.append({'type': 'write', 'ref': lead_doc, 'header': header, 'tasks': task_list, 'count': False})
+            operations.append({'type': 'delete', 'refs': del_list})
+            return operations
         # Case 2 - Step 1: Merge everything who is self-oversized
         for task in [task for task in task_list if task['size'] >= (self.size_limit // 2) and not task['merged']]:
-            header = self.get_header_from_ref(task['ref'])
-            body_data = self.get_data_from_header(header)
+            header = self._get_header(task['ref'])
+            header.pop('data', None)
             header['merge_status'] = 'merged'
+            operations.append({'type': 'write', 'ref': task['ref'], 'header': header, 'tasks': [task], 'count': True})
             task['merged'] = True
-            updated_header = self.update_document(task['ref'], header, body_data)
-            self.inc_table_header(merged_size=updated_header['data_size'], merged_lines=updated_header['line_nb'])
         # Case 2 - Step 2: Merge documents
-        base_doc, total_size, header, body_data = None, 0, dict(), list()
+        base_doc, total_size, header, group_tasks = None, 0, dict(), list()
         for task in task_list:
             if (total_size + task['size'] >= self.size_limit or task['merged']) and total_size > 0:
-                updated_header = self.update_document(base_doc, header, body_data)
-                self.inc_table_header(merged_size=updated_header['data_size'], merged_lines=updated_header['line_nb'])
-                base_doc, total_size, header, body_data = None, 0, dict(), list()
+                operations.append({'type': 'write', 'ref': base_doc, 'header': header, 'tasks': group_tasks,
+                                   'count': True})
+                base_doc, total_size, header, group_tasks = None, 0, dict(), list()
             if task['merged']:
                 continue
-            task_header = self.get_header_from_ref(task['ref'])
-            task_data = self.get_data_from_header(task_header)
-            body_data.extend(task_data)
+            group_tasks.append(task)
             total_size += task['size']
             if base_doc is None:
                 base_doc = task['ref']
-                header = task_header.copy()
+                header = self._get_header(task['ref'])
+                header.pop('data', None)
                 header['merge_status'] = 'merged'
             else:
                 del_list.append(task['ref'])
             header['start_time'] = task['start_time']
         if total_size > 0:
-            updated_header = self.update_document(base_doc, header, body_data)
-            self.inc_table_header(merged_size=updated_header['data_size'], merged_lines=updated_header['line_nb'])
-        self.delete_documents(del_list)
+            operations.append({'type': 'write', 'ref': base_doc, 'header': header, 'tasks': group_tasks, 'count': True})
+        operations.append({'type': 'delete', 'refs': del_list})
         # Case 2 - Step 3: Update Lead Document
         lead_doc = task_list[0]['ref']
         header = {'segment_start_time': segment_start_time, 'merged_level': target_merge_level}
-        self.update_document(lead_doc, header)
+        operations.append({'type': 'update', 'ref': lead_doc, 'header': header})
+        return operations
+
+    def _run_merge_journal(self, journal: dict, resumed: bool = False) -> bool:
+        for op_nb in range(journal['done'], len(journal['operations'])):
+            operation = journal['operations'][op_nb]
+            if operation['type'] == 'write':
+                merge_op = '{}-{}-{}'.format(journal['merge_key'], journal['merge_level'], op_nb)
+                updated_header = self._get_header(operation['ref']) if resumed else dict()
+                # The document might be written just before the interruption
+                if updated_header.get('merge_op', None) != merge_op:
+                    header = dict(operation['header'], merge_op=merge_op)
+                    merge_stream = self._get_merge_stream(operation['tasks'], journal['aged'])
+                    if journal.get('key_list', None):
+                        merge_stream = self._get_compacted_stream(merge_stream, journal['key_list'])
+                    updated_header = self._update_document_stream(operation['ref'], header, merge_stream)
+                if operation['count']:
+                    self._inc_counters(merged_size=updated_header['data_size'],
+                                       merged_lines=updated_header['line_nb'])
+            elif operation['type'] == 'delete':
+                self._delete_documents(operation['refs'])
+            else:
+                self.update_document(operation['ref'], operation['header'])
+            journal['done'] = op_nb + 1
+            self._save_journal_progress(journal['done'])
+        self._clear_journal()
         return True
+
+    def _save_journal(self, journal: dict):
+        """ To be implemented function
+
+        Save the merge journal of the current table, so an interrupted merge could be resumed.
+        Default implementation doesn't save anything. The journal is a json serializable dictionary
+
+        Args:
+            journal (:obj:`dict`): Merge journal
+        """
+
+    def _load_journal(self) -> Union[dict, None]:
+        """ To be implemented function
+
+        Load the merge journal of the current table, ``done`` must include the saved progress
+
+        Returns:
+            :obj:`dict`: Merge journal, None if there is no interrupted merge
+        """
+        return None
+
+    def _save_journal_progress(self, done: int):
+        """ To be implemented function
+
+        Save the number of finished operations of the current merge journal. It is called after each operation
+        so it should not rewrite the whole journal. Default implementation doesn't save anything
+
+        Args:
+            done (:obj:`int`): Number of finished operations
+        """
+
+    def _clear_journal(self):
+        """ To be implemented function
+
+        Remove the merge journal of the current table
+        """
+
+    def resume_merge(self) -> bool:
+        """ Public function
+
+        Finish the interrupted merge of the current table. A merge which has already been resumed
+        ``merge_attempt_limit`` times is discarded with an error log, so it could not block the next merges
+
+        Returns:
+            True if an interrupted merge is finished, False if there is nothing to resume
+        """
+        self._header_cache = _LRUCache(self.header_cache_size)
+        self._header_counters, self._header_counter_nb = dict(), 0
+        try:
+            return self._resume_merge()
+        finally:
+            self.flush_table_header()
+            self._header_counters = None
+            self._header_cache = None
+
+    def _resume_merge(self) -> bool:
+        journal = self._load_journal()
+        if journal is None:
+            return False
+        journal['attempts'] = journal.get('attempts', 0) + 1
+        if journal['attempts'] > self.merge_attempt_limit:
+            self.logger.error("Merge {}({}) discarded after {} failed attempts".format(
+                journal['merge_key'], journal['merge_level'], self.merge_attempt_limit), extra=self.log_context)
+            self._clear_journal()
+            return False
+        self.logger.warning("Resuming merge {}({})".format(journal['merge_key'], journal['merge_level']),
+                            extra=self.log_context)
+        self._save_journal(journal)
+        return self._run_merge_journal(journal, True)
+
+
+class MergeScheduler(object):
+    """Merge documents of many tables on a thread pool
+
+    Each worker thread gets its own depositor instance created by ``depositor_factory``, so the table context
+    set by ``set_current_topic_table`` is never shared. Tasks of the same table are protected by a table lock and
+    are executed by level order while tasks of different tables are executed in parallel.
+
+    Attributes:
+        depositor_factory (:obj:`callable`): Function without parameter returning a new depositor instance
+        max_workers (:obj:`int`): Number of worker threads
+    """
+    def __init__(self, depositor_factory: Callable[[], Depositor], max_workers: int = 4):
+        self.depositor_factory = depositor_factory
+        self.max_workers = max_workers
+        self._local = threading.local()
+        self._table_locks = dict()
+        self._table_locks_lock = threading.Lock()
+
+    def _get_depositor(self) -> Depositor:
+        depositor = getattr(self._local, 'depositor', None)
+        if depositor is None:
+            depositor = self.depositor_factory()
+            self._local.depositor = depositor
+        return depositor
+
+    def _get_table_lock(self, topic_id: str, table_id: str) -> threading.Lock:
+        with self._table_locks_lock:
+            return self._table_locks.setdefault((topic_id, table_id), threading.Lock())
+
+    def _run_table_tasks(self, topic_id: str, table_id: str, task_list: List[tuple]) -> List[tuple]:
+        results = list()
+        with self._get_table_lock(topic_id, table_id):
+            depositor = self._get_depositor()
+            depositor.set_current_topic_table(topic_id, table_id)
+            for task_pos, merge_key, target_merge_level in sorted(task_list, key=lambda x: x[2]):
+                results.append((task_pos, depositor.merge_documents(merge_key, target_merge_level)))
+        return results
+
+    def run(self, task_list: List[Tuple[str, str, str, int]]) -> List[bool]:
+        """Public function
+
+        Execute merge tasks
+
+        Args:
+            task_list (:obj:`list` of :obj:`tuple`): Merge tasks as (topic_id, table_id, merge_key, level)
+
+        Returns:
+            :obj:`list` of :obj:`bool`: Merge result of each task
+        """
+        table_tasks = OrderedDict()
+        for task_pos, (topic_id, table_id, merge_key, target_merge_level) in enumerate(task_list):
+            table_tasks.setdefault((topic_id, table_id), list()).append((task_pos, merge_key, target_merge_level))
+        results = [False] * len(task_list)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._run_table_tasks, topic_id, table_id, tasks)
+                       for (topic_id, table_id), tasks in table_tasks.items()]
+            for future in futures:
+                for task_pos, result in future.result():
+                    results[task_pos] = result
+        return results
+
+
+class AsyncDepositor(object):
+    """Awaitable depositor operations
+
+    Blocking depositor calls (serialization, compression and storage I/O) are executed in a thread pool so the
+    event loop is never stalled. Each worker thread gets its own depositor instance created by ``depositor_factory``.
+    Operations of the same table are serialized by an asyncio lock while operations of different tables are in
+    flight at the same time. Operations must be awaited inside a running event loop.
+
+    The thread pool is created and owned by the async depositor: use it as an async context manager or call
+    :meth:`shutdown` when it is no longer needed.
+
+    Attributes:
+        depositor_factory (:obj:`callable`): Function without parameter returning a new depositor instance
+        max_workers (:obj:`int`): Number of worker threads
+
+    Examples:
+        >>>async def main():
+        ...    async with AsyncDepositor(lambda: FileDepositor(deposit_path='.')) as async_depositor:
+        ...        await asyncio.gather(async_depositor.add_document(header_1, data_1),
+        ...                             async_depositor.add_document(header_2, data_2))
+        >>>asyncio.get_event_loop().run_until_complete(main())
+    """
+    def __init__(self, depositor_factory: Callable[[], Depositor], max_workers: int = 4):
+        self.depositor_factory = depositor_factory
+        self.max_workers = max_workers
+        self._local = threading.local()
+        self._table_locks = dict()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def _get_depositor(self) -> Depositor:
+        depositor = getattr(self._local, 'depositor', None)
+        if depositor is None:
+            depositor = self.depositor_factory()
+            self._local.depositor = depositor
+        return depositor
+
+    def _get_table_lock(self, topic_id: str, table_id: str) -> asyncio.Lock:
+        if (topic_id, table_id) not in self._table_locks:
+            self._table_locks[(topic_id, table_id)] = asyncio.Lock()
+        return self._table_locks[(topic_id, table_id)]
+
+    def _call(self, topic_id: str, table_id: str, method_name: str, args: tuple):
+        depositor = self._get_depositor()
+        depositor.set_current_topic_table(topic_id, table_id)
+        return getattr(depositor, method_name)(*args)
+
+    async def _run(self, topic_id: str, table_id: str, method_name: str, *args):
+        async with self._get_table_lock(topic_id, table_id):
+            # Inside a coroutine, get_event_loop returns the running loop (get_running_loop needs Python 3.7)
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self._executor, self._call, topic_id, table_id, method_name, args)
+
+    async def add_document(self, header: dict, data: Union[List[dict], Iterable[dict]]) -> List[dict]:
+        """Public function
+
+        Awaitable version of :meth:`Depositor.add_document`
+
+        Args:
+            header (:obj:`dict`): Document Header
+            data (:obj:`list` of :obj:`dict`): Data in Python dictioany list format
+
+        Returns:
+            :obj:`list` of :obj:`dict`: Header of created documents
+        """
+        return await self._run(header['topic_id'], header['table_id'], 'add_document', header, data)
+
+    async def add_encoded_document(self, header: dict, data: bytes) -> List[dict]:
+        """Public function
+
+        Awaitable version of :meth:`Depositor.add_encoded_document`
+
+        Args:
+            header (:obj:`dict`): Document Header
+            data (:obj:`bytes`): Gzipped data
+
+        Returns:
+            :obj:`list` of :obj:`dict`: Header of created documents
+        """
+        return await self._run(header['topic_id'], header['table_id'], 'add_encoded_document', header, data)
+
+    async def merge_documents(self, topic_id: str, table_id: str, merge_key: str, target_merge_level: int) -> bool:
+        """Public function
+
+        Awaitable version of :meth:`Depositor.merge_documents`
+
+        Args:
+            topic_id (:obj:`str`): Topic ID
+            table_id (:obj:`str`): Table ID
+            merge_key (:obj:`str`): Merge key of the leader document
+            target_merge_level (:obj:`int`): Target merge level
+
+        Returns:
+            :obj:`bool`: Merge result
+        """
+        return await self._run(topic_id, table_id, 'merge_documents', merge_key, target_merge_level)
+
+    def shutdown(self, wait: bool = True):
+        """Public function
+
+        Release the worker threads
+
+        Args:
+            wait (:obj:`bool`): Wait the end of running operations
+        """
+        self._executor.shutdown(wait=wait)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
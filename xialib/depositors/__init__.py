@@ -1,3 +1,4 @@
 from xialib.depositors.file_depositor import FileDepositor
+from xialib.depositors.sqlite_depositor import SQLiteDepositor
 
-__all__ = ['FileDepositor']
+__all__ = ['FileDepositor', 'SQLiteDepositor']
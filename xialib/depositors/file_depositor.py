@@ -1,18 +1,55 @@
 import os
 import json
+import time
 import base64
 import gzip
+import heapq
+import itertools
+from contextlib import contextmanager
+from bisect import bisect_left, bisect_right, insort
 from typing import List, Dict, Any, Union, Generator
 from xialib.depositor import Depositor
 
 
 class FileDepositor(Depositor):
+    """File Depositor
+
+    Each document is saved as a json file named by ``<sort_key>-<merge_key>.<merge_status>``.
+    When ``split_body`` is set, the json file only holds the header and the gzipped data is saved as it is in
+    a ``<sort_key>-<merge_key>.body`` file, so reading a header does not need to load the data.
+    Both formats could be read.
+
+    The sorted document list of each table is kept in memory. The index is maintained by the depositor operations
+    and is rebuilt when the modification time of table directory differs from the one seen by the last listing.
+    After a write of the depositor itself, the new modification time is only kept when the one read before the write
+    was the known one, so a change of another writer always leads to a new listing. Another writer could still
+    have changed the directory at the same time, so such a directory is listed once again when its modification
+    time is older than ``mtime_resolution`` nanoseconds.
+
+    The planned operations of a running merge are saved in ``merge.journal`` of the table directory and the
+    journal is removed when the merge is finished. The number of finished operations is appended to
+    ``merge.progress``, so the journal is only written once. The merge could be resumed after an interruption.
+
+    When ``bucket_prefix`` is set, the documents are saved in sub-directories named by the first ``bucket_prefix``
+    characters of their sort key, table headers and merge journal stay in the table directory. Each bucket has its
+    own index which is only loaded when the bucket is reached by a query. The same ``bucket_prefix`` must always be
+    used for a given deposit path.
+    """
     data_encode = 'b64g'
     size_limit = 2 ** 20
     file_type = {'initial': '.initial', 'merged': '.merged', 'packaged': '.packaged'}
+    # Document type by priority: the first one is used when a document is saved in several status
+    status_priority = ['.initial', '.merged', '.header', '.packaged']
+    journal_name = 'merge.journal'
+    progress_name = 'merge.progress'
+    mtime_resolution = 2 * 10 ** 9
 
-    def __init__(self, deposit_path=None, **kwargs):
+    def __init__(self, deposit_path=None, split_body: bool = False, bucket_prefix: int = 0, **kwargs):
         super().__init__(**kwargs)
+        self.split_body = split_body
+        self.bucket_prefix = bucket_prefix
+        self._table_indexes = dict()
+        self._aged_tables = dict()
         if deposit_path is None:
             self.deposit_path = self._get_default_deposit_path()
         else:
@@ -27,59 +64,207 @@ class FileDepositor(Depositor):
             os.mkdir(deposite_path)  # pragma: no cover
         return deposite_path
 
-    def _get_ref_from_filename(self, filename):
-        file = filename.split('.')[0]
-        if os.path.exists(os.path.join(self.table_path, file + '.initial')):
-            return file+'.initial'
-        elif os.path.exists(os.path.join(self.table_path, file + '.merged')):
-            return file+'.merged'
-        elif os.path.exists(os.path.join(self.table_path, file + '.header')):
-            return file + '.header'
+    def _get_table_index(self, check: bool = True) -> dict:
+        return self._get_dir_index(self.table_path, check)
+
+    def _get_dir_index(self, dir_path: str, check: bool = True) -> dict:
+        index = self._table_indexes.get(dir_path, None)
+        if index is not None and not check:
+            return index
+        mtime = self._get_dir_mtime(dir_path)
+        if mtime is None:
+            return self._get_new_index(dir_path, None)
+        if index is None or index['mtime'] != mtime or (index['recheck'] and not self._is_mtime_recent(mtime)):
+            index = self._get_new_index(dir_path, mtime)
+            # Changes made at the same time as the listing might be hidden, the directory will be checked once again
+            index['recheck'] = self._is_mtime_recent(mtime)
+            filenames = list()
+            for filename in sorted(os.listdir(dir_path)):
+                if filename.endswith(tuple(self.status_priority)):
+                    filenames.append(filename)
+                elif self.bucket_prefix > 0 and dir_path == self.table_path and '.' not in filename:
+                    index['buckets'].append(filename)
+            levels = self.calc_merge_levels(filename.split('.')[0][-20:] for filename in filenames)
+            for filename, level in zip(filenames, levels):
+                self._index_add(index, filename, level)
+            self._table_indexes[dir_path] = index
+        return index
+
+    @classmethod
+    def _get_new_index(cls, dir_path: str, mtime: Union[int, None]) -> dict:
+        return {'path': dir_path, 'mtime': mtime, 'recheck': False, 'names': list(), 'sort_keys': list(),
+                'refs': dict(), 'levels': dict(), 'merge_keys': dict(), 'headers': set(), 'buckets': list()}
+
+    @classmethod
+    def _get_dir_mtime(cls, dir_path: str) -> Union[int, None]:
+        try:
+            return os.stat(dir_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _is_mtime_recent(self, mtime: int) -> bool:
+        return int(time.time() * 10 ** 9) - mtime <= self.mtime_resolution
+
+    @contextmanager
+    def _own_write(self, dir_path: str):
+        """Keep the modification time of an index which is up to date before the writes of the depositor itself
+        """
+        mtime = self._get_dir_mtime(dir_path)
+        yield
+        index = self._table_indexes.get(dir_path, None)
+        if index is not None and mtime is not None and index['mtime'] == mtime:
+            index['mtime'] = self._get_dir_mtime(dir_path)
+            index['recheck'] = True
+
+    def _get_dir_path(self, filename: str) -> str:
+        # Table header documents don't have merge key so they are always in the table directory
+        if self.bucket_prefix > 0 and '-' in filename.split('.')[0]:
+            return os.path.join(self.table_path, filename[:self.bucket_prefix])
+        return self.table_path
+
+    def _get_doc_path(self, filename: str) -> str:
+        return os.path.join(self._get_dir_path(filename), filename)
+
+    def _get_doc_index(self, filename: str, check: bool = True) -> dict:
+        return self._get_dir_index(self._get_dir_path(filename), check)
+
+    def _get_bucket_indexes(self, buckets: List[str]) -> Generator[dict, None, None]:
+        for bucket in buckets:
+            yield self._get_dir_index(os.path.join(self.table_path, bucket))
+
+    def _index_add(self, index: dict, filename: str, level: int = None):
+        file, ext = os.path.splitext(filename)
+        old_ref = index['refs'].get(file, None)
+        if self._index_contains(index, filename):
+            return
+        pos = bisect_left(index['names'], filename)
+        index['names'].insert(pos, filename)
+        index['sort_keys'].insert(pos, filename[:20])
+        old_ext = os.path.splitext(old_ref)[1] if old_ref else ext
+        if old_ref is None or self.status_priority.index(ext) < self.status_priority.index(old_ext):
+            index['refs'][file] = filename
+        if ext == '.header':
+            index['headers'].add(filename)
         else:
-            return file + '.packaged'
+            if level is None:
+                level = index['levels'].get(file, None)
+            index['levels'][file] = self.calc_merge_level(file[-20:]) if level is None else level
+            index['merge_keys'].setdefault(file[-20:], set()).add(file)
+
+    def _index_contains(self, index: dict, filename: str) -> bool:
+        pos = bisect_left(index['names'], filename)
+        return pos < len(index['names']) and index['names'][pos] == filename
+
+    def _index_remove(self, index: dict, filename: str):
+        if not self._index_contains(index, filename):
+            return
+        file, ext = os.path.splitext(filename)
+        pos = bisect_left(index['names'], filename)
+        del index['names'][pos]
+        del index['sort_keys'][pos]
+        index['headers'].discard(filename)
+        other_refs = [file + other_ext for other_ext in self.status_priority
+                      if self._index_contains(index, file + other_ext)]
+        if other_refs:
+            index['refs'][file] = other_refs[0]
+            return
+        index['refs'].pop(file, None)
+        index['levels'].pop(file, None)
+        if file in index['merge_keys'].get(file[-20:], set()):
+            index['merge_keys'][file[-20:]].discard(file)
+            if not index['merge_keys'][file[-20:]]:
+                index['merge_keys'].pop(file[-20:])
+
+    def _get_ref_from_filename(self, filename, check: bool = True):
+        file = filename.split('.')[0]
+        return self._get_doc_index(file, check)['refs'].get(file, file + '.packaged')
 
     def _set_current_topic_table(self, topic_id: str, table_id: str):
         self.topic_path = os.path.join(self.deposit_path, self.topic_id)
         self.table_path = os.path.join(self.topic_path, self.table_id)
         if not os.path.exists(self.topic_path):
-            os.makedirs(self.topic_path)
+            os.makedirs(self.topic_path, exist_ok=True)
         if not os.path.exists(self.table_path):
-            os.makedirs(self.table_path)
+            os.makedirs(self.table_path, exist_ok=True)
+
+    def _get_body_filename(self, header: dict) -> str:
+        if header['merge_status'] == 'header':
+            return header['sort_key'] + '.body'
+        return header['sort_key'] + '-' + header['merge_key'] + '.body'
+
+    def _get_data_size(self, data: bytes) -> int:
+        # Data is saved in base64 format unless it is saved in a body file
+        return len(data) if self.split_body else (len(data) + 2) // 3 * 4
+
+    def _write_document(self, doc_ref: str, header: dict, data: bytes) -> dict:
+        doc_content = header.copy()
+        if self.split_body:
+            doc_content.pop('data', None)
+            doc_content['data_size'] = len(data)
+        else:
+            doc_content['data'] = base64.b64encode(data).decode()
+            doc_content['data_size'] = len(doc_content['data'])
+        with self._own_write(self._get_dir_path(doc_ref)):
+            if self.split_body:
+                with open(self._get_doc_path(doc_ref.split('.')[0] + '.body'), 'wb') as f:
+                    f.write(data)
+            with open(self._get_doc_path(doc_ref), 'w') as f:
+                f.write(json.dumps(doc_content, ensure_ascii=False))
+        return doc_content
+
+    def _remove_file(self, filename: str):
+        with self._own_write(self._get_dir_path(filename)):
+            os.remove(self._get_doc_path(filename))
+
+    def _remove_body(self, doc_ref: str):
+        try:
+            self._remove_file(doc_ref.split('.')[0] + '.body')
+        except FileNotFoundError:
+            pass
 
     def _add_document(self, header: dict, data: bytes) -> dict:
         if header['merge_status'] == 'header':
             doc_ref = header['sort_key'] + '.header'
         else:
             doc_ref = header['sort_key'] + '-' + header['merge_key'] + self.file_type.get(header['merge_status'])
-        old_file = os.path.join(self.table_path, self._get_ref_from_filename(doc_ref))
-        if os.path.exists(old_file):
-            os.remove(old_file)
-        doc_content = header.copy()
-        doc_content['data'] = base64.b64encode(data).decode()
-        doc_content['data_size'] = len(doc_content['data'])
-        with open(os.path.join(self.table_path, doc_ref), 'w') as f:
-            f.write(json.dumps(doc_content, ensure_ascii=False))
+        if not os.path.exists(self._get_dir_path(doc_ref)):
+            with self._own_write(self.table_path):
+                os.makedirs(self._get_dir_path(doc_ref), exist_ok=True)
+            table_index = self._get_table_index(False)
+            if doc_ref[:self.bucket_prefix] not in table_index['buckets']:
+                insort(table_index['buckets'], doc_ref[:self.bucket_prefix])
+        index = self._get_doc_index(doc_ref)
+        old_ref = index['refs'].get(doc_ref.split('.')[0], None)
+        if old_ref is not None:
+            self._remove_file(old_ref)
+            self._index_remove(index, old_ref)
+            if not self.split_body:
+                self._remove_body(old_ref)
+        doc_content = self._write_document(doc_ref, header, data)
+        self._index_add(index, doc_ref, header.get('merge_level', None))
         return doc_content
 
     def _update_document(self, ref: Any, header: dict, data: bytes):
-        ori_filename = os.path.join(self.table_path, self._get_ref_from_filename(ref))
-        tar_filename = os.path.join(self.table_path, '.'.join([ref.split('.')[0], header['merge_status']]))
-        doc_content = header.copy()
-        doc_content['data'] = base64.b64encode(data).decode()
-        doc_content['data_size'] = len(doc_content['data'])
-        with open(tar_filename, 'w') as f:
-            f.write(json.dumps(doc_content, ensure_ascii=False))
-        if ori_filename != tar_filename:
-            os.remove(ori_filename)
+        index = self._get_doc_index(ref)
+        ori_ref = self._get_ref_from_filename(ref, False)
+        tar_ref = '.'.join([ref.split('.')[0], header['merge_status']])
+        doc_content = self._write_document(tar_ref, header, data)
+        self._index_add(index, tar_ref)
+        if ori_ref != tar_ref:
+            self._remove_file(ori_ref)
+            self._index_remove(index, ori_ref)
+        if not self.split_body:
+            self._remove_body(ori_ref)
         return doc_content
 
     def _update_header(self, ref: Any, header: dict):
-        ori_filename = os.path.join(self.table_path, self._get_ref_from_filename(ref))
+        index = self._get_doc_index(ref)
+        ori_ref = self._get_ref_from_filename(ref, False)
         if 'merge_status' in header:
-            tar_filename = os.path.join(self.table_path, '.'.join([ref.split('.')[0], header['merge_status']]))
+            tar_ref = '.'.join([ref.split('.')[0], header['merge_status']])
         else:
-            tar_filename = ori_filename
-        with open(ori_filename, 'rb') as f:
+            tar_ref = ori_ref
+        with open(self._get_doc_path(ori_ref), 'rb') as f:
             doc_content = json.loads(f.read().decode())
         for key, value in header.items():
             if key not in doc_content and value != self.DELETE:
@@ -88,65 +273,156 @@ class FileDepositor(Depositor):
                 doc_content.pop(key, None)
             else:
                 doc_content[key] = value
-        with open(tar_filename, 'w') as f:
-            f.write(json.dumps(doc_content, ensure_ascii=False))
-        if ori_filename != tar_filename:
-            os.remove(ori_filename)
+        with self._own_write(self._get_dir_path(tar_ref)):
+            with open(self._get_doc_path(tar_ref), 'w') as f:
+                f.write(json.dumps(doc_content, ensure_ascii=False))
+        if ori_ref != tar_ref:
+            self._index_add(index, tar_ref)
+            self._remove_file(ori_ref)
+            self._index_remove(index, ori_ref)
         return doc_content
 
     def delete_documents(self, ref_list):
+        index_dict = dict()
         for file_to_delete in ref_list:
-            os.remove(os.path.join(self.table_path, self._get_ref_from_filename(file_to_delete)))
+            dir_path = self._get_dir_path(file_to_delete)
+            if dir_path not in index_dict:
+                index_dict[dir_path] = self._get_dir_index(dir_path)
+            index = index_dict[dir_path]
+            filename = self._get_ref_from_filename(file_to_delete, False)
+            try:
+                self._remove_file(filename)
+            except FileNotFoundError:
+                pass
+            self._index_remove(index, filename)
+            self._remove_body(filename)
         return True
 
+    def _remove_progress(self):
+        try:
+            self._remove_file(self.progress_name)
+        except FileNotFoundError:
+            pass
+
+    def _save_journal(self, journal: dict):
+        # The progress is always kept by the journal itself, so the progress of another journal is never read
+        self._remove_progress()
+        journal_file = os.path.join(self.table_path, self.journal_name)
+        with self._own_write(self.table_path):
+            with open(journal_file + '.tmp', 'w') as f:
+                f.write(json.dumps(journal, ensure_ascii=False))
+            os.replace(journal_file + '.tmp', journal_file)
+
+    def _save_journal_progress(self, done: int):
+        with self._own_write(self.table_path):
+            with open(os.path.join(self.table_path, self.progress_name), 'a') as f:
+                f.write(str(done) + '\n')
+
+    def _load_journal(self) -> Union[dict, None]:
+        journal_file = os.path.join(self.table_path, self.journal_name)
+        if not os.path.exists(journal_file):
+            return None
+        with open(journal_file, 'rb') as f:
+            journal = json.loads(f.read().decode())
+        progress_file = os.path.join(self.table_path, self.progress_name)
+        if os.path.exists(progress_file):
+            with open(progress_file) as f:
+                # A line interrupted during its write is ignored
+                done_list = [int(line) for line in f.read().split('\n') if line.isdigit()]
+            journal['done'] = max([journal['done']] + done_list)
+        return journal
+
+    def _clear_journal(self):
+        try:
+            self._remove_file(self.journal_name)
+        except FileNotFoundError:
+            pass
+        self._remove_progress()
+
     def get_header_from_ref(self, doc_ref: Any):
-        with open(os.path.join(self.table_path, self._get_ref_from_filename(doc_ref)), 'rb') as f:
+        with open(self._get_doc_path(self._get_ref_from_filename(doc_ref)), 'rb') as f:
             return json.loads(f.read().decode())
 
     def get_data_from_header(self, header: dict):
-        return json.loads(gzip.decompress(base64.b64decode(header['data'])).decode())
+        if 'data' in header:
+            return json.loads(gzip.decompress(base64.b64decode(header['data'])).decode())
+        with open(self._get_doc_path(self._get_body_filename(header)), 'rb') as f:
+            return json.loads(gzip.decompress(f.read()).decode())
+
+    def _is_aged_table(self) -> bool:
+        if self.table_path not in self._aged_tables:
+            header_ref = self.get_table_header()
+            if not header_ref:
+                return False
+            self._aged_tables[self.table_path] = self.get_header_from_ref(header_ref).get('aged', False)
+        return self._aged_tables[self.table_path]
 
     def get_ref_by_merge_key(self, merge_key):
-        based_doc_query = [fn for fn in os.listdir(self.table_path) if ('-' + merge_key + '.') in fn]
+        index = self._get_table_index()
+        based_doc_query = set(index['merge_keys'].get(merge_key, set()))
+        if index['buckets']:
+            # Sort key of aged document is its merge key, so only the bucket of the merge key is checked
+            bucket_index = self._get_dir_index(os.path.join(self.table_path, merge_key[:self.bucket_prefix]))
+            based_doc_query.update(bucket_index['merge_keys'].get(merge_key, set()))
+            if not based_doc_query and not self._is_aged_table():
+                # Sort key of normal document is its deposit time, the bucket could not be computed
+                for bucket_index in self._get_bucket_indexes(index['buckets']):
+                    based_doc_query.update(bucket_index['merge_keys'].get(merge_key, set()))
         if based_doc_query:
-            return self._get_ref_from_filename(max(based_doc_query))
+            file = max(based_doc_query)
+            return self._get_doc_index(file, False)['refs'][file]
 
-    def get_stream_by_sort_key(self,
-                               status_list: List[str] = None,
-                               le_ge_key: str = None,
-                               reverse: bool = False,
-                               min_merge_level: int = 0,
-                               equal: bool = True):
-        if not status_list:
-            status_list = ['header', 'initial', 'merged', 'packaged']
+    @classmethod
+    def _get_sorted_names(cls, index: dict, le_ge_key: str, reverse: bool, equal: bool) -> List[str]:
         if reverse:
             if not le_ge_key:
-                doc_list = sorted([f for f in os.listdir(self.table_path)
-                                   if f.endswith(tuple(status_list))], reverse=True)
+                return index['names'][::-1]
             elif equal:
-                doc_list = sorted([f for f in os.listdir(self.table_path)
-                                   if f.endswith(tuple(status_list)) and f[:20] <= le_ge_key], reverse=True)
+                return index['names'][:bisect_right(index['sort_keys'], le_ge_key)][::-1]
             else:
-                doc_list = sorted([f for f in os.listdir(self.table_path)
-                                   if f.endswith(tuple(status_list)) and f[:20] < le_ge_key], reverse=True)
+                return index['names'][:bisect_left(index['sort_keys'], le_ge_key)][::-1]
         else:
             if not le_ge_key:
-                doc_list = sorted([f for f in os.listdir(self.table_path)
-                                   if f.endswith(tuple(status_list))])
+                return index['names'][:]
             elif equal:
-                doc_list = sorted([f for f in os.listdir(self.table_path)
-                                   if f.endswith(tuple(status_list)) and f[:20] >= le_ge_key])
+                return index['names'][bisect_left(index['sort_keys'], le_ge_key):]
             else:
-                doc_list = sorted([f for f in os.listdir(self.table_path)
-                                   if f.endswith(tuple(status_list)) and f[:20] > le_ge_key])
+                return index['names'][bisect_right(index['sort_keys'], le_ge_key):]
+
+    def get_stream_by_sort_key(self,
+                               status_list: List[str] = None,
+                               le_ge_key: str = None,
+                               reverse: bool = False,
+                               min_merge_level: int = 0,
+                               equal: bool = True):
+        if not status_list:
+            status_list = ['header', 'initial', 'merged', 'packaged']
+        index = self._get_table_index()
+        doc_list = self._get_sorted_names(index, le_ge_key, reverse, equal)
+        if index['buckets']:
+            # Buckets are walked in order, each bucket index is loaded only when the bucket is reached
+            buckets = index['buckets'][::-1] if reverse else index['buckets']
+            if le_ge_key and reverse:
+                buckets = [bucket for bucket in buckets if bucket <= le_ge_key[:self.bucket_prefix]]
+            elif le_ge_key:
+                buckets = [bucket for bucket in buckets if bucket >= le_ge_key[:self.bucket_prefix]]
+            bucket_docs = itertools.chain.from_iterable(self._get_sorted_names(bucket_index, le_ge_key, reverse, equal)
+                                                        for bucket_index in self._get_bucket_indexes(buckets))
+            doc_list = heapq.merge(doc_list, bucket_docs, reverse=reverse)
         # Merge Level Check
         for doc in doc_list:
-            if not doc.endswith('.header') and self.calc_merge_level((doc.split('.')[0])[-20:]) < min_merge_level:
+            if self.metrics is not None:
+                self._add_metric('documents_scanned')
+            if not doc.endswith(tuple(status_list)):
+                continue
+            file = doc.split('.')[0]
+            doc_index = self._get_doc_index(file, False)
+            if not doc.endswith('.header') and doc_index['levels'].get(file, 0) < min_merge_level:
                 continue
-            yield self._get_ref_from_filename(doc)
+            yield self._get_ref_from_filename(file, False)
 
     def get_table_header(self) -> Any:
-        header_list = [f for f in os.listdir(self.table_path) if f.endswith(('.header'))]
+        header_list = self._get_table_index()['headers']
         if not header_list:
             return None
         else:
@@ -0,0 +1,180 @@
+import json
+import gzip
+import sqlite3
+from contextlib import contextmanager
+from typing import List, Any, Union, Generator, Iterable
+from xialib.depositor import Depositor
+
+
+class SQLiteDepositor(Depositor):
+    """SQLite Depositor
+
+    All documents are saved in the table ``XIA_DEPOSIT`` of the given ``sqlite3.Connection``, one line per document.
+    The sqlite3 specific ``execute`` / ``executemany`` shortcuts, ``?`` parameters and ``INSERT OR REPLACE`` are used,
+    so other PEP249 connections are not supported.
+    The searchable header fields are saved in indexed columns, the complete header is saved as a json text
+    and the gzipped data is saved as it is in a BLOB column.
+
+    Document reference is ``<sort_key>-<merge_key>`` (``<sort_key>`` for table header document).
+    Each ``add_document`` and ``merge_documents`` call is executed in a single transaction.
+    """
+    data_encode = 'gzip'
+    size_limit = 2 ** 20
+    create_sql_list = [
+        "CREATE TABLE IF NOT EXISTS XIA_DEPOSIT ("
+        "topic_id TEXT NOT NULL, table_id TEXT NOT NULL, doc_id TEXT NOT NULL, sort_key TEXT NOT NULL, "
+        "merge_key TEXT, merge_level INTEGER, merge_status TEXT NOT NULL, age INTEGER, end_age INTEGER, "
+        "header TEXT NOT NULL, data BLOB, PRIMARY KEY(topic_id, table_id, doc_id))",
+        "CREATE INDEX IF NOT EXISTS XIA_DEPOSIT_SORT_KEY ON XIA_DEPOSIT (topic_id, table_id, sort_key)",
+        "CREATE INDEX IF NOT EXISTS XIA_DEPOSIT_MERGE_KEY ON XIA_DEPOSIT (topic_id, table_id, merge_key)",
+        "CREATE INDEX IF NOT EXISTS XIA_DEPOSIT_STATUS ON XIA_DEPOSIT (topic_id, table_id, merge_status)",
+    ]
+    column_list = ['sort_key', 'merge_key', 'merge_level', 'merge_status', 'age', 'end_age']
+
+    def __init__(self, db, **kwargs):
+        super().__init__(**kwargs)
+        if not isinstance(db, sqlite3.Connection):
+            self.logger.error("db must be type of sqlite3.Connection", extra=self.log_context)
+            raise TypeError("XIA-000037")
+        self.connection = db
+        self._in_transaction = False
+        with self._transaction():
+            for sql in self.create_sql_list:
+                self.connection.execute(sql)
+
+    @contextmanager
+    def _transaction(self):
+        if self._in_transaction:
+            yield
+            return
+        self._in_transaction = True
+        try:
+            yield
+            self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
+        finally:
+            self._in_transaction = False
+
+    def _commit(self):
+        if not self._in_transaction:
+            self.connection.commit()
+
+    def _set_current_topic_table(self, topic_id: str, table_id: str):
+        pass
+
+    @classmethod
+    def _get_doc_id(cls, header: dict) -> str:
+        if header['merge_status'] == 'header':
+            return header['sort_key']
+        return header['sort_key'] + '-' + header['merge_key']
+
+    def _get_column_values(self, header: dict) -> list:
+        return [header.get(column, None) for column in self.column_list]
+
+    def add_document(self, header: dict, data: Union[List[dict], Iterable[dict]]) -> List[dict]:
+        with self._transaction():
+            return super().add_document(header, data)
+
+    def merge_documents(self, merge_key: str, target_merge_level: int) -> bool:
+        with self._transaction():
+            return super().merge_documents(merge_key, target_merge_level)
+
+    def _add_document(self, header: dict, data: bytes) -> dict:
+        doc_content = header.copy()
+        doc_content.pop('data', None)
+        doc_content['data_size'] = len(data)
+        sql = "INSERT OR REPLACE INTO XIA_DEPOSIT (topic_id, table_id, doc_id, {}, header, data) " \
+              "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)".format(', '.join(self.column_list))
+        self.connection.execute(sql, [self.topic_id, self.table_id, self._get_doc_id(doc_content)] +
+                                self._get_column_values(doc_content) +
+                                [json.dumps(doc_content, ensure_ascii=False), data])
+        self._commit()
+        return doc_content
+
+    def _save_header(self, ref: Any, doc_content: dict, data: bytes = None):
+        values = self._get_column_values(doc_content) + [json.dumps(doc_content, ensure_ascii=False)]
+        set_list = ['{} = ?'.format(column) for column in self.column_list + ['header']]
+        if data is not None:
+            set_list.append('data = ?')
+            values.append(data)
+        sql = "UPDATE XIA_DEPOSIT SET {} WHERE topic_id = ? AND table_id = ? AND doc_id = ?".format(', '.join(set_list))
+        self.connection.execute(sql, values + [self.topic_id, self.table_id, ref])
+        self._commit()
+
+    def _update_document(self, ref: Any, header: dict, data: bytes) -> dict:
+        doc_content = header.copy()
+        doc_content.pop('data', None)
+        doc_content['data_size'] = len(data)
+        self._save_header(ref, doc_content, data)
+        return doc_content
+
+    def _update_header(self, ref: Any, header: dict) -> dict:
+        doc_content = self.get_header_from_ref(ref)
+        for key, value in header.items():
+            if value == self.DELETE:
+                doc_content.pop(key, None)
+            else:
+                doc_content[key] = value
+        self._save_header(ref, doc_content)
+        return doc_content
+
+    def delete_documents(self, ref_list) -> bool:
+        sql = "DELETE FROM XIA_DEPOSIT WHERE topic_id = ? AND table_id = ? AND doc_id = ?"
+        self.connection.executemany(sql, [(self.topic_id, self.table_id, ref) for ref in ref_list])
+        self._commit()
+        return True
+
+    def get_header_from_ref(self, ref: Any) -> dict:
+        sql = "SELECT header FROM XIA_DEPOSIT WHERE topic_id = ? AND table_id = ? AND doc_id = ?"
+        row = self.connection.execute(sql, (self.topic_id, self.table_id, ref)).fetchone()
+        return json.loads(row[0]) if row else dict()
+
+    def get_data_from_header(self, header: dict) -> List[dict]:
+        sql = "SELECT data FROM XIA_DEPOSIT WHERE topic_id = ? AND table_id = ? AND doc_id = ?"
+        row = self.connection.execute(sql, (self.topic_id, self.table_id, self._get_doc_id(header))).fetchone()
+        return json.loads(gzip.decompress(row[0]).decode())
+
+    def get_ref_by_merge_key(self, merge_key: str) -> Any:
+        sql = "SELECT MAX(doc_id) FROM XIA_DEPOSIT WHERE topic_id = ? AND table_id = ? AND merge_key = ? " \
+              "AND merge_status <> 'header'"
+        row = self.connection.execute(sql, (self.topic_id, self.table_id, merge_key)).fetchone()
+        return row[0] if row else None
+
+    def get_stream_by_sort_key(self,
+                               status_list: List[str] = None,
+                               le_ge_key: str = None,
+                               reverse: bool = False,
+                               min_merge_level: int = 0,
+                               equal: bool = True) -> Generator[Any, None, None]:
+        if not status_list:
+            status_list = ['header', 'initial', 'merged', 'packaged']
+        where_list = ["topic_id = ?", "table_id = ?", "merge_status IN ({})".format(', '.join('?' * len(status_list)))]
+        values = [self.topic_id, self.table_id] + list(status_list)
+        if le_ge_key:
+            where_list.append("sort_key {}{} ?".format('<' if reverse else '>', '=' if equal else ''))
+            values.append(le_ge_key)
+        if min_merge_level > 0:
+            where_list.append("(merge_status = 'header' OR merge_level >= ?)")
+            values.append(min_merge_level)
+        sql = "SELECT doc_id FROM XIA_DEPOSIT WHERE {} ORDER BY sort_key {order}, doc_id {order}".format(
+            ' AND '.join(where_list), order='DESC' if reverse else 'ASC')
+        # The whole list is fetched so the caller could modify the documents during the iteration
+        for row in self.connection.execute(sql, values).fetchall():
+            if self.metrics is not None:
+                self._add_metric('documents_scanned')
+            yield row[0]
+
+    def get_table_header(self) -> Any:
+        sql = "SELECT MAX(doc_id) FROM XIA_DEPOSIT WHERE topic_id = ? AND table_id = ? AND merge_status = 'header'"
+        return self.connection.execute(sql, (self.topic_id, self.table_id)).fetchone()[0]
+
+    def inc_table_header(self, **kwargs) -> dict:
+        with self._transaction():
+            header_ref = self.get_table_header()
+            header_dict = self.get_header_from_ref(header_ref)
+            for key, value in kwargs.items():
+                header_dict[key] = header_dict.get(key, 0) + value
+            self.update_document(header_ref, header_dict)
+        return header_dict